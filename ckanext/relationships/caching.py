@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+'''Caching of relationship responses.
+
+GET responses of the hierarchy endpoint and of the
+``package_relationships_list`` API action carry an ``ETag`` and a
+``Last-Modified`` header derived from
+:py:func:`~ckanext.relationships.model.relationships_version` of the
+requested packages, over as many levels of relationships as the response
+may show, and from the datasets the user can read. Conditional requests
+that still match are answered with ``304 Not Modified`` before any resolver
+or action runs.
+
+Tree summaries of ``package_show`` are kept in Redis together with the
+generation numbers of the packages they depend on: the package itself and
+the packages of its path to the root. The generation of a package is
+increased when relationships of the package are created or deleted, and
+when the package or one of its children is updated or deleted, so only the
+summaries that may show it are recomputed.
+'''
+import hashlib
+import json
+
+from flask import g, request, make_response
+from sqlalchemy import event
+from werkzeug.http import is_resource_modified
+
+import ckan.plugins.toolkit as tk
+from ckan import model
+from ckan.lib.redis import connect_to_redis
+from ckan.model import meta
+
+from .model import CHANGED, relationships_version
+
+CONFIG_MAX_AGE = 'ckanext.relationships.cache_max_age'
+CONFIG_TREE_TTL = 'ckanext.relationships.tree_summary.cache_ttl'
+
+DEFAULT_TREE_TTL = 300
+
+# Never expire, so that a generation is not counted again from zero while
+# summaries stored with it are cached
+REDIS_GENERATION = 'ckanext-relationships:generation:{}'
+REDIS_TREE = 'ckanext-relationships:tree:{}:{}'
+
+CACHED_ACTIONS = ('package_relationships_list', )
+
+
+def package_refs_from_document(document_ast, variables):
+    '''Return the package ids or names passed as ``id`` arguments anywhere in
+    a GraphQL document, or None if one of them cannot be determined without
+    executing the query.'''
+    from graphql.language import ast
+
+    refs = []
+    stack = list(document_ast.definitions)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Field):
+            for argument in node.arguments or []:
+                if argument.name.value not in ('id', 'ids'):
+                    continue
+                value = _argument_value(argument.value, variables)
+                if value is None:
+                    return None
+                refs.extend(value if isinstance(value, list) else [value])
+        selection_set = getattr(node, 'selection_set', None)
+        if selection_set:
+            stack.extend(selection_set.selections)
+    return refs
+
+
+def _argument_value(value, variables):
+    from graphql.language import ast
+
+    if isinstance(value, ast.Variable):
+        return (variables or {}).get(value.name.value)
+    if isinstance(value, ast.ListValue):
+        values = [_argument_value(v, variables) for v in value.values]
+        return None if None in values else values
+    if isinstance(value, (ast.StringValue, ast.IntValue)):
+        return value.value
+    return None
+
+
+class CacheValidator(object):
+    '''ETag and Last-Modified of one response, showing the relationships of
+    the given packages within `depth` levels, or all levels without it.'''
+
+    def __init__(self, package_refs, *extra, depth=None):
+        from .logic.action import visibility_key
+
+        version, self.last_modified = relationships_version(
+            package_refs, depth)
+        self.etag = None
+        if version is not None:
+            visibility = visibility_key(
+                {'model': model, 'user': g.get('user')})
+            key = json.dumps([version, visibility] + list(extra),
+                             sort_keys=True)
+            self.etag = hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def not_modified(self):
+        '''Return a 304 response if the client's copy is still valid.'''
+        if self.etag is None:
+            return None
+        if is_resource_modified(request.environ, etag=self.etag,
+                                last_modified=self.last_modified):
+            return None
+        return self.apply(make_response('', 304))
+
+    def apply(self, response):
+        if self.etag is None:
+            return response
+        response.set_etag(self.etag)
+        if self.last_modified:
+            response.last_modified = self.last_modified
+        if g.get('user'):
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = tk.asint(
+                tk.config.get(CONFIG_MAX_AGE, 0))
+        return response
+
+
+def _action_validator():
+    if request.method != 'GET' or request.endpoint != 'api.action':
+        return None
+    if (request.view_args or {}).get('logic_function') not in CACHED_ACTIONS:
+        return None
+    data_dict = request.args.to_dict()
+    refs = [ref for ref in (data_dict.get('id'), data_dict.get('id2')) if ref]
+    if not refs:
+        return None
+    try:
+        tk.check_access('package_relationships_list',
+                        {'user': g.get('user')}, data_dict)
+    except (tk.NotAuthorized, tk.ObjectNotFound):
+        # Let the action produce the error response
+        return None
+    return CacheValidator(refs, sorted(data_dict.items()),
+                          request.view_args.get('ver'), depth=1)
+
+
+def before_action_request():
+    validator = _action_validator()
+    if validator is None:
+        return None
+    g.relationships_cache_validator = validator
+    return validator.not_modified()
+
+
+def after_action_request(response):
+    validator = g.pop('relationships_cache_validator', None)
+    if validator is not None and response.status_code == 200:
+        validator.apply(response)
+    return response
+
+
+def cached_tree_summary(package_id, visibility, compute):
+    '''Return the tree summary of a package from the cache, or from
+    `compute` when missing or invalidated.
+
+    `visibility` identifies the datasets the summary may show, as summaries
+    of the same package differ between users who can read different private
+    datasets. `compute` is called with ``primary=True`` after an
+    invalidation, as the read database may not have the change yet, and
+    returns the summary with the ids of the packages of its path.'''
+    ttl = tk.asint(tk.config.get(CONFIG_TREE_TTL, DEFAULT_TREE_TTL))
+    if not ttl:
+        return compute(primary=False)[0]
+    redis = connect_to_redis()
+    key = REDIS_TREE.format(package_id, visibility)
+    cached = redis.get(key)
+    if cached is not None:
+        cached = json.loads(cached)
+        ids = sorted(cached['generations'])
+        if _generations(redis, ids) == [
+                cached['generations'][id_] for id_ in ids]:
+            return cached['summary']
+    summary, ancestors = compute(primary=cached is not None)
+    ids = sorted(set([package_id] + list(ancestors)))
+    redis.setex(key, ttl, json.dumps({
+        'summary': summary,
+        'generations': dict(zip(ids, _generations(redis, ids))),
+    }))
+    return summary
+
+
+def _generations(redis, package_ids):
+    return [int(generation or 0) for generation in redis.mget(
+        [REDIS_GENERATION.format(id_) for id_ in package_ids])]
+
+
+def invalidate_tree_summaries(package_ids):
+    '''Drop the cached tree summaries showing any of the given packages when
+    the current transaction is committed, e.g. after a dataset has been
+    renamed or made private.
+
+    That is the summaries of the packages themselves and of those below
+    them, so a package that changed among the children of its parents is
+    passed with them.'''
+    meta.Session.info.setdefault(CHANGED, set()).update(package_ids)
+
+
+def _invalidate_after_commit(session):
+    package_ids = session.info.pop(CHANGED, None)
+    if package_ids \
+            and tk.asint(tk.config.get(CONFIG_TREE_TTL, DEFAULT_TREE_TTL)):
+        pipeline = connect_to_redis().pipeline()
+        for package_id in sorted(package_ids):
+            pipeline.incr(REDIS_GENERATION.format(package_id))
+        pipeline.execute()
+
+
+def _forget_after_rollback(session):
+    session.info.pop(CHANGED, None)
+
+
+event.listen(meta.Session, 'after_commit', _invalidate_after_commit)
+event.listen(meta.Session, 'after_rollback', _forget_after_rollback)
@@ -5,7 +5,15 @@ import click
 
 @click.group()
 def relationship():
-    pass
+    # Commands run outside of requests, whose teardown would otherwise end
+    # the transactions of the read sessions
+    click.get_current_context().call_on_close(_remove_read_sessions)
+
+
+def _remove_read_sessions():
+    from .model import remove_read_sessions
+
+    remove_read_sessions()
 
 
 @relationship.command()
@@ -30,5 +38,100 @@ def drop():
         click.echo("[INFO] GITIGNORE was not generated.", fg='blue')
 
 
+@relationship.command()
+def recount():
+    """Rebuild the relationship counters of every package."""
+    import ckan.model as model
+    from .model import recount as recount_
+
+    counters = recount_()
+    model.repo.commit()
+    click.secho("Rebuilt {} counters.".format(counters), fg="green")
+
+
+@relationship.command()
+@click.option('--top', default=10, show_default=True,
+              help='Number of hub packages to list.')
+@click.option('--tree-type', default=u'child_of', show_default=True,
+              help='Relationship type the trees are made of.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print the statistics as JSON.')
+def stats(top, tree_type, as_json):
+    """Report statistics of the whole relationship graph."""
+    import json
+
+    import ckan.model as model
+    from .model import PackageRelationship, iter_edges
+    from .stats import GraphStats
+
+    if tree_type not in PackageRelationship.get_all_types():
+        raise click.BadParameter(
+            'Unknown relationship type: {}'.format(tree_type),
+            param_hint='--tree-type')
+    if tree_type not in PackageRelationship.get_forward_types():
+        tree_type = PackageRelationship.reverse_to_forward_type(tree_type)
+
+    graph = GraphStats(tree_type)
+    for subject, object_, type_ in iter_edges():
+        graph.add(subject, object_, type_)
+    summary = graph.summary(top)
+
+    names = dict(model.Session.query(
+        model.Package.id, model.Package.name
+    ).filter(model.Package.id.in_([id_ for id_, _c in summary['hubs']])))
+    summary['hubs'] = [(names.get(id_, id_), count)
+                       for id_, count in summary['hubs']]
+
+    if as_json:
+        click.echo(json.dumps(summary, indent=2))
+        return
+
+    click.echo('Packages with relationships: {}'.format(summary['packages']))
+    click.echo('Relationships: {}'.format(summary['relationships']))
+    for type_, count in sorted(summary['types'].items()):
+        click.echo('  {}: {}'.format(type_, count))
+    click.echo('Connected components: {} (largest: {} packages)'.format(
+        summary['components'], summary['largest_component']))
+    click.echo('{} trees: {} (max depth: {}, average depth: {:.2f})'.format(
+        tree_type, summary['trees'], summary['max_depth'],
+        summary['average_depth']))
+    if summary['multiple_parents'] or summary['cycles']:
+        click.echo('  packages with several parents: {}, cycles: {}'.format(
+            summary['multiple_parents'], summary['cycles']))
+    click.echo('Fan-out (relationships per package):')
+    for low, high, count in summary['fanout']:
+        bucket = str(low) if low == high else '{}-{}'.format(low, high)
+        click.echo('  {:>11}: {}'.format(bucket, count))
+    click.echo('Top {} hubs:'.format(top))
+    for name, count in summary['hubs']:
+        click.echo('  {}: {}'.format(name, count))
+
+
+@relationship.command()
+@click.argument('output', type=click.File('wb'))
+@click.option('--format', 'format_', default='graphml', show_default=True,
+              type=click.Choice(['graphml', 'parquet', 'arrow', 'adjacency']),
+              help='graphml: nodes with the package attributes and edges; '
+                   'parquet, arrow: edge list with the package names; '
+                   'adjacency: compact binary adjacency.')
+def export(output, format_):
+    """Export the relationship graph to OUTPUT ('-' for stdout)."""
+    from . import export as export_
+    from .model import iter_edges, iter_nodes
+
+    if format_ == 'graphml':
+        export_.write_graphml(output, iter_nodes(), iter_edges(details=True))
+    elif format_ == 'adjacency':
+        nodes, edges = export_.write_adjacency(output, iter_edges())
+        click.echo('{} nodes, {} edges'.format(nodes, edges), err=True)
+    else:
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            raise click.ClickException(
+                'pyarrow is required for the {} format'.format(format_))
+        export_.write_arrow(output, iter_edges(details=True), format_)
+
+
 def get_commands():
     return [relationship]
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+'''Parsed-document cache and persisted queries for the GraphQL endpoint.
+
+Parsing and validating a query is done once per distinct query text, the
+result is kept in a bounded LRU cache keyed by the SHA-256 of the text.
+
+Clients may also send only the hash of a query, following the Automatic
+Persisted Queries protocol::
+
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}}}
+
+When the hash is unknown the request fails with ``PersistedQueryNotFound``
+and the client retries with both the query and its hash, which registers
+the query in Redis for every CKAN process. Only queries that are valid,
+within the cost budgets and at most
+``ckanext.relationships.graphql.persisted_queries.max_length`` characters
+long are registered, for
+``ckanext.relationships.graphql.persisted_queries.ttl`` seconds.
+'''
+import collections
+import functools
+import hashlib
+import json
+import logging
+import threading
+
+from graphql import GraphQLError, parse, validate
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql_server import HttpQueryError
+
+import ckan.plugins.toolkit as tk
+from ckan.lib.redis import connect_to_redis
+
+from .limits import check_cost
+
+log = logging.getLogger(__name__)
+
+CONFIG_CACHE_SIZE = 'ckanext.relationships.graphql.document_cache_size'
+CONFIG_PERSISTED = 'ckanext.relationships.graphql.persisted_queries'
+CONFIG_PERSISTED_MAX_LENGTH = \
+    'ckanext.relationships.graphql.persisted_queries.max_length'
+CONFIG_PERSISTED_TTL = 'ckanext.relationships.graphql.persisted_queries.ttl'
+
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_PERSISTED_MAX_LENGTH = 10000
+DEFAULT_PERSISTED_TTL = 24 * 60 * 60
+
+REDIS_KEY = 'ckanext-relationships:persisted-query:{}'
+
+
+class LRUCache(object):
+    '''A thread-safe mapping that keeps at most `maxsize` recent items.'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf8')).hexdigest()
+
+
+class CachedDocumentBackend(GraphQLBackend):
+    '''Parse, validate and cost every distinct query only once.
+
+    Invalid and over-budget documents are not cached, so they cannot push
+    valid ones out of the cache.'''
+
+    def __init__(self, maxsize):
+        self.documents = LRUCache(maxsize)
+
+    def document_from_string(self, schema, request_string):
+        key = query_hash(request_string)
+        document = self.documents.get(key)
+        if document is not None:
+            return document
+
+        document_ast = parse(request_string)
+        errors = validate(schema, document_ast)
+        if not errors:
+            cost, errors = check_cost(schema, document_ast)
+        if errors:
+            document = GraphQLDocument(
+                schema, request_string, document_ast,
+                lambda *args, **kwargs: ExecutionResult(
+                    errors=errors, invalid=True))
+            document.cost = 0
+            document.errors = errors
+            return document
+
+        document = GraphQLDocument(
+            schema, request_string, document_ast,
+            functools.partial(execute, schema, document_ast))
+        document.cost = cost.cost
+        document.errors = []
+        self.documents.set(key, document)
+        return document
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = CachedDocumentBackend(tk.asint(
+                    tk.config.get(CONFIG_CACHE_SIZE, DEFAULT_CACHE_SIZE)))
+    return _backend
+
+
+_queries = LRUCache(DEFAULT_CACHE_SIZE)
+
+
+def _get_persisted_query(sha256):
+    query = _queries.get(sha256)
+    if query is None:
+        query = connect_to_redis().get(REDIS_KEY.format(sha256))
+        if query is not None:
+            query = query.decode('utf8')
+            _queries.set(sha256, query)
+    return query
+
+
+def _set_persisted_query(sha256, query, schema):
+    max_length = tk.asint(tk.config.get(
+        CONFIG_PERSISTED_MAX_LENGTH, DEFAULT_PERSISTED_MAX_LENGTH))
+    if len(query) > max_length:
+        return
+    try:
+        document = get_backend().document_from_string(schema, query)
+    except GraphQLError:
+        return
+    if document.errors:
+        # Executed as usual to report the errors, but not registered
+        return
+    ttl = tk.asint(tk.config.get(CONFIG_PERSISTED_TTL, DEFAULT_PERSISTED_TTL))
+    connect_to_redis().set(REDIS_KEY.format(sha256), query, ex=ttl)
+    _queries.set(sha256, query)
+
+
+def _persisted_hash(extensions):
+    if not extensions:
+        return None
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            raise HttpQueryError(400, 'Extensions are invalid JSON.')
+    persisted = extensions.get('persistedQuery') or {}
+    return persisted.get('sha256Hash')
+
+
+def resolve_persisted_query(data, query_data, schema):
+    '''Return a copy of the GraphQL params in `data` with the query text
+    filled in from the persisted query hash, if one is given.
+
+    `query_data` holds the query string arguments, used for GET requests.
+    A query sent with its hash is registered if it is valid against
+    `schema`.
+    '''
+    if not tk.asbool(tk.config.get(CONFIG_PERSISTED, True)):
+        return data
+
+    sha256 = _persisted_hash(
+        data.get('extensions') or query_data.get('extensions'))
+    if not sha256:
+        return data
+
+    query = data.get('query') or query_data.get('query')
+    if query:
+        if query_hash(query) != sha256:
+            raise HttpQueryError(400, 'provided sha does not match query')
+        _set_persisted_query(sha256, query, schema)
+        return data
+
+    query = _get_persisted_query(sha256)
+    if query is None:
+        raise HttpQueryError(400, 'PersistedQueryNotFound')
+
+    data = dict(data.items())
+    data['query'] = query
+    return data
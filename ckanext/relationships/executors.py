@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''GraphQL executors used by the hierarchy endpoint.
+
+By default resolvers run synchronously, one after another. Setting
+``ckanext.relationships.graphql.executor`` to ``thread`` or ``asyncio`` runs
+every resolver on a shared thread pool of
+``ckanext.relationships.graphql.max_workers`` threads, so sibling fields and
+root queries of one document overlap their I/O. Each pool thread holds at
+most one database connection, so the pool size also bounds the number of
+connections used by GraphQL requests.
+'''
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+from graphql.execution.executors.asyncio import AsyncioExecutor
+from promise import Promise
+
+import ckan.plugins.toolkit as tk
+from ckan.model import meta
+
+from .model import remove_read_sessions
+
+log = logging.getLogger(__name__)
+
+CONFIG_EXECUTOR = 'ckanext.relationships.graphql.executor'
+CONFIG_MAX_WORKERS = 'ckanext.relationships.graphql.max_workers'
+
+DEFAULT_MAX_WORKERS = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                max_workers = tk.asint(
+                    tk.config.get(CONFIG_MAX_WORKERS, DEFAULT_MAX_WORKERS))
+                _pool = ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix='relationships-graphql')
+    return _pool
+
+
+def _in_request_context(fn):
+    '''Make `fn` callable from a pool thread.
+
+    CKAN actions need the current request (for the user and the config) and
+    use the thread-local ``meta.Session``, so the request context is copied
+    into the worker and the sessions are removed afterwards to return their
+    connections to the pools. The worker gets a fresh application context,
+    so the values of ``g``, including the acting user, are carried over
+    too.'''
+    if flask.has_request_context():
+        fn = flask.copy_current_request_context(
+            _with_globals(fn, dict(vars(flask.g._get_current_object()))))
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            meta.Session.remove()
+            remove_read_sessions()
+    return wrapper
+
+
+def _with_globals(fn, values):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for name, value in values.items():
+            setattr(flask.g, name, value)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+class PooledThreadExecutor(object):
+    '''Run every resolver on the shared thread pool.'''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.futures = []
+
+    def wait_until_finished(self):
+        # Resolved parents schedule their children from the worker threads,
+        # so keep waiting until no new work has been submitted.
+        while self.futures:
+            futures, self.futures = self.futures, []
+            for future in futures:
+                future.result()
+
+    def clean(self):
+        self.futures = []
+
+    def execute(self, fn, *args, **kwargs):
+        promise = Promise()
+        fn = _in_request_context(fn)
+
+        def task():
+            try:
+                promise.do_resolve(fn(*args, **kwargs))
+            except Exception as e:
+                promise.do_reject(e)
+
+        self.futures.append(self.pool.submit(task))
+        return promise
+
+
+class PooledAsyncioExecutor(AsyncioExecutor):
+    '''Drive resolvers from a private event loop.
+
+    Coroutine resolvers run on the loop, while the synchronous CKAN
+    resolvers are offloaded to the shared thread pool.'''
+
+    def __init__(self, pool):
+        super(PooledAsyncioExecutor, self).__init__(
+            loop=asyncio.new_event_loop())
+        self.pool = pool
+
+    def wait_until_finished(self):
+        try:
+            super(PooledAsyncioExecutor, self).wait_until_finished()
+        finally:
+            self.loop.close()
+
+    def execute(self, fn, *args, **kwargs):
+        if asyncio.iscoroutinefunction(fn):
+            return super(PooledAsyncioExecutor, self).execute(
+                fn, *args, **kwargs)
+
+        future = self.loop.run_in_executor(
+            self.pool,
+            functools.partial(_in_request_context(fn), *args, **kwargs))
+        self.futures.append(future)
+        return Promise.resolve(future)
+
+
+_executors = {
+    'thread': PooledThreadExecutor,
+    'asyncio': PooledAsyncioExecutor,
+}
+
+
+def get_executor():
+    '''Return a new executor for one GraphQL request, or None to let
+    graphql execute synchronously.'''
+    name = tk.config.get(CONFIG_EXECUTOR, 'sync')
+    if name == 'sync':
+        return None
+    if name not in _executors:
+        log.warning('Unknown %s value %r, falling back to sync',
+                    CONFIG_EXECUTOR, name)
+        return None
+    return _executors[name](_get_pool())
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+'''Export of the relationship graph for offline processing.
+
+Every writer takes the nodes and the edges as iterables, as yielded by
+:py:func:`~ckanext.relationships.model.iter_nodes` and
+:py:func:`~ckanext.relationships.model.iter_edges`, and writes them to a
+binary file object as they come, except for the adjacency format, which
+needs every edge before it can write the offsets.
+'''
+import datetime
+import itertools
+import json
+import struct
+import sys
+from array import array
+from xml.sax.saxutils import quoteattr, escape
+
+from .model import NODE_ATTRIBUTES
+
+EDGE_COLUMNS = ('subject_id', 'object_id', 'type', 'comment', 'extras',
+                'subject_name', 'object_name')
+
+ADJACENCY_MAGIC = b'CKANRELS'
+ADJACENCY_VERSION = 1
+
+_GRAPHML_TYPES = {
+    'private': 'boolean',
+}
+
+
+def _text(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True)
+    return u'{}'.format(value)
+
+
+def write_graphml(out, nodes, edges):
+    '''Write the graph as GraphML, with the package attributes on the nodes
+    and the type, comment and extras (as JSON) on the edges.
+
+    `edges` must be yielded with details.'''
+    def write(text):
+        out.write(text.encode('utf8'))
+
+    write(u'<?xml version="1.0" encoding="UTF-8"?>\n'
+          u'<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    for name in NODE_ATTRIBUTES:
+        write(u'<key id={0} for="node" attr.name={0} attr.type="{1}"/>\n'
+              .format(quoteattr(name), _GRAPHML_TYPES.get(name, 'string')))
+    for name in ('type', 'comment', 'extras'):
+        write(u'<key id={0} for="edge" attr.name={0} attr.type="string"/>\n'
+              .format(quoteattr('edge_' + name)))
+    write(u'<graph id="relationships" edgedefault="directed">\n')
+
+    for row in nodes:
+        write(u'<node id={}>'.format(quoteattr(row[0])))
+        for name, value in zip(NODE_ATTRIBUTES, row[1:]):
+            if value is not None:
+                write(u'<data key={}>{}</data>'.format(
+                    quoteattr(name), escape(_text(value))))
+        write(u'</node>\n')
+
+    for subject, object_, type_, comment, extras, _s, _o in edges:
+        write(u'<edge source={} target={}>'.format(
+            quoteattr(subject), quoteattr(object_)))
+        for name, value in (('type', type_), ('comment', comment),
+                            ('extras', extras)):
+            if value:
+                write(u'<data key={}>{}</data>'.format(
+                    quoteattr('edge_' + name), escape(_text(value))))
+        write(u'</edge>\n')
+    write(u'</graph>\n</graphml>\n')
+
+
+def write_arrow(out, edges, format='parquet', batch_size=10000):
+    '''Write the edge list, with the names of the packages joined in, as
+    Parquet or as an Arrow IPC file.
+
+    `edges` must be yielded with details. Requires pyarrow.'''
+    import pyarrow as pa
+
+    schema = pa.schema(
+        [(name, pa.string()) for name in EDGE_COLUMNS])
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(out, schema)
+        write = writer.write_table
+    else:
+        writer = pa.ipc.new_file(out, schema)
+        write = writer.write
+
+    edges = iter(edges)
+    try:
+        while True:
+            rows = list(itertools.islice(edges, batch_size))
+            if not rows:
+                break
+            columns = [
+                [None if value is None else _text(value) for value in column]
+                for column in zip(*rows)]
+            write(pa.Table.from_arrays(
+                [pa.array(column, pa.string()) for column in columns],
+                schema=schema))
+    finally:
+        writer.close()
+
+
+def write_adjacency(out, edges):
+    '''Write the graph as a compact binary adjacency, in compressed sparse
+    row form, with the edges in their stored direction.
+
+    Layout, little-endian::
+
+        8s   magic b'CKANRELS'
+        u32  version
+        u32  number of nodes, u32 number of edges, u32 number of types
+        for every type: u16 length, utf-8 name
+        for every node: u16 length, utf-8 package id
+        u64  offsets, one per node plus one: the edges of node ``i`` are
+             those from ``offsets[i]`` to ``offsets[i + 1]``
+        u32  target node of every edge
+        u16  type of every edge
+
+    Returns the number of nodes and of edges written.'''
+    index = {}
+    ids = []
+    type_index = {}
+    sources = array('I')
+    targets = array('I')
+    edge_types = array('H')
+
+    def node(package_id):
+        position = index.get(package_id)
+        if position is None:
+            position = index[package_id] = len(ids)
+            ids.append(package_id)
+        return position
+
+    for row in edges:
+        subject, object_, type_ = row[:3]
+        sources.append(node(subject))
+        targets.append(node(object_))
+        edge_types.append(type_index.setdefault(type_, len(type_index)))
+
+    # Counting sort of the edges by source
+    offsets = array('Q', [0]) * (len(ids) + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for position in range(len(ids)):
+        offsets[position + 1] += offsets[position]
+    fill = array('Q', offsets)
+    sorted_targets = array('I', [0]) * len(targets)
+    sorted_types = array('H', [0]) * len(edge_types)
+    for source, target, type_ in zip(sources, targets, edge_types):
+        sorted_targets[fill[source]] = target
+        sorted_types[fill[source]] = type_
+        fill[source] += 1
+
+    out.write(ADJACENCY_MAGIC)
+    out.write(struct.pack('<IIII', ADJACENCY_VERSION, len(ids),
+                          len(targets), len(type_index)))
+    for name in sorted(type_index, key=type_index.get) + ids:
+        encoded = name.encode('utf8')
+        out.write(struct.pack('<H', len(encoded)))
+        out.write(encoded)
+    for values in (offsets, sorted_targets, sorted_types):
+        _write_array(out, values)
+    return len(ids), len(targets)
+
+
+def _write_array(out, values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    out.write(values.tobytes())
+
+
+def _read_array(in_, typecode, count):
+    values = array(typecode)
+    values.frombytes(in_.read(values.itemsize * count))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def read_adjacency(in_):
+    '''Read a graph written by :py:func:`write_adjacency`.
+
+    :returns: ``(package_ids, types, offsets, targets, edge_types)``, the
+        last three as arrays
+    '''
+    def unpack(fmt):
+        return struct.unpack(fmt, in_.read(struct.calcsize(fmt)))
+
+    def string():
+        length, = unpack('<H')
+        return in_.read(length).decode('utf8')
+
+    if in_.read(len(ADJACENCY_MAGIC)) != ADJACENCY_MAGIC:
+        raise ValueError('Not a relationship adjacency file')
+    version, nodes, edges, types = unpack('<IIII')
+    if version != ADJACENCY_VERSION:
+        raise ValueError('Unsupported version: {}'.format(version))
+    type_names = [string() for _ in range(types)]
+    package_ids = [string() for _ in range(nodes)]
+    offsets = _read_array(in_, 'Q', nodes + 1)
+    targets = _read_array(in_, 'I', edges)
+    edge_types = _read_array(in_, 'H', edges)
+    return package_ids, type_names, offsets, targets, edge_types
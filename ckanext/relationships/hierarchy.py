@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+'''The GraphQL schema and view of the hierarchy endpoint.
+
+Importing this module loads graphene and builds the schema, so it is only
+imported when the endpoint is first requested.
+'''
+import graphene
+from graphql import GraphQLError
+import json
+import uuid
+
+from flask import Response, g, request
+from flask_graphql import GraphQLView
+from graphql_server import HttpQueryError
+
+import ckan.logic as logic
+from datetime import datetime as dt, timezone
+from ckan.model.package import Package
+
+from .caching import CacheValidator, package_refs_from_document
+from .documents import get_backend, resolve_persisted_query
+from .limits import consume
+from .model import read_session
+from .executors import get_executor
+
+# <Package id=55601304-bcda-4314-9bb3-5f961378b92f
+# name=abraham title=Abraham version= url= author=
+# author_email= maintainer= maintainer_email= notes=
+# license_id=cc-by type=dataset owner_org=c31bf3ba-a6ae-453b-9552-492c3652f0e7
+# creator_user_id=None metadata_created=2020-03-10 08:35:12.329084
+# metadata_modified=2020-03-10 11:59:50.715404 private=True state=active>
+# (Pdb) dir(pkg_dicts[0])
+
+
+
+class Child(graphene.ObjectType):
+    id = graphene.ID()
+    name = graphene.String()
+    title = graphene.String()
+    url = graphene.String()
+    description = graphene.String()
+    private = graphene.Boolean()
+    pkg_type = graphene.String()
+    state = graphene.String()
+    created_date = graphene.DateTime()
+    modified_date = graphene.DateTime()
+    license_id = graphene.String()
+    owner_org = graphene.ID()
+
+class Dataset(graphene.ObjectType):
+    id = graphene.ID()
+    name = graphene.String()
+    title = graphene.String()
+    url = graphene.String()
+    description = graphene.String()
+    private = graphene.Boolean()
+    pkg_type = graphene.String()
+    state = graphene.String()
+    created_date = graphene.DateTime()
+    modified_date = graphene.DateTime()
+    license_id = graphene.String()
+    owner_org = graphene.ID()
+    child = graphene.Field(Child)
+    relationships = graphene.List(lambda: Relation)
+
+
+class Relation(graphene.ObjectType):
+    subject = graphene.ID()
+    type = graphene.String()
+    object = graphene.ID()
+    comment = graphene.String()
+    extras = graphene.JSONString()
+    depth = graphene.Int()
+
+
+def _dataset(pkg, relationships=None):
+    return Dataset(
+        id=pkg.id,
+        name=pkg.name,
+        title=pkg.title,
+        url=pkg.url,
+        description=pkg.notes,
+        private=pkg.private,
+        pkg_type=pkg.type,
+        state=pkg.state,
+        created_date=pkg.metadata_created,
+        modified_date=pkg.metadata_modified,
+        license_id=pkg.license_id,
+        owner_org=pkg.owner_org,
+        relationships=[Relation(**rel) for rel in relationships or []],
+    )
+
+
+class Query(graphene.ObjectType):
+    package = graphene.List(Dataset, id=graphene.ID())
+    child = graphene.List(Child, id=graphene.ID())
+    packages = graphene.List(
+        Dataset,
+        ids=graphene.List(graphene.ID, required=True),
+        type=graphene.String(),
+        depth=graphene.Int(default_value=1),
+        extras=graphene.JSONString(),
+        as_of=graphene.DateTime(),
+    )
+
+    def resolve_packages(self, info, ids, type=None, depth=1, extras=None,
+                         as_of=None):
+        data_dict = {'ids': ids, 'type': type, 'depth': depth}
+        if extras is not None:
+            data_dict['extras'] = extras
+        if as_of is not None:
+            if as_of.tzinfo is not None:
+                as_of = as_of.astimezone(timezone.utc).replace(tzinfo=None)
+            data_dict['as_of'] = as_of
+        try:
+            relationships = logic.get_action(
+                'package_relationships_list_many')(
+                    {'api_version': 2}, data_dict)
+        except (logic.NotFound, logic.NotAuthorized,
+                logic.ValidationError) as e:
+            raise GraphQLError(str(e))
+
+        packages = {}
+        for pkg in read_session().query(Package).filter(
+                Package.id.in_(ids) | Package.name.in_(ids)):
+            packages[pkg.id] = packages[pkg.name] = pkg
+        return [_dataset(packages[ref], relationships[ref]) for ref in ids]
+
+    def resolve_child(self, info, id):
+        return [
+            Package(
+                id=pkg_dict['id'],
+                title=pkg_dict['title']
+            ) for pkg_dict in sub_pkgs.values()
+        ]
+
+    def resolve_package(self, info, id):
+        pkg_dict = logic.get_action('package_show')(None, {'id': id})
+
+        if not pkg_dict:
+            raise GraphQLError(f"The package with id '{id}' doesn't exists")
+
+        if pkg_dict['relationships_as_object']:
+            as_object = [
+                pkg['__extras']['subject_package_id']
+                for pkg in pkg_dict['relationships_as_object']
+            ]
+
+        if pkg_dict['relationships_as_subject']:
+            as_subject = [
+                pkg['__extras']['object_package_id']
+                for pkg in pkg_dict['relationships_as_subject']
+            ]
+        sub_pkgs = {}
+        if as_object:
+            for id in as_object:
+                sub_pkgs[id] = logic.get_action('package_show')(None, {'id': id})
+
+        return [
+            Package(
+                id=pkg_dict['id'],
+                name=pkg_dict['name'],
+                title=pkg_dict['title'],
+                url=pkg_dict['url'],
+                description=pkg_dict['notes'],
+                private=pkg_dict['private'],
+                pkg_type=pkg_dict['type'],
+                state=pkg_dict['state'],
+                created_date = pkg_dict['metadata_created'],
+                modified_date = pkg_dict['metadata_modified'],
+                license_id = pkg_dict['license_id'],
+                owner_org = pkg_dict['owner_org'],
+                child = graphene.Field(Child, default_value=sub_pkgs)
+            )
+        ]
+class NewQuery(graphene.ObjectType):
+    people = graphene.Field(Query)
+
+    def resolve_people(self, info):
+        return Query()
+
+package_schema = graphene.Schema(query=NewQuery)
+
+
+class HierarchyView(GraphQLView):
+
+    def get_executor(self):
+        # A fresh executor per request, all sharing one bounded pool
+        return get_executor()
+
+    def get_backend(self):
+        return get_backend()
+
+    def parse_body(self):
+        data = super(HierarchyView, self).parse_body()
+        if isinstance(data, list):
+            return [resolve_persisted_query(entry, {}, self.schema)
+                    for entry in data]
+        return resolve_persisted_query(data, request.args, self.schema)
+
+    def dispatch_request(self):
+        documents = self._documents()
+
+        cost = sum(document.cost for document, variables in documents or [])
+        if cost and not consume(g.get('user') or request.remote_addr, cost):
+            return self.format_error_response(
+                'Rate limit exceeded, retry later', 429)
+
+        validator = self._cache_validator(documents)
+        if validator is not None:
+            not_modified = validator.not_modified()
+            if not_modified is not None:
+                return not_modified
+
+        response = super(HierarchyView, self).dispatch_request()
+        if validator is not None and response.status_code == 200:
+            validator.apply(response)
+        return response
+
+    def format_error_response(self, message, status):
+        response = json.dumps({'errors': [{'message': message}]})
+        return Response(response, status=status,
+                        content_type='application/json')
+
+    def _documents(self):
+        '''Return ``(document, variables)`` of every operation in the request,
+        or None if the request is malformed and left to the GraphQL view to
+        report.'''
+        if self.should_display_graphiql():
+            return None
+        try:
+            data = self.parse_body()
+        except HttpQueryError:
+            return None
+
+        documents = []
+        for entry in data if isinstance(data, list) else [data]:
+            query = entry.get('query') or request.args.get('query')
+            variables = entry.get('variables') \
+                or request.args.get('variables')
+            if not query:
+                return None
+            if isinstance(variables, str):
+                try:
+                    variables = json.loads(variables)
+                except ValueError:
+                    return None
+            try:
+                document = get_backend().document_from_string(
+                    self.schema, query)
+            except GraphQLError:
+                return None
+            documents.append((document, variables))
+        return documents
+
+    def _cache_validator(self, documents):
+        if request.method != 'GET' or not documents or len(documents) > 1:
+            return None
+
+        document, variables = documents[0]
+        refs = package_refs_from_document(document.document_ast, variables)
+        if not refs:
+            return None
+        return CacheValidator(refs, document.document_string, variables)
@@ -9,6 +9,8 @@ class IRelationships(interfaces.Interface):
         Provides an ability to define own types of relationships
         between packages in additional of existed "child_of"-"parent_of"
 
+        The types are collected once, when CKAN starts.
+
         The relationships should be provided as a pair of object-subject
 
         If object and subject are equal, then the non-directional
@@ -23,7 +25,7 @@ class IRelationships(interfaces.Interface):
             ("siblings", "siblings")
         ]
         '''
-        return rel_dict
+        return []
 
     def get_printable_rel_types(self):
         '''
@@ -38,4 +40,36 @@ class IRelationships(interfaces.Interface):
             ("is a child of {}", "is a parent of {}")
         ]
         '''
-        return rel_printable_dict
\ No newline at end of file
+        return []
+
+    def get_rel_type_rules(self):
+        '''
+        Semantics of relationship types, which decide the queries run for
+        them. Optional for every type and rule; the rules of
+        ``ckanext.relationships.types_file`` take precedence.
+
+        Rules, by forward or reverse type:
+
+        ``transitive``
+            follow the relationships beyond the first level in traversals
+            (default: true unless symmetric)
+        ``hierarchical``
+            the subject is a child of the object, which allows tree
+            summaries, re-parenting and moving subtrees; implies
+            ``acyclic`` (default: false, true for ``child_of``)
+        ``symmetric``
+            the type is its own reverse; must match the type pair
+        ``acyclic``
+            reject relationships closing a cycle (default: false)
+        ``indexed``
+            expose the type as search filters and indexed fields
+            (default: true)
+        ``cached``
+            allow caching results derived from the type (default: true)
+
+        rules = {
+            "depends_on": {"acyclic": True},
+            "links_to": {"transitive": False, "indexed": False},
+        }
+        '''
+        return {}
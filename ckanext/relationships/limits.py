@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''Static cost analysis and rate limiting of GraphQL queries.
+
+Every document is analysed once, when it is parsed, for its depth, its number
+of fields and its estimated cost: each field costs one unit per object it is
+expected to be resolved for, where every list field not restricted to a
+single ``id`` multiplies the objects below it by the number of ``ids`` or
+by the average relationship fan-out of the catalogue. Documents over any of
+the configured budgets are rejected before execution.
+
+The cost of each executed document is also charged to a per-user token
+bucket kept in Redis, refilled at a constant rate.
+'''
+import threading
+import time
+
+from graphql import GraphQLError
+from graphql.language import ast
+from graphql.type import GraphQLList
+
+import ckan.plugins.toolkit as tk
+from ckan.lib.redis import connect_to_redis
+
+from .model import average_fanout
+
+CONFIG_MAX_DEPTH = 'ckanext.relationships.graphql.max_depth'
+CONFIG_MAX_FIELDS = 'ckanext.relationships.graphql.max_fields'
+CONFIG_MAX_COST = 'ckanext.relationships.graphql.max_cost'
+CONFIG_CAPACITY = 'ckanext.relationships.graphql.rate_limit.capacity'
+CONFIG_REFILL_RATE = 'ckanext.relationships.graphql.rate_limit.refill_rate'
+CONFIG_BATCH_LIMIT = 'ckanext.relationships.batch_limit'
+CONFIG_TRAVERSAL_MAX_DEPTH = 'ckanext.relationships.traversal_max_depth'
+
+DEFAULT_MAX_DEPTH = 10
+DEFAULT_MAX_FIELDS = 200
+DEFAULT_MAX_COST = 5000
+DEFAULT_REFILL_RATE = 10
+DEFAULT_BATCH_LIMIT = 100
+DEFAULT_TRAVERSAL_MAX_DEPTH = 5
+
+FANOUT_TTL = 300
+
+REDIS_KEY = 'ckanext-relationships:rate-limit:{}'
+
+# Refill the bucket for the time elapsed since the last request, then take
+# `cost` tokens out of it if there are enough. Returns 1 if the request is
+# allowed.
+_TOKEN_BUCKET = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return allowed
+'''
+
+
+class QueryCost(object):
+
+    def __init__(self, depth=0, fields=0, cost=0):
+        self.depth = depth
+        self.fields = fields
+        self.cost = cost
+
+
+_fanout = (None, 0)
+_fanout_lock = threading.Lock()
+
+
+def _get_fanout():
+    global _fanout
+    value, expires = _fanout
+    if value is None or expires < time.time():
+        with _fanout_lock:
+            value = max(1.0, average_fanout())
+            _fanout = (value, time.time() + FANOUT_TTL)
+    return value
+
+
+def _list_multiplier(field, fanout):
+    '''Return how many objects a list field is expected to resolve to.
+
+    Lists keyed by a single ``id`` hold one object, lists keyed by ``ids``
+    one per id, and any other list holds `fanout` objects per level of
+    ``depth``. Arguments passed as variables are assumed to be at their
+    configured maximum.'''
+    arguments = {
+        argument.name.value: argument.value
+        for argument in field.arguments or []
+    }
+    if 'id' in arguments:
+        return 1
+    if 'ids' in arguments:
+        if isinstance(arguments['ids'], ast.ListValue):
+            multiplier = max(1, len(arguments['ids'].values))
+        else:
+            multiplier = tk.asint(
+                tk.config.get(CONFIG_BATCH_LIMIT, DEFAULT_BATCH_LIMIT))
+    else:
+        multiplier = fanout
+    if 'depth' in arguments:
+        if isinstance(arguments['depth'], ast.IntValue):
+            depth = int(arguments['depth'].value)
+        else:
+            depth = tk.asint(tk.config.get(
+                CONFIG_TRAVERSAL_MAX_DEPTH, DEFAULT_TRAVERSAL_MAX_DEPTH))
+        multiplier *= fanout ** max(0, depth - 1)
+    return multiplier
+
+
+def analyse(schema, document_ast, fanout, max_depth):
+    '''Return the :py:class:`QueryCost` of a parsed document.
+
+    Selections deeper than `max_depth` are not walked, the depth is then
+    reported as ``max_depth + 1``.'''
+    result = QueryCost()
+    fragments = {
+        definition.name.value: definition
+        for definition in document_ast.definitions
+        if isinstance(definition, ast.FragmentDefinition)
+    }
+    stack = []
+    for definition in document_ast.definitions:
+        if isinstance(definition, ast.OperationDefinition):
+            root_type = schema.get_query_type()
+            if definition.operation == 'mutation':
+                root_type = schema.get_mutation_type()
+            stack.append(
+                (definition.selection_set, root_type, 1, 1, frozenset()))
+
+    while stack:
+        selection_set, parent_type, level, multiplier, seen = stack.pop()
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.FragmentSpread):
+                name = selection.name.value
+                if name in seen or name not in fragments:
+                    continue
+                stack.append((fragments[name].selection_set, parent_type,
+                              level, multiplier, seen | {name}))
+                continue
+
+            if isinstance(selection, ast.InlineFragment):
+                fragment_type = parent_type
+                if selection.type_condition:
+                    fragment_type = schema.get_type(
+                        selection.type_condition.name.value)
+                stack.append((selection.selection_set, fragment_type,
+                              level, multiplier, seen))
+                continue
+
+            result.fields += 1
+            result.cost += multiplier
+            result.depth = max(result.depth, level)
+            if not selection.selection_set:
+                continue
+            if level >= max_depth:
+                result.depth = max_depth + 1
+                continue
+
+            field_def = getattr(parent_type, 'fields', {}).get(
+                selection.name.value)
+            if field_def is None:
+                continue
+            field_type = field_def.type
+            child_multiplier = multiplier
+            while hasattr(field_type, 'of_type'):
+                if isinstance(field_type, GraphQLList):
+                    child_multiplier *= _list_multiplier(selection, fanout)
+                field_type = field_type.of_type
+            stack.append((selection.selection_set, field_type, level + 1,
+                          child_multiplier, seen))
+    return result
+
+
+def check_cost(schema, document_ast):
+    '''Return the cost of a document and the list of budget errors.'''
+    max_depth = tk.asint(tk.config.get(CONFIG_MAX_DEPTH, DEFAULT_MAX_DEPTH))
+    max_fields = tk.asint(
+        tk.config.get(CONFIG_MAX_FIELDS, DEFAULT_MAX_FIELDS))
+    max_cost = tk.asint(tk.config.get(CONFIG_MAX_COST, DEFAULT_MAX_COST))
+
+    cost = analyse(schema, document_ast, _get_fanout(), max_depth)
+    errors = []
+    if cost.depth > max_depth:
+        errors.append(GraphQLError(
+            'Query is too deep, the maximum depth is {}'.format(max_depth)))
+    if cost.fields > max_fields:
+        errors.append(GraphQLError(
+            'Query has {} fields, the maximum is {}'.format(
+                cost.fields, max_fields)))
+    if cost.cost > max_cost:
+        errors.append(GraphQLError(
+            'Query cost is estimated at {:.0f}, the maximum is {}'.format(
+                cost.cost, max_cost)))
+    return cost, errors
+
+
+def consume(key, cost):
+    '''Take `cost` tokens from the bucket of `key`.
+
+    Returns False if the bucket does not hold enough tokens. Always allows
+    the request when rate limiting is disabled.'''
+    capacity = tk.asint(tk.config.get(CONFIG_CAPACITY, 0))
+    if not capacity:
+        return True
+    rate = float(tk.config.get(CONFIG_REFILL_RATE, DEFAULT_REFILL_RATE))
+    bucket = connect_to_redis().register_script(_TOKEN_BUCKET)
+    allowed = bucket(keys=[REDIS_KEY.format(key)],
+                     args=[capacity, rate, time.time(), cost])
+    return bool(allowed)
@@ -1,6 +1,42 @@
+import hashlib
+import json
+
+import ckan.authz as authz
 import ckan.logic
+import ckan.lib.navl.dictization_functions
+import ckan.plugins.toolkit as tk
 import logging
-from .schema import default_create_relationship_schema
+from flask import g, has_request_context
+from sqlalchemy import and_, or_, tuple_
+from .schema import (
+    default_create_relationship_schema,
+    default_update_relationship_schema,
+    default_changes_since_schema,
+    default_list_schema,
+    default_list_many_schema,
+)
+from ..caching import cached_tree_summary
+from ..model import (
+    PackageRelationship,
+    Relationship,
+    RelationshipChange,
+    closing_cycles,
+    copy_children,
+    delete_relationships,
+    existing_relationships,
+    involving,
+    is_descendant,
+    move_children,
+    read_session,
+    visible_packages,
+    relationship_counts,
+    relationships_of,
+    resolve_package_ids,
+    subtree,
+    traverse,
+    tree_summary,
+    upsert_relationships,
+)
 
 log = logging.getLogger(__name__)
 
@@ -9,6 +45,7 @@ NotFound = ckan.logic.NotFound
 _check_access = ckan.logic.check_access
 _get_or_bust = ckan.logic.get_or_bust
 _get_action = ckan.logic.get_action
+_validate = ckan.lib.navl.dictization_functions.validate
 
 
 def package_relationship_create(context, data_dict):
@@ -27,50 +64,110 @@ def package_relationship_create(context, data_dict):
     :type type: string
     :param comment: a comment about the relationship (optional)
     :type comment: string
+    :param extras: attributes of the relationship, such as ``weight`` or
+        ``valid_from``, as a JSON object (optional)
+    :type extras: dictionary
 
     :returns: the newly created package relationship
     :rtype: dictionary
 
     '''
     model = context['model']
-    user = context['user']
     schema = context.get('schema') or default_create_relationship_schema()
 
     # TODO: do we need it?
     api = context.get('api_version')
     ref_package_by = 'id' if api == 2 else 'name'
 
-    id1, id2, rel_type = _get_or_bust(data_dict, ['subject', 'object', 'type'])
-    comment = data_dict.get('comment', u'')
-
-    pkg1 = model.Package.get(id1)
-    pkg2 = model.Package.get(id2)
-    if not pkg1:
-        raise NotFound(f'Subject package {id1} was not found.')
-    if not pkg2:
-        return NotFound(f'Object package {id2} was not found.')
-
-    data, errors = _validate(data_dict, schema, context)
-    if errors:
-        model.Session.rollback()
-        raise ValidationError(errors)
+    _get_or_bust(data_dict, ['subject', 'object', 'type'])
+    data, = _validate_relationships(context, [data_dict], schema)
 
     _check_access('package_relationship_create', context, data_dict)
 
-    # Create a Package Relationship.
-    existing_rels = pkg1.get_relationships_with(pkg2, rel_type)
-    if existing_rels:
-        return _update_package_relationship(existing_rels[0],
-                                            comment, context)
-    rel = pkg1.add_relationship(rel_type, pkg2, comment=comment)
+    # Create a Package Relationship, or update the existing one, in a single
+    # statement that concurrent writers cannot race.
+    key = _forward(data['subject'], data['type'], data['object'])
+    relationship_dicts, = _upsert_relationships(
+        model, {key: (data.get('comment', u''), data.get('extras'))},
+        ref_package_by)
     if not context.get('defer_commit'):
-        model.repo.commit_and_remove()
-    context['relationship'] = rel
-
-    relationship_dicts = rel.as_dict(ref_package_by=ref_package_by)
+        model.repo.commit()
     return relationship_dicts
 
 
+def _upsert_relationships(model, values, ref_package_by, check_cycles=True):
+    '''Create or update the relationships of `values`, as taken by
+    :py:func:`~ckanext.relationships.model.upsert_relationships`, and return
+    them as dicts, in the same order.
+
+    New relationships of acyclic types closing a cycle are rejected, with
+    one query per such type.'''
+    written = upsert_relationships(values)
+    if check_cycles:
+        _check_cycles(model, written)
+    current = dict(
+        (key, (comment, extras))
+        for key, (_op, comment, extras) in written.items())
+    unchanged = [key for key in values if key not in current]
+    for rel in PackageRelationship.get_active_many(unchanged):
+        current[(rel.subject_package_id, rel.type, rel.object_package_id)] = (
+            rel.comment, rel.extras)
+    refs = _package_refs(model, set(
+        id_ for subject, _t, object_ in values for id_ in (subject, object_)),
+        ref_package_by)
+    return [{
+        'subject': refs[subject],
+        'type': rel_type,
+        'object': refs[object_],
+        'comment': current[(subject, rel_type, object_)][0],
+        'extras': current[(subject, rel_type, object_)][1] or {},
+    } for subject, rel_type, object_ in values]
+
+
+def _check_cycles(model, written):
+    created = {}
+    for (subject, rel_type, object_), (op, _c, _e) in written.items():
+        if op == RelationshipChange.CREATE \
+                and PackageRelationship.has_rule(rel_type, 'acyclic'):
+            created.setdefault(rel_type, []).append((subject, object_))
+    for rel_type, edges in sorted(created.items()):
+        cycles = closing_cycles(edges, rel_type)
+        if cycles:
+            model.Session.rollback()
+            subject, object_ = min(cycles)
+            raise ValidationError({'object': [
+                'A {} relationship of {} with {} would close a cycle'.format(
+                    rel_type, subject, object_)]})
+
+
+def _validate_relationships(context, data_dicts, schema):
+    '''Validate many relationship dicts, checking every dataset they
+    reference with a single query.
+
+    Dataset names are converted to ids in the validated dicts.'''
+    model = context['model']
+    refs = set()
+    for data_dict in data_dicts:
+        refs.update(
+            ref for ref in (data_dict.get('subject'), data_dict.get('object'))
+            if isinstance(ref, str))
+    # Read by the relationship_package_exists validator. A copy, so the
+    # caller's context is left as it was
+    context = dict(context, relationship_package_ids=resolve_package_ids(refs))
+
+    validated, errors = [], []
+    for data_dict in data_dicts:
+        data, error = _validate(data_dict, schema, context)
+        validated.append(data)
+        errors.append(error)
+    if any(errors):
+        model.Session.rollback()
+        if len(data_dicts) == 1:
+            raise ValidationError(errors[0])
+        raise ValidationError({'relationships': errors})
+    return validated
+
+
 def package_relationship_delete(context, data_dict):
     '''Delete a dataset (package) relationship.
 
@@ -88,7 +185,6 @@ def package_relationship_delete(context, data_dict):
 
     '''
     model = context['model']
-    user = context['user']
     id1, id2, rel = _get_or_bust(data_dict, ['subject', 'object', 'type'])
 
     pkg1 = model.Package.get(id1)
@@ -96,25 +192,28 @@ def package_relationship_delete(context, data_dict):
     if not pkg1:
         raise NotFound(f'Subject package {id1} was not found.')
     if not pkg2:
-        return NotFound(f'Object package {id2} was not found.')
+        raise NotFound(f'Object package {id2} was not found.')
 
-    existing_rels = pkg1.get_relationships_with(pkg2, rel)
-    if not existing_rels:
+    relationship = PackageRelationship.get_active(
+        *_forward(pkg1.id, rel, pkg2.id))
+    if not relationship:
         raise NotFound
 
-    relationship = existing_rels[0]
-    revisioned_details = 'Package Relationship: %s %s %s' % (id1, rel, id2)
-
     context['relationship'] = relationship
     _check_access('package_relationship_delete', context, data_dict)
 
     relationship.delete()
-    model.repo.commit()
+    RelationshipChange.record(RelationshipChange.DELETE, relationship)
+    if not context.get('defer_commit'):
+        model.repo.commit()
 
 
+@tk.side_effect_free
 def package_relationships_list(context, data_dict):
     '''Return a dataset (package)'s relationships.
 
+    Relationships with datasets the user cannot read are left out.
+
     :param id: the id or name of the first package
     :type id: string
     :param id2: the id or name of the second package
@@ -122,6 +221,12 @@ def package_relationships_list(context, data_dict):
     :param rel: relationship as string see
         :py:func:`~ckan.logic.action.create.package_relationship_create` for
         the relationship types (optional)
+    :param extras: return only the relationships whose extras contain these
+        keys and values, as a JSON object (optional)
+    :type extras: dictionary
+    :param as_of: return the relationships as they were at this date and
+        time, in UTC (optional)
+    :type as_of: ISO 8601 string
 
     :rtype: list of dictionaries
 
@@ -132,7 +237,10 @@ def package_relationships_list(context, data_dict):
 
     id1 = _get_or_bust(data_dict, "id")
     id2 = data_dict.get("id2")
-    rel = data_dict.get("rel")
+    data, errors = _validate(data_dict, default_list_schema(), context)
+    if errors:
+        raise ValidationError(errors)
+    rel = data.get("rel")
     ref_package_by = 'id' if api == 2 else 'name'
     pkg1 = model.Package.get(id1)
     pkg2 = None
@@ -148,30 +256,98 @@ def package_relationships_list(context, data_dict):
 
     _check_access('package_relationships_list', context, data_dict)
 
-    # TODO: How to handle this object level authz?
-    # Currently we don't care
-    relationships = pkg1.get_relationships(with_package=pkg2, type=rel)
+    # Relationships with datasets the user cannot read are left out
+    relationships = relationships_of(
+        pkg1.id, pkg2.id if pkg2 else None, rel, data.get('extras'),
+        data.get('as_of'), _visible_packages(context))
 
     if rel and not relationships:
         raise NotFound('Relationship "%s %s %s" not found.'
                        % (id1, rel, id2))
 
-    relationship_dicts = [
-        rel.as_dict(pkg1, ref_package_by=ref_package_by)
-        for rel in relationships]
+    refs = _package_refs(
+        model, [pkg1.id] + [
+            row[1] if row[0] == pkg1.id else row[0] for row in relationships],
+        ref_package_by)
+    relationship_dicts = []
+    for subject, object_, type_, comment, extras in relationships:
+        if subject != pkg1.id:
+            # Seen from the object
+            subject, object_ = object_, subject
+            type_ = PackageRelationship.forward_to_reverse_type(type_)
+        relationship_dicts.append({
+            'subject': refs[subject],
+            'type': type_,
+            'object': refs[object_],
+            'comment': comment,
+            'extras': extras or {},
+        })
 
     return relationship_dicts
 
 
-def _update_package_relationship(relationship, comment, context):
+def _visible_packages(context):
+    '''Return a query of the ids of the datasets the user can read, or None
+    if they can read them all.'''
+    readable = _readable_for(context)
+    return None if readable is None else visible_packages(*readable)
+
+
+def _readable_for(context):
+    '''Return the ids of the organizations and of the datasets that give
+    the user access to private datasets, looked up once per request, or None
+    if the user can read every dataset.'''
+    user = context.get('user')
+    if context.get('ignore_auth') or authz.is_sysadmin(user):
+        return None
+    key = 'relationships_readable:{}'.format(user)
+    readable = g.get(key) if has_request_context() else None
+    if readable is None:
+        readable = _readable(context['model'], user)
+        if has_request_context():
+            setattr(g, key, readable)
+    return readable
+
+
+def _readable(model, user):
+    user_obj = model.User.get(user) if user else None
+    if user_obj is None:
+        return [], []
+    org_ids = [org['id'] for org in _get_action('organization_list_for_user')(
+        {'user': user, 'ignore_auth': True},
+        {'id': user_obj.id, 'permission': 'read'})]
+    package_ids = []
+    if tk.asbool(tk.config.get('ckan.auth.allow_dataset_collaborators')):
+        package_ids = [id_ for id_, in model.Session.query(
+            model.PackageMember.package_id
+        ).filter(model.PackageMember.user_id == user_obj.id)]
+    return org_ids, package_ids
+
+
+def _package_refs(model, ids, ref_package_by):
+    '''Map package ids to their `ref_package_by`, with a single query.'''
+    if ref_package_by != 'name':
+        return dict((id_, id_) for id_ in ids)
+    return dict(read_session().query(
+        model.Package.id, model.Package.name
+    ).filter(model.Package.id.in_(set(ids))))
+
+
+def _update_package_relationship(relationship, comment, context,
+                                 extras=None):
     model = context['model']
     api = context.get('api_version')
     ref_package_by = 'id' if api == 2 else 'name'
-    is_changed = relationship.comment != comment
+    if extras is None:
+        extras = relationship.extras
+    is_changed = (relationship.comment != comment
+                  or relationship.extras != extras)
     if is_changed:
         relationship.comment = comment
+        relationship.extras = extras
+        RelationshipChange.record(RelationshipChange.UPDATE, relationship)
         if not context.get('defer_commit'):
-            model.repo.commit_and_remove()
+            model.repo.commit()
     rel_dict = relationship.as_dict(package=relationship.subject,
                                     ref_package_by=ref_package_by)
     return rel_dict
@@ -181,7 +357,8 @@ def package_relationship_update(context, data_dict):
     '''Update a relationship between two datasets (packages).
 
     The subject, object and type parameters are required to identify the
-    relationship. Only the comment can be updated.
+    relationship. Only the comment and the extras can be updated, extras
+    being replaced as a whole when given.
 
     You must be authorized to edit both the subject and the object datasets.
 
@@ -197,35 +374,741 @@ def package_relationship_update(context, data_dict):
     :type type: string
     :param comment: a comment about the relationship (optional)
     :type comment: string
+    :param extras: attributes of the relationship, such as ``weight`` or
+        ``valid_from``, as a JSON object (optional)
+    :type extras: dictionary
 
     :returns: the updated relationship
     :rtype: dictionary
 
     '''
-    model = context['model']
     schema = context.get('schema') \
-        or schema_.default_update_relationship_schema()
+        or default_update_relationship_schema()
 
-    id1, id2, rel = _get_or_bust(data_dict, ['subject', 'object', 'type'])
+    _get_or_bust(data_dict, ['subject', 'object', 'type'])
+    data, = _validate_relationships(context, [data_dict], schema)
 
-    pkg1 = model.Package.get(id1)
-    pkg2 = model.Package.get(id2)
-    if not pkg1:
-        raise NotFound(f'Subject package {id1} was not found.')
-    if not pkg2:
-        return NotFound(f'Object package {id2} was not found.')
+    _check_access('package_relationship_update', context, data_dict)
+
+    entity = PackageRelationship.get_active(*_forward(
+        data['subject'], data['type'], data['object']))
+    if not entity:
+        raise NotFound('This relationship between the packages was not found.')
+    comment = data_dict.get('comment', u'')
+    context['relationship'] = entity
+    return _update_package_relationship(
+        entity, comment, context, data.get('extras'))
+
+
+def package_relationship_create_many(context, data_dict):
+    '''Create many relationships between datasets (packages) at once.
+
+    Every relationship is validated first, with the referenced datasets
+    checked by a single query, and all of them are written in one
+    transaction. Relationships that already exist get their comment, and
+    their extras when given, updated.
 
+    You must be authorized to edit every dataset on either side of the
+    relationships.
+
+    :param relationships: the relationships to create, each a dictionary
+        with ``subject``, ``object``, ``type`` and optionally ``comment``
+        and ``extras`` keys, as for
+        :py:func:`~ckanext.relationships.logic.action.package_relationship_create`
+    :type relationships: list of dictionaries
+
+    :returns: the created or updated relationships
+    :rtype: list of dictionaries
+
+    '''
+    model = context['model']
+    schema = context.get('schema') or default_create_relationship_schema()
+    api = context.get('api_version')
+    ref_package_by = 'id' if api == 2 else 'name'
+
+    edges = _get_or_bust(data_dict, 'relationships')
+    if not isinstance(edges, list):
+        raise ValidationError({'relationships': ['Must be a list']})
+    values = _validated_edges(context, edges, schema, data_dict)
+    relationship_dicts = _upsert_relationships(model, values, ref_package_by)
+    if not context.get('defer_commit'):
+        model.repo.commit()
+    return relationship_dicts
+
+
+def _validated_edges(context, edges, schema=None, data_dict=None):
+    '''Validate relationship dicts and check that the user may create them.
+
+    :returns: ``{(subject_id, type, object_id): (comment, extras)}`` of the
+        relationships, as taken by :py:func:`_upsert_relationships`
+    '''
+    validated = _validate_relationships(
+        context, edges, schema or default_create_relationship_schema())
+    values = {}
+    for data in validated:
+        key = _forward(data['subject'], data['type'], data['object'])
+        values[key] = (data.get('comment', u''), data.get('extras'))
+    packages = sorted(set(
+        id_ for subject, _t, object_ in values for id_ in (subject, object_)))
+    _check_access('package_relationship_create_many', context,
+                  dict(data_dict or {}, packages=packages))
+    return values
+
+
+@tk.side_effect_free
+def package_relationship_changes_since(context, data_dict):
+    '''Return relationship changes recorded after the given sequence number.
+
+    Every create, update and delete of a relationship appends one entry to
+    the change log in the same transaction as the write itself, so a
+    consumer can keep a mirror in sync by repeatedly passing the
+    ``last_seq`` of the previous page as ``since``. Writers of the log are
+    serialized, so entries are committed in sequence order and no entry
+    appears later below a ``last_seq`` already returned.
+
+    :param since: return only changes with a sequence number greater than
+        this one (optional, default: ``0``)
+    :type since: int
+    :param limit: the maximum number of changes to return (optional,
+        default: ``100``, maximum: ``1000``)
+    :type limit: int
+
+    :returns: a dictionary with the ``changes`` list, each with ``seq``,
+        ``op``, ``relationship_id``, ``subject``, ``object``, ``type`` and
+        ``timestamp`` keys, and ``last_seq``, the sequence number to pass
+        as ``since`` for the next page
+    :rtype: dictionary
+
+    '''
+    schema = context.get('schema') or default_changes_since_schema()
     data, errors = _validate(data_dict, schema, context)
     if errors:
-        model.Session.rollback()
         raise ValidationError(errors)
 
-    _check_access('package_relationship_update', context, data_dict)
+    _check_access('package_relationship_changes_since', context, data_dict)
 
-    existing_rels = pkg1.get_relationships_with(pkg2, rel)
-    if not existing_rels:
-        raise NotFound('This relationship between the packages was not found.')
-    entity = existing_rels[0]
-    comment = data_dict.get('comment', u'')
-    context['relationship'] = entity
-    return _update_package_relationship(entity, comment, context)
+    since = data.get('since', 0)
+    changes = [
+        change.as_dict()
+        for change in RelationshipChange.since(since, data['limit'])
+    ]
+
+    return {
+        'changes': changes,
+        'last_seq': changes[-1]['seq'] if changes else since,
+    }
+
+
+def _resolve_package_ids(model, refs):
+    '''Map package ids or names to package ids with a single query.
+
+    Raises NotFound for any reference that matches no package.'''
+    refs = set(refs)
+    found = resolve_package_ids(refs)
+    missing = refs - set(found)
+    if missing:
+        raise NotFound('Packages not found: {}'.format(
+            ', '.join(sorted(missing))))
+    return found
+
+
+def _forward(subject, rel_type, object_):
+    '''Return the stored (subject, type, object) form of a relationship.'''
+    if rel_type not in PackageRelationship.get_all_types():
+        raise ValidationError({'type': [
+            'Unknown relationship type: {}'.format(rel_type)]})
+    if rel_type in PackageRelationship.get_forward_types():
+        return subject, rel_type, object_
+    return object_, PackageRelationship.reverse_to_forward_type(rel_type), \
+        subject
+
+
+def package_relationship_delete_many(context, data_dict):
+    '''Delete many dataset (package) relationships in one transaction.
+
+    Either pass the ``relationships`` to delete, or any of ``subject``,
+    ``object`` and ``type`` to delete every relationship matching them. At
+    least one of ``subject`` and ``object`` is required in the latter case.
+
+    You must be authorized to edit every dataset on either side of the
+    deleted relationships.
+
+    :param relationships: the relationships to delete, each a dictionary
+        with ``subject``, ``object`` and ``type`` keys (optional)
+    :type relationships: list of dictionaries
+    :param subject: the id or name of the dataset that is the subject of the
+        relationships (optional)
+    :type subject: string
+    :param object: the id or name of the dataset that is the object of the
+        relationships (optional)
+    :type object: string
+    :param type: the type of the relationships (optional)
+    :type type: string
+
+    :returns: the number of deleted relationships, as ``{'deleted': n}``
+    :rtype: dictionary
+
+    '''
+    model = context['model']
+    rel = Relationship.__table__
+
+    edges = data_dict.get('relationships')
+    if edges is not None:
+        if not isinstance(edges, list):
+            raise ValidationError({'relationships': ['Must be a list']})
+        triples = [
+            _get_or_bust(edge, ['subject', 'object', 'type'])
+            for edge in edges
+        ]
+        ids = _resolve_package_ids(
+            model, [ref for s, t, o in triples for ref in (s, o)])
+        keys = set(
+            _forward(ids[s], t, ids[o]) for s, t, o in triples)
+        if not keys:
+            return {'deleted': 0}
+        clause = tuple_(
+            rel.c.subject_package_id, rel.c.type, rel.c.object_package_id
+        ).in_(list(keys))
+    else:
+        subject = data_dict.get('subject')
+        object_ = data_dict.get('object')
+        rel_type = data_dict.get('type')
+        if not (subject or object_):
+            raise ValidationError(
+                {'subject': ['Either subject or object is required']})
+        ids = _resolve_package_ids(model, filter(None, [subject, object_]))
+        subject, object_ = ids.get(subject), ids.get(object_)
+        if rel_type:
+            subject, rel_type, object_ = _forward(subject, rel_type, object_)
+
+        clause = and_(*[
+            column == value for column, value in [
+                (rel.c.subject_package_id, subject),
+                (rel.c.object_package_id, object_),
+                (rel.c.type, rel_type),
+            ] if value
+        ])
+
+    rows = model.Session.query(
+        rel.c.subject_package_id, rel.c.object_package_id
+    ).filter(clause, rel.c.state == model.State.ACTIVE).distinct()
+    packages = sorted({id_ for row in rows for id_ in row})
+    _check_access('package_relationship_delete_many', context,
+                  dict(data_dict, packages=packages))
+
+    deleted = delete_relationships(clause) if packages else 0
+    if not context.get('defer_commit'):
+        model.repo.commit()
+    return {'deleted': deleted}
+
+
+def _tree_type(rel_type):
+    '''Return the stored type whose subject is the child of its object in
+    the tree of `rel_type`.'''
+    if rel_type not in PackageRelationship.get_all_types():
+        raise ValidationError({'type': [
+            'Unknown relationship type: {}'.format(rel_type)]})
+    if not PackageRelationship.has_rule(rel_type, 'hierarchical'):
+        raise ValidationError({'type': [
+            'Relationships of type {} do not form a tree'.format(rel_type)]})
+    if rel_type in PackageRelationship.get_forward_types():
+        return rel_type
+    return PackageRelationship.reverse_to_forward_type(rel_type)
+
+
+def package_relationship_reparent(context, data_dict):
+    '''Change the parent of a dataset (package), with its whole subtree.
+
+    The relationships of the dataset with its current parents are deleted
+    and the relationship with the new parent is created in one transaction.
+
+    You must be authorized to edit the dataset, its current parents and the
+    new parent.
+
+    :param id: the id or name of the dataset to re-parent
+    :type id: string
+    :param parent: the id or name of the new parent
+    :type parent: string
+    :param type: the type of the relationship of a child with its parent
+        (optional, default: ``'child_of'``)
+    :type type: string
+    :param comment: a comment about the new relationship (optional)
+    :type comment: string
+    :param extras: attributes of the new relationship, as a JSON object
+        (optional)
+    :type extras: dictionary
+
+    :returns: the new relationship
+    :rtype: dictionary
+
+    '''
+    model = context['model']
+    rel = Relationship.__table__
+    api = context.get('api_version')
+    ref_package_by = 'id' if api == 2 else 'name'
+
+    ref, parent_ref = _get_or_bust(data_dict, ['id', 'parent'])
+    rel_type = _tree_type(data_dict.get('type') or u'child_of')
+    ids = _resolve_package_ids(model, [ref, parent_ref])
+    node_id, parent_id = ids[ref], ids[parent_ref]
+    data, = _validate_relationships(context, [{
+        'subject': node_id, 'object': parent_id, 'type': rel_type,
+        'comment': data_dict.get('comment', u''),
+        'extras': data_dict.get('extras', {}),
+    }], default_create_relationship_schema())
+
+    current = and_(rel.c.subject_package_id == node_id,
+                   rel.c.type == rel_type)
+    parents = [id_ for id_, in model.Session.query(
+        rel.c.object_package_id).filter(
+            current, rel.c.state == model.State.ACTIVE)]
+    _check_access('package_relationship_reparent', context, dict(
+        data_dict, packages=sorted(set([node_id, parent_id] + parents))))
+    if node_id == parent_id or is_descendant(parent_id, node_id, rel_type):
+        raise ValidationError({'parent': [
+            'The new parent is inside the subtree being moved']})
+
+    delete_relationships(current)
+    # The cycle has been ruled out above
+    new, = _upsert_relationships(model, {
+        (node_id, rel_type, parent_id): (data['comment'], data.get('extras')),
+    }, ref_package_by, check_cycles=False)
+    if not context.get('defer_commit'):
+        model.repo.commit()
+    return new
+
+
+def package_relationship_move_subtree(context, data_dict):
+    '''Move, or copy, the children of a dataset (package), with their own
+    subtrees, under another dataset in one transaction.
+
+    The relationships are changed in bulk, whatever the number of children.
+    Children already under the target are not duplicated.
+
+    You must be authorized to edit the source and the target datasets, and
+    every child moved.
+
+    :param source: the id or name of the dataset whose children are moved
+    :type source: string
+    :param target: the id or name of the dataset the children are moved
+        under
+    :type target: string
+    :param type: the type of the relationship of a child with its parent
+        (optional, default: ``'child_of'``)
+    :type type: string
+    :param copy: keep the children under the source as well (optional,
+        default: ``False``)
+    :type copy: bool
+
+    :returns: the number of children moved, as ``{'moved': n}``, or copied,
+        as ``{'copied': n}``
+    :rtype: dictionary
+
+    '''
+    model = context['model']
+
+    source_ref, target_ref = _get_or_bust(data_dict, ['source', 'target'])
+    rel_type = _tree_type(data_dict.get('type') or u'child_of')
+    copy = tk.asbool(data_dict.get('copy', False))
+    ids = _resolve_package_ids(model, [source_ref, target_ref])
+    source_id, target_id = ids[source_ref], ids[target_ref]
+
+    rel = Relationship.__table__
+    children = [id_ for id_, in model.Session.query(
+        rel.c.subject_package_id).filter(
+            rel.c.object_package_id == source_id, rel.c.type == rel_type,
+            rel.c.state == model.State.ACTIVE)]
+    _check_access('package_relationship_move_subtree', context, dict(
+        data_dict, packages=sorted(set([source_id, target_id] + children))))
+    if source_id == target_id \
+            or is_descendant(target_id, source_id, rel_type):
+        raise ValidationError({'target': [
+            'The target is inside the subtree being moved']})
+
+    if copy:
+        result = {'copied': copy_children(source_id, target_id, rel_type)}
+    else:
+        result = {'moved': move_children(source_id, target_id, rel_type)}
+    if not context.get('defer_commit'):
+        model.repo.commit()
+    return result
+
+
+@tk.side_effect_free
+def package_relationship_exists(context, data_dict):
+    '''Return whether relationships between datasets (packages) exist.
+
+    Either pass ``subject``, ``object`` and optionally ``type`` to check a
+    single relationship, or a list of ``relationships`` to check many with
+    one query. Without a type, any relationship between the two datasets
+    counts.
+
+    :param subject: the id or name of the dataset that is the subject of the
+        relationship
+    :type subject: string
+    :param object: the id or name of the dataset that is the object of the
+        relationship
+    :type object: string
+    :param type: the type of the relationship (optional)
+    :type type: string
+    :param relationships: the relationships to check, each a dictionary with
+        ``subject``, ``object`` and optionally ``type`` keys (optional)
+    :type relationships: list of dictionaries
+
+    :returns: whether the relationship exists, or a list with one boolean
+        per requested relationship
+    :rtype: bool or list of bools
+
+    '''
+    model = context['model']
+
+    edges = data_dict.get('relationships')
+    single = edges is None
+    if single:
+        edges = [data_dict]
+    if not isinstance(edges, list):
+        raise ValidationError({'relationships': ['Must be a list']})
+
+    requested = []
+    for edge in edges:
+        subject, object_ = _get_or_bust(edge, ['subject', 'object'])
+        requested.append((subject, edge.get('type'), object_))
+    ids = _resolve_package_ids(
+        model, [ref for s, t, o in requested for ref in (s, o)])
+
+    _check_access('package_relationship_exists', context,
+                  dict(data_dict, packages=sorted(set(ids.values()))))
+
+    existing = existing_relationships(
+        set((ids[s], ids[o]) for s, t, o in requested))
+    pairs = set((s, o) for s, t, o in existing)
+
+    result = []
+    for subject, rel_type, object_ in requested:
+        subject, object_ = ids[subject], ids[object_]
+        if rel_type:
+            result.append(_forward(subject, rel_type, object_) in existing)
+        else:
+            result.append(
+                (subject, object_) in pairs or (object_, subject) in pairs)
+    return result[0] if single else result
+
+
+@tk.side_effect_free
+def package_relationship_counts(context, data_dict):
+    '''Return the number of relationships of datasets (packages) per type.
+
+    Types are seen from each dataset, e.g. a dataset with two children has
+    ``{'parent_of': 2}``. Relationships with datasets the user cannot read
+    are not counted.
+
+    :param id: the id or name of the dataset (optional)
+    :type id: string
+    :param ids: the ids or names of many datasets (optional)
+    :type ids: list of strings
+    :param type: count only relationships of this type (optional)
+    :type type: string
+
+    :returns: the counts per type of each dataset, keyed by the ids or names
+        as given
+    :rtype: dictionary
+
+    '''
+    model = context['model']
+
+    refs = data_dict.get('ids')
+    if refs is None:
+        refs = [_get_or_bust(data_dict, 'id')]
+    if isinstance(refs, str):
+        refs = [refs]
+    rel_type = data_dict.get('type')
+    if rel_type and rel_type not in PackageRelationship.get_all_types():
+        raise ValidationError({'type': [
+            'Unknown relationship type: {}'.format(rel_type)]})
+
+    ids = _resolve_package_ids(model, refs)
+    _check_access('package_relationship_counts', context,
+                  dict(data_dict, packages=sorted(set(ids.values()))))
+
+    counts = relationship_counts(
+        list(set(ids.values())), _visible_packages(context))
+    result = {}
+    for ref in refs:
+        by_type = counts[ids[ref]]
+        if rel_type:
+            by_type = {rel_type: by_type.get(rel_type, 0)}
+        result[ref] = by_type
+    return result
+
+
+@tk.side_effect_free
+def package_relationships_list_many(context, data_dict):
+    '''Return the relationships of many datasets (packages) at once.
+
+    All the datasets are walked together, with one query per level, and a
+    dataset reached from several of them is looked up only once. Datasets
+    the user cannot read are not reached.
+
+    :param ids: the ids or names of the datasets, at most
+        ``ckanext.relationships.batch_limit`` (default: ``100``)
+    :type ids: list of strings
+    :param type: follow only relationships of this type, as seen from each
+        dataset, e.g. ``'parent_of'`` for children (optional)
+    :type type: string
+    :param depth: how many levels of relationships to return, at most
+        ``ckanext.relationships.traversal_max_depth`` (optional, default:
+        ``1``, maximum: ``5``)
+    :type depth: int
+    :param extras: follow only relationships whose extras contain these keys
+        and values, as a JSON object (optional)
+    :type extras: dictionary
+    :param as_of: follow the relationships as they were at this date and
+        time, in UTC (optional)
+    :type as_of: ISO 8601 string
+
+    :returns: the relationships reachable from each dataset, keyed by the
+        ids or names as given. Each relationship is a dictionary with
+        ``subject``, ``type``, ``object``, ``comment``, ``extras`` and
+        ``depth`` keys,
+        seen from the side nearer to the dataset
+    :rtype: dictionary
+
+    '''
+    model = context['model']
+    api = context.get('api_version')
+    ref_package_by = 'id' if api == 2 else 'name'
+
+    schema = context.get('schema') or default_list_many_schema()
+    data, errors = _validate(data_dict, schema, context)
+    if errors:
+        raise ValidationError(errors)
+
+    refs = data['ids']
+    batch_limit = tk.asint(
+        tk.config.get('ckanext.relationships.batch_limit', 100))
+    if len(refs) > batch_limit:
+        raise ValidationError({'ids': [
+            'At most {} datasets can be requested at once'.format(
+                batch_limit)]})
+    rel_type = data.get('type')
+    if rel_type and rel_type not in PackageRelationship.get_all_types():
+        raise ValidationError({'type': [
+            'Unknown relationship type: {}'.format(rel_type)]})
+
+    ids = _resolve_package_ids(model, refs)
+    _check_access('package_relationships_list_many', context,
+                  dict(data_dict, packages=sorted(set(ids.values()))))
+
+    depth = data['depth']
+    adjacency = traverse(
+        set(ids.values()), rel_type, depth, data.get('extras'),
+        data.get('as_of'), _visible_packages(context))
+
+    reached = set(adjacency)
+    for edges in adjacency.values():
+        reached.update(edge[0] for edge in edges)
+    refs_by_id = _package_refs(model, reached, ref_package_by)
+
+    result = {}
+    for ref in refs:
+        result[ref] = [{
+            'subject': refs_by_id.get(node, node),
+            'type': type_,
+            'object': refs_by_id.get(other, other),
+            'comment': comment,
+            'extras': extras,
+            'depth': level,
+        } for level, node, type_, other, comment, extras
+            in subtree(adjacency, ids[ref], depth)]
+    return result
+
+
+@tk.side_effect_free
+@tk.chained_action
+def package_show(next_action, context, data_dict):
+    '''Add a summary of the position of the dataset in the ``child_of``
+    tree to ``package_show`` as ``relationships_tree``, when requested with
+    ``include_tree_summary`` or, with ``ckanext.relationships.tree_summary``
+    enabled, on dataset pages.
+
+    The summary has the ``path`` from the root down to the parent of the
+    dataset, its ``child_count`` and its first ``children`` by name, at most
+    ``ckanext.relationships.tree_summary.children`` (default: ``10``). Each
+    dataset in it is a dictionary with ``id``, ``name`` and ``title`` keys.
+    Datasets the user cannot read are left out.
+
+    :param include_tree_summary: include the tree summary (optional,
+        default: ``False``)
+    :type include_tree_summary: bool
+
+    '''
+    result = next_action(context, data_dict)
+    include = data_dict.get('include_tree_summary')
+    if include is None:
+        include = context.get('for_view') and tk.asbool(tk.config.get(
+            'ckanext.relationships.tree_summary', False))
+    if tk.asbool(include) \
+            and PackageRelationship.has_rule(u'child_of', 'hierarchical'):
+        result['relationships_tree'] = _tree_summary(context, result['id'])
+    return result
+
+
+def _tree_summary(context, package_id):
+    readable = _readable_for(context)
+    limit = tk.asint(tk.config.get(
+        'ckanext.relationships.tree_summary.children', 10))
+    max_depth = tk.asint(tk.config.get(
+        'ckanext.relationships.tree_summary.max_depth', 20))
+
+    def compute(primary):
+        visible = None if readable is None else visible_packages(*readable)
+        path, child_count, children, ancestors = tree_summary(
+            package_id, limit, max_depth, visible=visible, primary=primary)
+        keys = ('id', 'name', 'title')
+        return {
+            'path': [dict(zip(keys, row)) for row in path],
+            'child_count': child_count,
+            'children': [dict(zip(keys, row)) for row in children],
+        }, ancestors
+
+    if not PackageRelationship.has_rule(u'child_of', 'cached'):
+        return compute(primary=False)[0]
+    return cached_tree_summary(package_id, visibility_key(context), compute)
+
+
+def visibility_key(context):
+    '''Return a key identifying the datasets the user can read, for cached
+    responses that leave the other datasets out.'''
+    readable = _readable_for(context)
+    if readable is None:
+        return 'all'
+    return hashlib.sha1(json.dumps(
+        [sorted(ids) for ids in readable]).encode('utf8')).hexdigest()
+
+
+NESTED_RELATIONSHIPS = {
+    # key: (side of the dataset, side given in every relationship)
+    'relationships_as_subject': ('subject', 'object'),
+    'relationships_as_object': ('object', 'subject'),
+}
+
+
+@tk.chained_action
+def package_create(next_action, context, data_dict):
+    '''Create the relationships declared in ``relationships_as_subject`` and
+    ``relationships_as_object`` together with the dataset.
+
+    See :py:func:`_with_nested_relationships`.'''
+    return _with_nested_relationships(next_action, context, data_dict)
+
+
+@tk.chained_action
+def package_update(next_action, context, data_dict):
+    '''Replace the relationships of the dataset with those declared in
+    ``relationships_as_subject`` and ``relationships_as_object``, together
+    with the dataset. A list that is not given leaves its side as it is; an
+    empty list deletes every relationship on that side.
+
+    See :py:func:`_with_nested_relationships`.'''
+    return _with_nested_relationships(next_action, context, data_dict)
+
+
+@tk.chained_action
+def package_patch(next_action, context, data_dict):
+    '''Replace only the relationship lists given in `data_dict`.
+
+    The dataset is patched with the output of ``package_show``, whose
+    ``relationships_as_subject`` and ``relationships_as_object`` are those
+    of CKAN core, always empty here, so they must not be synced.'''
+    context = dict(context, relationships_given=[
+        key for key in NESTED_RELATIONSHIPS if key in data_dict])
+    return next_action(context, data_dict)
+
+
+def _with_nested_relationships(next_action, context, data_dict):
+    '''Run the package action with its commit deferred, then sync the
+    relationships nested in `data_dict` in bulk and commit everything once.
+
+    Every relationship is a dictionary with ``type``, the other dataset as
+    ``object`` (in ``relationships_as_subject``) or ``subject`` (in
+    ``relationships_as_object``), and optionally ``comment`` and ``extras``.
+    All of them are validated with a single query and written with at most
+    two statements, whatever their number. The stored relationships of the
+    dataset on the side of a given list that are not in any list are
+    deleted. The returned dataset shows the synced lists.'''
+    given = context.get('relationships_given', NESTED_RELATIONSHIPS)
+    nested = [(key, data_dict.pop(key)) for key in NESTED_RELATIONSHIPS
+              if key in data_dict]
+    nested = [(key, relationships) for key, relationships in nested
+              if key in given]
+    if not nested:
+        return next_action(context, data_dict)
+
+    model = context['model']
+    action_context = dict(context, defer_commit=True, return_id_only=True)
+    package_id = next_action(action_context, data_dict)
+
+    edges = []
+    for key, relationships in nested:
+        if not isinstance(relationships, list) \
+                or not all(isinstance(r, dict) for r in relationships):
+            model.Session.rollback()
+            raise ValidationError({key: ['Must be a list of objects']})
+        side, other = NESTED_RELATIONSHIPS[key]
+        edges.extend(dict(
+            relationship, **{side: package_id, other: relationship.get(other)}
+        ) for relationship in relationships)
+    values = _validated_edges(dict(context), edges) if edges else {}
+    _delete_unlisted(context, package_id,
+                     [NESTED_RELATIONSHIPS[key][0] for key, _r in nested],
+                     values)
+    written = _upsert_relationships(model, values, 'id') if values else []
+
+    if context.get('return_id_only'):
+        result = package_id
+    else:
+        result = tk.get_action('package_show')(
+            dict(action_context, return_id_only=False), {'id': package_id})
+        for key, _relationships in nested:
+            side = NESTED_RELATIONSHIPS[key][0]
+            result[key] = [rel for rel in written if rel[side] == package_id]
+    if not context.get('defer_commit'):
+        model.repo.commit()
+    return result
+
+
+def _delete_unlisted(context, package_id, sides, listed):
+    '''Delete the relationships stored with the package on any of `sides`
+    whose ``(subject_id, type, object_id)`` is not in `listed`.'''
+    model = context['model']
+    rel = Relationship.__table__
+    clause = or_(*[
+        rel.c.subject_package_id == package_id if side == 'subject'
+        else rel.c.object_package_id == package_id for side in sides])
+    if listed:
+        clause = and_(clause, ~tuple_(
+            rel.c.subject_package_id, rel.c.type, rel.c.object_package_id
+        ).in_(list(listed)))
+    rows = model.Session.query(
+        rel.c.subject_package_id, rel.c.object_package_id
+    ).filter(clause, rel.c.state == model.State.ACTIVE).distinct()
+    packages = sorted({id_ for row in rows for id_ in row})
+    if packages:
+        _check_access('package_relationship_delete_many', context,
+                      {'packages': packages})
+        delete_relationships(clause)
+
+
+@tk.chained_action
+def dataset_purge(next_action, context, data_dict):
+    '''Remove the relationships of a dataset before purging it.
+
+    The relationships reference the dataset, so they are removed in bulk,
+    in the same transaction as the dataset itself.'''
+    model = context['model']
+    _check_access('dataset_purge', context, data_dict)
+
+    pkg = model.Package.get(_get_or_bust(data_dict, 'id'))
+    if pkg is not None:
+        delete_relationships(involving([pkg.id]), purge=True)
+    return next_action(context, data_dict)
@@ -1,4 +1,6 @@
 import ckan.authz as authz
+import ckan.plugins.toolkit as tk
+from ckan.common import _
 
 
 def package_relationship_create(context, data_dict):
@@ -38,11 +40,12 @@ def package_relationship_delete(context, data_dict):
         return {'success': True}
 
 
+@tk.auth_allow_anonymous_access
 def package_relationships_list(context, data_dict):
     user = context.get('user')
 
-    id1 = data_dict.get('subject')
-    id2 = data_dict.get('object')
+    id1 = data_dict.get('id') or data_dict.get('subject')
+    id2 = data_dict.get('id2') or data_dict.get('object')
 
     # If we can see each package we can see the relationships
     authorized1 = authz.is_authorized_boolean(
@@ -64,3 +67,68 @@ def package_relationships_list(context, data_dict):
 
 def package_relationship_update(context, data_dict):
     return authz.is_authorized('package_relationship_create', context, data_dict)
+
+
+def package_relationship_create_many(context, data_dict):
+    return authz.is_authorized(
+        'package_relationship_delete_many', context, data_dict)
+
+
+def package_relationship_delete_many(context, data_dict):
+    user = context.get('user')
+
+    # The action passes every package on either side of the relationships
+    for id_ in data_dict.get('packages', []):
+        authorized = authz.is_authorized_boolean(
+            'package_update', context, {'id': id_})
+        if not authorized:
+            return {
+                'success': False,
+                'msg': _(f'User {user} not authorized to edit package {id_}')
+            }
+    return {'success': True}
+
+
+def package_relationship_reparent(context, data_dict):
+    return authz.is_authorized(
+        'package_relationship_delete_many', context, data_dict)
+
+
+def package_relationship_move_subtree(context, data_dict):
+    return authz.is_authorized(
+        'package_relationship_delete_many', context, data_dict)
+
+
+@tk.auth_allow_anonymous_access
+def package_relationship_exists(context, data_dict):
+    user = context.get('user')
+
+    # If we can see each package we can see the relationships
+    for id_ in data_dict.get('packages', []):
+        authorized = authz.is_authorized_boolean(
+            'package_show', context, {'id': id_})
+        if not authorized:
+            return {
+                'success': False,
+                'msg': _(f'User {user} not authorized to read package {id_}')
+            }
+    return {'success': True}
+
+
+@tk.auth_allow_anonymous_access
+def package_relationship_counts(context, data_dict):
+    return authz.is_authorized('package_relationship_exists', context, data_dict)
+
+
+@tk.auth_allow_anonymous_access
+def package_relationships_list_many(context, data_dict):
+    return authz.is_authorized('package_relationship_exists', context, data_dict)
+
+
+def package_relationship_changes_since(context, data_dict):
+    # The change log spans every package, including private ones, so only
+    # sysadmins may read it
+    return {
+        'success': False,
+        'msg': _('Only sysadmins can read the relationship change log')
+    }
@@ -1,6 +1,8 @@
 import ckan.plugins as p
 from ckan.logic.schema import validator_args
 
+from ..model import PackageRelationship
+
 get_validator = p.toolkit.get_validator
 
 not_empty = get_validator('not_empty')
@@ -12,39 +14,86 @@ default = get_validator('default')
 
 @validator_args
 def default_relationship_schema(
-        ignore_missing, unicode_safe, not_empty, one_of, ignore):
+        ignore_missing, unicode_safe, not_empty, one_of, ignore,
+        relationship_extras):
     return {
         'id': [ignore_missing, unicode_safe],
         'subject': [ignore_missing, unicode_safe],
         'object': [ignore_missing, unicode_safe],
         'type': [not_empty,
-                 one_of(ckan.model.PackageRelationship.get_all_types())],
+                 one_of(PackageRelationship.get_all_types())],
         'comment': [ignore_missing, unicode_safe],
+        'extras': [ignore_missing, relationship_extras],
         'state': [ignore],
     }
 
 
 @validator_args
 def default_create_relationship_schema(
-        empty, not_empty, unicode_safe, package_id_or_name_exists):
+        empty, not_empty, unicode_safe, relationship_package_exists):
     schema = default_relationship_schema()
     schema['id'] = [empty]
-    schema['subject'] = [not_empty, unicode_safe, package_id_or_name_exists]
-    schema['object'] = [not_empty, unicode_safe, package_id_or_name_exists]
+    schema['subject'] = [not_empty, unicode_safe, relationship_package_exists]
+    schema['object'] = [not_empty, unicode_safe, relationship_package_exists]
 
     return schema
 
 
 @validator_args
 def default_update_relationship_schema(
-        ignore_missing, package_id_not_changed):
+        ignore_missing, package_id_not_changed, relationship_package_exists):
     schema = default_relationship_schema()
     schema['id'] = [ignore_missing, package_id_not_changed]
 
     # Todo: would like to check subject, object & type haven't changed, but
     # no way to do this in schema
-    schema['subject'] = [ignore_missing]
-    schema['object'] = [ignore_missing]
+    schema['subject'] = [ignore_missing, relationship_package_exists]
+    schema['object'] = [ignore_missing, relationship_package_exists]
     schema['type'] = [ignore_missing]
 
     return schema
+
+
+@validator_args
+def default_changes_since_schema(
+        ignore_missing, default, natural_number_validator,
+        limit_to_configured_maximum):
+    return {
+        'since': [ignore_missing, natural_number_validator],
+        'limit': [
+            default(100), natural_number_validator,
+            limit_to_configured_maximum(
+                'ckanext.relationships.changes_limit', 1000)],
+    }
+
+
+@validator_args
+def default_list_schema(
+        not_empty, ignore_missing, unicode_safe, one_of, relationship_extras,
+        isodate):
+    return {
+        'id': [not_empty, unicode_safe],
+        'id2': [ignore_missing, unicode_safe],
+        'rel': [ignore_missing, unicode_safe,
+                one_of(PackageRelationship.get_all_types() +
+                       ['relationships'])],
+        'extras': [ignore_missing, relationship_extras],
+        'as_of': [ignore_missing, isodate],
+    }
+
+
+@validator_args
+def default_list_many_schema(
+        not_empty, ignore_missing, default, list_of_strings,
+        natural_number_validator, limit_to_configured_maximum, unicode_safe,
+        relationship_extras, isodate):
+    return {
+        'ids': [not_empty, list_of_strings],
+        'type': [ignore_missing, unicode_safe],
+        'extras': [ignore_missing, relationship_extras],
+        'as_of': [ignore_missing, isodate],
+        'depth': [
+            default(1), natural_number_validator,
+            limit_to_configured_maximum(
+                'ckanext.relationships.traversal_max_depth', 5)],
+    }
@@ -0,0 +1,37 @@
+import json
+
+from ckan.common import _
+from ckan.lib.navl.dictization_functions import Invalid
+
+from ..model import resolve_package_ids
+
+
+def relationship_package_exists(value, context):
+    '''Ensure the dataset exists and convert its name to its id.
+
+    Actions validating many relationships resolve every dataset they
+    reference with one query beforehand, and pass the result as
+    ``context['relationship_package_ids']``.'''
+    package_ids = context.get('relationship_package_ids')
+    if package_ids is None or value not in package_ids:
+        package_ids = resolve_package_ids([value])
+    if value not in package_ids:
+        raise Invalid('%s: %s' % (_('Not found'), _('Dataset')))
+    return package_ids[value]
+
+
+def relationship_extras(value):
+    '''Ensure the value is a JSON object, given either as a dictionary or as
+    its JSON serialization.'''
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise Invalid(_('Could not parse as valid JSON'))
+    if not isinstance(value, dict):
+        raise Invalid(_('Must be a JSON object'))
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        raise Invalid(_('Could not parse as valid JSON'))
+    return value
@@ -1,13 +1,22 @@
 # encoding: utf-8
+import datetime
+import json
 import logging
+import threading
 
-from sqlalchemy import orm, types, Column, Table, ForeignKey
+from sqlalchemy import (
+    create_engine, inspect, orm, types, Column, Index, Table, ForeignKey, and_, case,
+    distinct, event, exists, func, literal, literal_column, or_, select, text,
+    tuple_, union_all)
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation
 
 import ckan.plugins as p
 
 from ckan.common import _
+from ckan.exceptions import CkanConfigurationException
 from ckan.model import meta
 from ckan.model import core
 from ckan.model import package as _package
@@ -19,14 +28,126 @@ from .interfaces import IRelationships
 
 Base = declarative_base(metadata=metadata)
 
-__all__ = ['PackageRelationship', 'Relationship', ]
+__all__ = ['PackageRelationship', 'Relationship', 'RelationshipChange',
+           'RelationshipCount', ]
 
 
 log = logging.getLogger(__name__)
 
+CONFIG_READ_URL = 'ckanext.relationships.read_url'
+
+# Set in the info of the primary session once it has written relationships
+_WRITTEN = 'ckanext.relationships.written'
+# Ids of the packages whose relationships the primary session has created or
+# deleted, or whose tree summaries it has otherwise invalidated, until
+# committed or rolled back
+CHANGED = 'ckanext.relationships.changed'
+# Ids of the packages whose counters the primary session has changed, until
+# committed or rolled back
+RECOUNTED = 'ckanext.relationships.recounted'
+# Set in the info of the primary session once it holds CHANGE_LOG_LOCK, until
+# committed or rolled back
+_LOCKED = 'ckanext.relationships.locked'
+
+# Key of the transaction-level advisory lock held by the writers of the
+# change log
+CHANGE_LOG_LOCK = 0x72656c6174696f6e
+
+_read_sessions = {}
+_read_sessions_lock = threading.Lock()
+
+
+def _read_session_for(url):
+    session = _read_sessions.get(url)
+    if session is None:
+        with _read_sessions_lock:
+            session = _read_sessions.get(url)
+            if session is None:
+                session = _read_sessions[url] = orm.scoped_session(
+                    orm.sessionmaker(bind=create_engine(
+                        url, pool_pre_ping=True)))
+    return session
+
+
+def read_session():
+    '''Return the session to read relationships with.
+
+    That is a session on the database configured by
+    ``ckanext.relationships.read_url``, typically a read replica, unless the
+    primary session has already written relationships, whose reads then stay
+    on the primary so they see the writes. Without a read url it is always
+    the primary session.'''
+    url = p.toolkit.config.get(CONFIG_READ_URL)
+    if not url or meta.Session.info.get(_WRITTEN):
+        return meta.Session
+    return _read_session_for(url)
+
+
+def remove_read_sessions():
+    '''Close the read sessions of the current thread, as done for
+    ``meta.Session`` at the end of every request.
+
+    Code reading relationships outside of requests, such as CLI commands
+    and threads of its own, calls it when done so that the connections to
+    the read database do not stay idle in a transaction.'''
+    for session in _read_sessions.values():
+        session.remove()
+
+
+def _written():
+    meta.Session.info[_WRITTEN] = True
+
+
+def _lock_change_log():
+    '''Wait until no other transaction can record relationship changes, and
+    keep it so until the current one ends.
+
+    ``seq`` is drawn when a change is inserted rather than when it is
+    committed, so without the lock a writer could commit a lower ``seq``
+    after a consumer of the log has paged past it. With the lock, changes
+    are committed in ``seq`` order.'''
+    if not meta.Session.info.get(_LOCKED):
+        meta.Session.execute(
+            select([func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)]))
+        meta.Session.info[_LOCKED] = True
+
+
+def _unlock(session):
+    session.info.pop(_LOCKED, None)
+
+
+event.listen(meta.Session, 'after_commit', _unlock)
+event.listen(meta.Session, 'after_rollback', _unlock)
+
+
+def _recounted(package_ids):
+    package_ids = set(package_ids)
+    meta.Session.info.setdefault(RECOUNTED, set()).update(package_ids)
+    meta.Session.info.setdefault(CHANGED, set()).update(package_ids)
+
+
+# An edge is active at most once, which the upserts rely on
+ACTIVE_EDGE_INDEX = 'idx_package_relationship_active_edge'
+ACTIVE_EDGE_COLUMNS = ('subject_package_id', 'type', 'object_package_id')
+ACTIVE_EDGE = "state = 'active'"
+
 
 class Relationship(Base):
     __tablename__ = 'package_relationship_dev'
+    # Cover the lookups by either side, so existence checks and counts per
+    # type can be answered from the indexes alone
+    __table_args__ = (
+        Index('idx_package_relationship_subject',
+              'subject_package_id', 'state', 'type'),
+        Index('idx_package_relationship_object',
+              'object_package_id', 'state', 'type'),
+        # Serves the containment (@>) filters on extras
+        Index('idx_package_relationship_extras', 'extras',
+              postgresql_using='gin',
+              postgresql_ops={'extras': 'jsonb_path_ops'}),
+        Index(ACTIVE_EDGE_INDEX, *ACTIVE_EDGE_COLUMNS, unique=True,
+              postgresql_where=text(ACTIVE_EDGE)),
+    )
 
     _id = Column('id', types.UnicodeText, primary_key=True,
                  default=_types.make_uuid)
@@ -35,6 +156,179 @@ class Relationship(Base):
     _type = Column('type', types.UnicodeText)
     comment = Column(types.UnicodeText)
     state = Column(types.UnicodeText, default=core.State.ACTIVE)
+    # Typed attributes of the relationship, e.g. weight or provenance
+    extras = Column(JSONB, nullable=False, default=dict,
+                    server_default='{}')
+
+
+class RelationshipChange(Base):
+    '''Append-only log of relationship writes.
+
+    Rows are added to the session of the action that changes the
+    relationship, so they are committed (or rolled back) together with it.
+    Consumers page through the log by ``seq`` to sync incrementally.
+
+    Every row holds the state of the relationship after the change, so the
+    log is also the history of the relationships: the latest change of a
+    relationship up to a date is its state at that date.'''
+    __tablename__ = 'package_relationship_change'
+    # Range queries on the history of the relationships of a package
+    __table_args__ = (
+        Index('idx_package_relationship_change_subject',
+              'subject_package_id', 'timestamp'),
+        Index('idx_package_relationship_change_object',
+              'object_package_id', 'timestamp'),
+    )
+
+    CREATE = u'create'
+    UPDATE = u'update'
+    DELETE = u'delete'
+
+    seq = Column(types.Integer, primary_key=True, autoincrement=True)
+    op = Column(types.UnicodeText, nullable=False)
+    relationship_id = Column(types.UnicodeText)
+    subject_package_id = Column(types.UnicodeText)
+    object_package_id = Column(types.UnicodeText)
+    type = Column(types.UnicodeText)
+    comment = Column(types.UnicodeText)
+    extras = Column(JSONB)
+    timestamp = Column(types.DateTime, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def record(cls, op, relationship):
+        change = cls(
+            op=op,
+            relationship_id=relationship.id,
+            subject_package_id=relationship.subject_package_id,
+            object_package_id=relationship.object_package_id,
+            type=relationship.type,
+            comment=relationship.comment,
+            extras=relationship.extras,
+            timestamp=datetime.datetime.utcnow(),
+        )
+        _lock_change_log()
+        _written()
+        meta.Session.add(change)
+        if op in _COUNT_SIGNS:
+            _adjust_counts(_count_deltas([(
+                relationship.subject_package_id, relationship.type,
+                relationship.object_package_id,
+            )], _COUNT_SIGNS[op]))
+        return change
+
+    @classmethod
+    def record_many(cls, op, whereclause):
+        '''Record a change for every relationship matching `whereclause`,
+        with a single ``INSERT ... SELECT``, and update the counters with
+        another.'''
+        _lock_change_log()
+        _written()
+        meta.Session.execute(cls._insert_from(op, whereclause))
+        if op in _COUNT_SIGNS:
+            _recounted(id_ for id_, in meta.Session.execute(_add_counts(
+                _counts_from(whereclause, _COUNT_SIGNS[op]))))
+
+    @classmethod
+    def _insert_from(cls, op, whereclause):
+        rel = Relationship.__table__
+        columns = ['op', 'relationship_id', 'subject_package_id',
+                   'object_package_id', 'type', 'comment', 'extras',
+                   'timestamp']
+        rows = select([
+            literal(op), rel.c.id, rel.c.subject_package_id,
+            rel.c.object_package_id, rel.c.type, rel.c.comment, rel.c.extras,
+            literal(datetime.datetime.utcnow()),
+        ]).where(whereclause)
+        return cls.__table__.insert().from_select(columns, rows)
+
+    @classmethod
+    def since(cls, seq, limit):
+        return read_session().query(cls).filter(
+            cls.seq > seq).order_by(cls.seq).limit(limit)
+
+    @classmethod
+    def latest_for(cls, package_ids):
+        '''Return the ``(seq, timestamp)`` of the latest change touching any
+        of the given packages.
+
+        ``seq`` is global and only grows, so it serves as a version counter
+        of the relationships of each package.'''
+        return read_session().query(
+            func.max(cls.seq), func.max(cls.timestamp)
+        ).filter(or_(
+            cls.subject_package_id.in_(package_ids),
+            cls.object_package_id.in_(package_ids),
+        )).one()
+
+    def as_dict(self):
+        return {
+            'seq': self.seq,
+            'op': self.op,
+            'relationship_id': self.relationship_id,
+            'subject': self.subject_package_id,
+            'object': self.object_package_id,
+            'type': self.type,
+            'comment': self.comment,
+            'extras': self.extras,
+            'timestamp': self.timestamp.isoformat(),
+        }
+
+
+_COUNT_SIGNS = {
+    RelationshipChange.CREATE: 1,
+    RelationshipChange.DELETE: -1,
+}
+
+
+class RelationshipCount(Base):
+    '''Number of active relationships of a package per type, as seen from
+    the package, e.g. ``parent_of`` for the children of a package.
+
+    The counters are updated with every creation and deletion recorded in the
+    change log, in the same transaction, and can be rebuilt with
+    :py:func:`recount`.'''
+    __tablename__ = 'package_relationship_count'
+    # Filters on the counts of a type
+    __table_args__ = (
+        Index('idx_package_relationship_count_type', 'type', 'count'),
+    )
+
+    package_id = Column(types.UnicodeText, primary_key=True)
+    type = Column(types.UnicodeText, primary_key=True)
+    count = Column(types.Integer, nullable=False, default=0)
+
+
+DEFAULT_TYPES = [
+    (u'child_of', u'parent_of'),
+    (u'sibling_of', u'sibling_of')
+]
+
+DEFAULT_TYPES_PRINTABLE = [
+    (u'is a child of {}', u'is a parent of {}'),
+    (u'is a sibling of {}', u'is a sibling of {}')
+]
+
+# Semantics of a relationship type, which decide the queries run for it:
+# transitive
+#     relationships are followed beyond the first level in traversals
+# hierarchical
+#     the subject is a child of the object, so the type forms trees that can
+#     be summarised and re-arranged; implies acyclic
+# symmetric
+#     the type is its own reverse
+# acyclic
+#     relationships closing a cycle are rejected
+# indexed
+#     the type is exposed as search filters and indexed fields
+# cached
+#     results derived from the type may be cached
+TYPE_RULES = ('transitive', 'hierarchical', 'symmetric', 'acyclic',
+              'indexed', 'cached')
+
+DEFAULT_TYPE_RULES = {
+    u'child_of': {'transitive': True, 'hierarchical': True},
+    u'sibling_of': {'transitive': False},
+}
 
 
 class PackageRelationship(core.StatefulObjectMixin,
@@ -53,12 +347,8 @@ class PackageRelationship(core.StatefulObjectMixin,
     #          (u'links_to', u'linked_from'),
     #          (u'child_of', u'parent_of'),
     #          ]
-    types = [
-        (u'child_of', u'parent_of'),
-        (u'sibling_of', u'sibling_of')
-    ]
-    for plugin in p.PluginImplementations(IRelationships):
-        types = plugin.get_rel_types()
+    # Replaced at startup by load_types()
+    types = DEFAULT_TYPES
 
     # types_printable = \
     #         [(_(u'depends on %s'), _(u'is a dependency of %s')),
@@ -66,17 +356,15 @@ class PackageRelationship(core.StatefulObjectMixin,
     #          (_(u'links to %s'), _(u'is linked from %s')),
     #          (_(u'is a child of %s'), _(u'is a parent of %s')),
     #          ]
-    types_printable = [
-        (u'is a child of {}', u'is a parent of {}'),
-        (u'is a sibling of {}', u'is a sibling of {}')
-    ]
-
-    for plugin in p.PluginImplementations(IRelationships):
-        types = plugin.get_printable_rel_types()
+    types_printable = DEFAULT_TYPES_PRINTABLE
 
     # inferred_types_printable = \
     #         {'sibling':_('has sibling %s')}
 
+    # {forward_type: {rule: bool}}, see TYPE_RULES
+    # Set below, and replaced at startup by load_types()
+    rules = {}
+
     def __str__(self):
         state = "*" if self.active != core.State.ACTIVE else ""
         return f'<{state}PackageRelationship {self.subject.name} \
@@ -91,9 +379,12 @@ class PackageRelationship(core.StatefulObjectMixin,
         e.g. {'subject':u'annakarenina',
               'type':u'depends_on',
               'object':u'warandpeace',
-              'comment':u'Since 1843'}"""
+              'comment':u'Since 1843',
+              'extras': {'weight': 0.5}}"""
 
         relationship_type = self.type
+        subject_pkg = self.subject
+        object_pkg = self.object
         if package and package == object_pkg:
             subject_pkg = self.object
             object_pkg = self.subject
@@ -104,7 +395,8 @@ class PackageRelationship(core.StatefulObjectMixin,
             'subject': subject_ref,
             'type': relationship_type,
             'object': object_ref,
-            'comment': self.comment
+            'comment': self.comment,
+            'extras': self.extras or {},
         }
 
     def as_tuple(self, package):
@@ -126,15 +418,55 @@ class PackageRelationship(core.StatefulObjectMixin,
         return (type_str, other_package)
 
     @classmethod
-    def by_subject(cls, package):
+    def get_active(cls, subject_id, type_, object_id):
         return meta.Session.query(cls).filter(
+            cls.subject_package_id == subject_id,
+            cls.type == type_,
+            cls.object_package_id == object_id,
+            cls.state == core.State.ACTIVE,
+        ).first()
+
+    @classmethod
+    def get_active_many(cls, keys):
+        '''Return the active relationships matching any of the given
+        ``(subject_id, type, object_id)`` with a single query.'''
+        keys = list(keys)
+        if not keys:
+            return []
+        return meta.Session.query(cls).filter(
+            tuple_(cls.subject_package_id, cls.type,
+                   cls.object_package_id).in_(keys),
+            cls.state == core.State.ACTIVE,
+        ).all()
+
+    @classmethod
+    def by_subject(cls, package):
+        return read_session().query(cls).filter(
             cls.subject_package_id == package.id)
 
     @classmethod
     def by_object(cls, package):
-        return meta.Session.query(cls).filter(
+        return read_session().query(cls).filter(
             cls.object_package_id == package.id)
 
+    @classmethod
+    def set_types(cls, types, types_printable, rules=None):
+        cls.types = types
+        cls.types_printable = types_printable
+        cls.rules = _type_rules(types, rules or {})
+        # Drop the lists derived from the previous types
+        for attr in ('fwd_types', 'rev_types', 'all_types'):
+            if attr in cls.__dict__:
+                delattr(cls, attr)
+
+    @classmethod
+    def has_rule(cls, type_, rule):
+        '''Return whether a forward or reverse type follows one of the
+        :py:data:`TYPE_RULES`.'''
+        forward = type_ if type_ in cls.get_forward_types() \
+            else cls.reverse_to_forward_type(type_)
+        return bool(cls.rules.get(forward, {}).get(rule))
+
     @classmethod
     def get_forward_types(cls):
         if not hasattr(cls, 'fwd_types'):
@@ -200,12 +532,1018 @@ meta.mapper(PackageRelationship, Relationship.__table__, properties={
 })
 
 
+def _printable(type_):
+    return u'{} {{}}'.format(type_.replace(u'_', u' '))
+
+
+def _types_from_config(config):
+    types, types_printable, rules = [], [], {}
+
+    for pair in config.get('ckanext.relationships.types', u'').split():
+        fwd, _sep, rev = pair.partition(u':')
+        types.append((fwd, rev or fwd))
+        types_printable.append((_printable(fwd), _printable(rev or fwd)))
+
+    path = config.get('ckanext.relationships.types_file')
+    if path:
+        try:
+            with open(path) as f:
+                declared = json.load(f)
+        except (IOError, ValueError) as e:
+            raise CkanConfigurationException(
+                'Cannot read relationship types from {}: {}'.format(path, e))
+        for item in declared:
+            fwd = item.get('type')
+            rev = item.get('reverse') or fwd
+            types.append((fwd, rev))
+            types_printable.append((
+                item.get('printable') or _printable(fwd or u''),
+                item.get('reverse_printable') or _printable(rev or u''),
+            ))
+            declared_rules = dict(
+                (rule, item[rule]) for rule in TYPE_RULES if rule in item)
+            if declared_rules:
+                rules[fwd] = declared_rules
+    return types, types_printable, rules
+
+
+def _type_rules(types, declared):
+    '''Resolve the rules of every type pair from the `declared` ones, by
+    forward or reverse type, falling back on :py:data:`DEFAULT_TYPE_RULES`.
+
+    Types without declared rules are transitive unless symmetric, indexed
+    and cached.'''
+    rules = {}
+    for fwd, rev in types:
+        symmetric = fwd == rev
+        rule = {
+            'transitive': not symmetric, 'hierarchical': False,
+            'symmetric': symmetric, 'acyclic': False, 'indexed': True,
+            'cached': True,
+        }
+        rule.update(DEFAULT_TYPE_RULES.get(fwd, {}))
+        for type_ in (rev, fwd):
+            rule.update(declared.get(type_) or {})
+        unknown = set(rule) - set(TYPE_RULES)
+        if unknown:
+            raise CkanConfigurationException(
+                'Unknown rules of relationship type {}: {}'.format(
+                    fwd, ', '.join(sorted(unknown))))
+        if bool(rule['symmetric']) != symmetric:
+            raise CkanConfigurationException(
+                'Relationship type {} is symmetric only if it is its own '
+                'reverse'.format(fwd))
+        if rule['hierarchical']:
+            if symmetric:
+                raise CkanConfigurationException(
+                    'Symmetric relationship type {} cannot be '
+                    'hierarchical'.format(fwd))
+            rule['acyclic'] = True
+        rules[fwd] = dict((name, bool(value)) for name, value in rule.items())
+    return rules
+
+
+# Replaced at startup by load_types()
+PackageRelationship.rules = _type_rules(DEFAULT_TYPES, {})
+
+
+def _validate_types(types, types_printable):
+    if len(types) != len(types_printable):
+        raise CkanConfigurationException(
+            'Every relationship type pair needs a printable pair')
+    reverse_of = {}
+    for (fwd, rev), printable in zip(types, types_printable):
+        if not fwd or not rev:
+            raise CkanConfigurationException(
+                'Invalid relationship type pair: {!r}'.format((fwd, rev)))
+        for type_, other in ((fwd, rev), (rev, fwd)):
+            if reverse_of.setdefault(type_, other) != other:
+                raise CkanConfigurationException(
+                    'Relationship type {} is declared twice'.format(type_))
+        if len(printable) != 2 or not all(u'{}' in p for p in printable):
+            raise CkanConfigurationException(
+                'Printable relationship types must contain "{{}}": '
+                '{!r}'.format(printable))
+
+
+def load_types(config):
+    '''Resolve the relationship types once, at startup.
+
+    The types come from ``ckanext.relationships.types`` (space separated
+    ``type:reverse_type`` pairs) or ``ckanext.relationships.types_file``
+    (a JSON list of objects with ``type``, ``reverse``, ``printable`` and
+    ``reverse_printable`` keys, and optionally any of the
+    :py:data:`TYPE_RULES` as booleans), or are the default ones if neither is
+    set. Types and rules provided by IRelationships plugins are added to
+    them, the rules of the config taking precedence.'''
+    types, types_printable, config_rules = _types_from_config(config)
+    if not types:
+        types = list(DEFAULT_TYPES)
+        types_printable = list(DEFAULT_TYPES_PRINTABLE)
+
+    rules = {}
+    for plugin in p.PluginImplementations(IRelationships):
+        plugin_types = plugin.get_rel_types() or []
+        plugin_printable = plugin.get_printable_rel_types() or []
+        if len(plugin_types) != len(plugin_printable):
+            raise CkanConfigurationException(
+                '{} must provide a printable pair for every relationship '
+                'type pair'.format(plugin.name))
+        for pair, printable in zip(plugin_types, plugin_printable):
+            if tuple(pair) not in types:
+                types.append(tuple(pair))
+                types_printable.append(tuple(printable))
+        # Plugins written before the rules, without inherit=True, do not
+        # have the method
+        plugin_rules = getattr(plugin, 'get_rel_type_rules', dict)()
+        for type_, rule in (plugin_rules or {}).items():
+            rules.setdefault(type_, {}).update(rule)
+    for type_, rule in config_rules.items():
+        rules.setdefault(type_, {}).update(rule)
+
+    _validate_types(types, types_printable)
+    PackageRelationship.set_types(types, types_printable, rules)
+    log.debug('Relationship types: %s, rules: %s', types,
+              PackageRelationship.rules)
+
+
+def resolve_package_ids(refs):
+    '''Map package ids or names to package ids with a single query.
+
+    References that match no package are left out.'''
+    refs = set(refs)
+    found = {}
+    if not refs:
+        return found
+    Package = _package.Package
+    for id_, name in meta.Session.query(Package.id, Package.name).filter(
+            or_(Package.id.in_(refs), Package.name.in_(refs))):
+        found[id_] = id_
+        found[name] = id_
+    return found
+
+
+def involving(package_ids):
+    '''Clause matching the relationships with any of the given packages on
+    either side.'''
+    rel = Relationship.__table__
+    return or_(rel.c.subject_package_id.in_(package_ids),
+               rel.c.object_package_id.in_(package_ids))
+
+
+def existing_relationships(pairs):
+    '''Return the set of active ``(subject_id, type, object_id)`` stored
+    between any of the given ``(package_id, package_id)`` pairs, in either
+    direction, with a single query.'''
+    rel = Relationship.__table__
+    pairs = list(pairs)
+    if not pairs:
+        return set()
+    sides = tuple_(rel.c.subject_package_id, rel.c.object_package_id)
+    query = read_session().query(
+        rel.c.subject_package_id, rel.c.type, rel.c.object_package_id
+    ).filter(
+        rel.c.state == core.State.ACTIVE,
+        or_(sides.in_(pairs), sides.in_([(b, a) for a, b in pairs])),
+    )
+    return set(query)
+
+
+def relationship_counts(package_ids, visible=None):
+    '''Return the number of active relationships of each package per type,
+    seen from that package, as ``{package_id: {type: count}}``.
+
+    The counts are read from the counters, by primary key. With `visible`, a
+    query of package ids as returned by :py:func:`visible_packages`, only the
+    relationships with one of these packages on the other side are counted,
+    from the relationships themselves.'''
+    result = dict((id_, {}) for id_ in package_ids)
+    if visible is None:
+        counts = RelationshipCount.__table__
+        rows = select([
+            counts.c.package_id, counts.c.type, counts.c.count,
+        ]).where(and_(
+            counts.c.package_id.in_(package_ids), counts.c.count > 0))
+    else:
+        rows = _visible_counts(package_ids, visible)
+    for package_id, type_, count in read_session().execute(rows):
+        result[package_id][type_] = count
+    return result
+
+
+def _visible_counts(package_ids, visible):
+    rel = Relationship.__table__
+    active = rel.c.state == core.State.ACTIVE
+    reverse = case([
+        (rel.c.type == fwd, literal(rev))
+        for fwd, rev in PackageRelationship.types
+    ], else_=rel.c.type)
+    sides = union_all(
+        select([rel.c.subject_package_id.label('package_id'),
+                rel.c.type.label('type')]).where(and_(
+                    active, rel.c.subject_package_id.in_(package_ids),
+                    rel.c.object_package_id.in_(visible))),
+        select([rel.c.object_package_id, reverse]).where(and_(
+            active, rel.c.object_package_id.in_(package_ids),
+            rel.c.subject_package_id.in_(visible))),
+    ).alias('sides')
+    return select([sides.c.package_id, sides.c.type, func.count()]) \
+        .group_by(sides.c.package_id, sides.c.type)
+
+
+def _count_deltas(edges, sign):
+    '''Return the changes of the counters for `edges`, stored ``(subject_id,
+    type, object_id)``, being created (`sign` 1) or deleted (-1).'''
+    deltas = {}
+    for subject, type_, object_ in edges:
+        reverse = PackageRelationship.forward_to_reverse_type(type_) or type_
+        for key in ((subject, type_), (object_, reverse)):
+            deltas[key] = deltas.get(key, 0) + sign
+    return deltas
+
+
+def _counts_from(whereclause, sign):
+    '''Select the changes of the counters for the relationships matching
+    `whereclause` being created (`sign` 1) or deleted (-1).'''
+    rel = Relationship.__table__
+    reverse = case([
+        (rel.c.type == fwd, literal(rev))
+        for fwd, rev in PackageRelationship.types
+    ], else_=rel.c.type)
+    sides = union_all(
+        select([rel.c.subject_package_id.label('package_id'),
+                rel.c.type.label('type')]).where(whereclause),
+        select([rel.c.object_package_id, reverse]).where(whereclause),
+    ).alias('sides')
+    return select([
+        sides.c.package_id, sides.c.type, func.count() * sign,
+    ]).group_by(sides.c.package_id, sides.c.type).order_by(
+        sides.c.package_id, sides.c.type)
+
+
+def _add_counts(rows):
+    '''Add the ``(package_id, type, delta)`` selected by `rows` to the
+    counters, creating the missing ones.'''
+    counts = RelationshipCount.__table__
+    statement = pg_insert(counts).from_select(
+        ['package_id', 'type', 'count'], rows)
+    return statement.on_conflict_do_update(
+        index_elements=['package_id', 'type'],
+        set_={'count': counts.c.count + statement.excluded.count},
+    ).returning(counts.c.package_id)
+
+
+def _adjust_counts(deltas):
+    counts = RelationshipCount.__table__
+    deltas = [(key, delta) for key, delta in sorted(deltas.items()) if delta]
+    if not deltas:
+        return
+    _recounted(package_id for (package_id, _t), _d in deltas)
+    # The counters are locked in key order, as by concurrent writers
+    statement = pg_insert(counts).values([
+        {'package_id': package_id, 'type': type_, 'count': delta}
+        for (package_id, type_), delta in deltas])
+    meta.Session.execute(statement.on_conflict_do_update(
+        index_elements=['package_id', 'type'],
+        set_={'count': counts.c.count + statement.excluded.count}))
+
+
+def recount(connection=None):
+    '''Rebuild the counters from the active relationships, on `connection`
+    or in the current session, which the caller commits.
+
+    The counters are locked meanwhile, so concurrent writes wait for the
+    rebuild.
+
+    :returns: the number of counters
+    '''
+    execute = (connection or meta.Session).execute
+    counts = RelationshipCount.__table__
+    rel = Relationship.__table__
+    execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(counts.name))
+    execute(counts.delete())
+    return execute(counts.insert().from_select(
+        ['package_id', 'type', 'count'],
+        _counts_from(rel.c.state == core.State.ACTIVE, 1))).rowcount
+
+
+def packages_counted(rel_type, low=None, high=None):
+    '''Return the ids of the packages having between `low` and `high`
+    active relationships of `rel_type`, as seen from them, either bound
+    being optional. Packages without such relationships are only found by
+    their absence.'''
+    counts = RelationshipCount.__table__
+    clause = and_(counts.c.type == rel_type, counts.c.count > 0)
+    if low is not None:
+        clause = and_(clause, counts.c.count >= low)
+    if high is not None:
+        clause = and_(clause, counts.c.count <= high)
+    return set(id_ for id_, in read_session().execute(
+        select([counts.c.package_id]).where(clause)))
+
+
+def _directions(rel_type):
+    '''Return ``(forward_type, reverse_type)``, the stored types to follow
+    from the subject side and from the object side to find the relationships
+    of `rel_type` as seen from a package. Either is None when that side
+    cannot hold such relationships, and both are True without a type.'''
+    if rel_type is None:
+        return True, True
+    if rel_type in PackageRelationship.get_forward_types():
+        return rel_type, PackageRelationship.is_undirect(rel_type)
+    return None, PackageRelationship.reverse_to_forward_type(rel_type)
+
+
+def _typed(clause, column, stored_type):
+    if stored_type is True:
+        return clause
+    return and_(clause, column == stored_type)
+
+
+def extras_clause(extras, table=None):
+    '''Clause matching the relationships whose extras contain all the given
+    keys and values, answered from the GIN index.'''
+    table = Relationship.__table__ if table is None else table
+    return table.c.extras.contains(extras)
+
+
+def _edges(where, as_of=None, extras=None):
+    '''Return the ``(subject_id, object_id, type, comment, extras)`` of the
+    active relationships matching ``where(table)``.
+
+    With `as_of`, the relationships active at that date are read from the
+    change log instead: the latest change of every relationship up to the
+    date, unless it is a deletion. `where` gets the table to build its
+    clause on, both tables having the same relationship columns.'''
+    if as_of is None:
+        table = Relationship.__table__
+        clause = and_(table.c.state == core.State.ACTIVE, where(table))
+    else:
+        table = RelationshipChange.__table__
+        latest = select([func.max(table.c.seq)]).where(and_(
+            table.c.timestamp <= as_of, where(table),
+        )).group_by(table.c.relationship_id)
+        clause = and_(table.c.seq.in_(latest),
+                      table.c.op != RelationshipChange.DELETE)
+    if extras:
+        clause = and_(clause, extras_clause(extras, table))
+    return read_session().execute(select([
+        table.c.subject_package_id, table.c.object_package_id, table.c.type,
+        table.c.comment, table.c.extras,
+    ]).where(clause))
+
+
+def visible_packages(org_ids=(), package_ids=()):
+    '''Return a query of the ids of the active datasets that are public,
+    owned by one of `org_ids` or one of `package_ids`.'''
+    package = _package.Package.__table__
+    readable = [package.c.private == False]  # noqa: E712
+    if org_ids:
+        readable.append(package.c.owner_org.in_(org_ids))
+    if package_ids:
+        readable.append(package.c.id.in_(package_ids))
+    return select([package.c.id]).where(and_(
+        package.c.state == core.State.ACTIVE, or_(*readable)))
+
+
+def _visible(clause, column, visible):
+    if visible is None:
+        return clause
+    return and_(clause, column.in_(visible))
+
+
+def relationships_of(package_id, other_id=None, rel_type=None, extras=None,
+                     as_of=None, visible=None):
+    '''Return the active relationships of a package, optionally only those
+    with `other_id`, of `rel_type` as seen from the package, with `extras`
+    containing the given keys and values, or those active at `as_of`.
+
+    With `visible`, a query of package ids as returned by
+    :py:func:`visible_packages`, only the relationships with one of these
+    packages on the other side are returned.
+
+    :returns: ``(subject_id, object_id, type, comment, extras)`` of the
+        stored relationships
+    '''
+    forward, reverse = _directions(rel_type)
+    if not (forward or reverse):
+        return []
+
+    def where(table):
+        sides = []
+        if forward:
+            clause = table.c.subject_package_id == package_id
+            if other_id:
+                clause = and_(clause, table.c.object_package_id == other_id)
+            clause = _visible(clause, table.c.object_package_id, visible)
+            sides.append(_typed(clause, table.c.type, forward))
+        if reverse:
+            clause = table.c.object_package_id == package_id
+            if other_id:
+                clause = and_(clause, table.c.subject_package_id == other_id)
+            clause = _visible(clause, table.c.subject_package_id, visible)
+            sides.append(_typed(clause, table.c.type, reverse))
+        return or_(*sides)
+
+    return _edges(where, as_of, extras).fetchall()
+
+
+def traverse(root_ids, rel_type=None, depth=1, extras=None, as_of=None,
+             visible=None):
+    '''Walk the relationships of many packages at once, breadth first.
+
+    Every level costs a single query for all the roots together, and a
+    package reached from several roots, or several times, is expanded only
+    once. With a `rel_type` only relationships of that type, as seen from
+    the package being expanded, are followed, and with `extras` only those
+    whose extras contain the given keys and values. With `as_of` the
+    relationships active at that date are followed. With `visible`, a query
+    of package ids as returned by :py:func:`visible_packages`, only these
+    packages are reached.
+
+    Only the relationships of transitive types are followed beyond the
+    roots: those of other types are returned at the first level only.
+
+    :returns: the relationships of every expanded package, as
+        ``{package_id: [(other_package_id, type, comment, extras)]}`` where
+        the type is seen from the expanded package
+    '''
+    forward, reverse = _directions(rel_type)
+    if not (forward or reverse):
+        return {}
+    transitive = None
+    if rel_type is None:
+        transitive = [
+            type_ for type_ in PackageRelationship.get_forward_types()
+            if PackageRelationship.has_rule(type_, 'transitive')]
+    elif not PackageRelationship.has_rule(rel_type, 'transitive'):
+        depth = min(depth, 1)
+
+    def where(table):
+        conditions = []
+        if forward:
+            conditions.append(_typed(_visible(
+                table.c.subject_package_id.in_(frontier),
+                table.c.object_package_id, visible), table.c.type, forward))
+        if reverse:
+            conditions.append(_typed(_visible(
+                table.c.object_package_id.in_(frontier),
+                table.c.subject_package_id, visible), table.c.type, reverse))
+        if level and transitive is not None:
+            return and_(or_(*conditions), table.c.type.in_(transitive))
+        return or_(*conditions)
+
+    def followed(type_):
+        return transitive is None \
+            or PackageRelationship.has_rule(type_, 'transitive')
+
+    adjacency = {}
+    frontier = set(root_ids)
+    for level in range(depth):
+        if not frontier:
+            break
+        rows = _edges(where, as_of, extras)
+
+        for node in frontier:
+            adjacency[node] = []
+        for subject, object_, type_, comment, extras_ in rows:
+            if forward and subject in frontier:
+                adjacency[subject].append(
+                    (object_, type_, comment, extras_ or {}))
+            if reverse and object_ in frontier:
+                adjacency[object_].append((
+                    subject,
+                    PackageRelationship.forward_to_reverse_type(type_)
+                    or type_,
+                    comment, extras_ or {}))
+        frontier = set(
+            edge[0] for node in frontier for edge in adjacency[node]
+            if followed(edge[1])
+        ) - set(adjacency)
+    return adjacency
+
+
+def packages_with(rel_type):
+    '''Return the ids of the packages having at least one active relationship
+    of `rel_type`, as seen from them.'''
+    rel = Relationship.__table__
+    if rel_type in PackageRelationship.get_forward_types():
+        columns = [rel.c.subject_package_id]
+        if PackageRelationship.is_undirect(rel_type):
+            columns.append(rel.c.object_package_id)
+        stored_type = rel_type
+    else:
+        columns = [rel.c.object_package_id]
+        stored_type = PackageRelationship.reverse_to_forward_type(rel_type)
+    ids = set()
+    for column in columns:
+        ids.update(id_ for id_, in read_session().query(column).filter(
+            rel.c.state == core.State.ACTIVE,
+            rel.c.type == stored_type,
+        ).distinct())
+    return ids
+
+
+def subtree(adjacency, root_id, depth=1):
+    '''Yield ``(level, package_id, type, other_package_id, comment,
+    extras)`` for the relationships reachable from `root_id` in an adjacency
+    returned by :py:func:`traverse`, each package being expanded once and
+    only when reached through a relationship of a transitive type.'''
+    seen = {root_id}
+    frontier = [root_id]
+    for level in range(1, depth + 1):
+        next_frontier = []
+        for node in frontier:
+            for other, type_, comment, extras in adjacency.get(node, []):
+                yield level, node, type_, other, comment, extras
+                if other not in seen \
+                        and PackageRelationship.has_rule(type_, 'transitive'):
+                    seen.add(other)
+                    next_frontier.append(other)
+        frontier = next_frontier
+
+
+def delete_relationships(whereclause, purge=False):
+    '''Delete the active relationships matching `whereclause` in bulk.
+
+    The relationships are marked as deleted, or removed from the table when
+    `purge` is set, with one statement, and recorded in the change log. The
+    caller is responsible for committing.
+
+    :returns: the number of relationships deleted
+    '''
+    rel = Relationship.__table__
+    active = and_(whereclause, rel.c.state == core.State.ACTIVE)
+    meta.Session.flush()
+    RelationshipChange.record_many(RelationshipChange.DELETE, active)
+    if purge:
+        statement = rel.delete().where(whereclause)
+    else:
+        statement = rel.update().where(active).values(
+            state=core.State.DELETED)
+    result = meta.Session.execute(statement)
+    # Relationships loaded in the session no longer match the table
+    meta.Session.expire_all()
+    return result.rowcount
+
+
+def upsert_relationships(values):
+    '''Create the given relationships, or update those already active, with
+    ``INSERT ... ON CONFLICT`` statements that record their changes in the
+    same statement.
+
+    `values` maps ``(subject_id, type, object_id)`` to ``(comment,
+    extras)``, with the extras of an existing relationship left as they are
+    when None. Relationships written concurrently by another transaction are
+    waited for and updated instead of duplicated, and the rows are written
+    in key order so concurrent batches lock them in the same order. At most
+    two statements are run, one for each kind of extras. The caller is
+    responsible for committing.
+
+    :returns: ``{key: (op, comment, extras)}`` of the relationships created
+        or changed, unchanged ones being left out
+    '''
+    _lock_change_log()
+    meta.Session.flush()
+    written = {}
+    for update_extras in (True, False):
+        keys = sorted(key for key, (_c, extras) in values.items()
+                      if (extras is not None) == update_extras)
+        if keys:
+            for row in meta.Session.execute(
+                    _upsert([key + values[key] for key in keys],
+                            update_extras)):
+                written[(row.subject_package_id, row.type,
+                         row.object_package_id)] = (
+                    row.op, row.comment, row.extras)
+    if written:
+        _written()
+        _adjust_counts(_count_deltas(
+            [key for key, (op, _c, _e) in written.items()
+             if op == RelationshipChange.CREATE], 1))
+        meta.Session.expire_all()
+    return written
+
+
+def _upsert(rows, update_extras):
+    rel = Relationship.__table__
+    changes = RelationshipChange.__table__
+    statement = pg_insert(rel).values([{
+        'id': _types.make_uuid(),
+        'subject_package_id': subject,
+        'type': type_,
+        'object_package_id': object_,
+        'comment': comment,
+        'extras': extras or {},
+        'state': core.State.ACTIVE,
+    } for subject, type_, object_, comment, extras in rows])
+    excluded = statement.excluded
+    set_ = {'comment': excluded.comment}
+    changed = rel.c.comment.is_distinct_from(excluded.comment)
+    if update_extras:
+        set_['extras'] = excluded.extras
+        changed = or_(changed, rel.c.extras != excluded.extras)
+    # Unchanged relationships are not updated, so they return no row
+    upserted = statement.on_conflict_do_update(
+        index_elements=ACTIVE_EDGE_COLUMNS, index_where=text(ACTIVE_EDGE),
+        set_=set_, where=changed,
+    ).returning(
+        rel.c.id, rel.c.subject_package_id, rel.c.object_package_id,
+        rel.c.type, rel.c.comment, rel.c.extras,
+        # xmax is only set on the rows that were updated
+        literal_column('xmax = 0').label('inserted'),
+    ).cte('upserted')
+
+    columns = ['op', 'relationship_id', 'subject_package_id',
+               'object_package_id', 'type', 'comment', 'extras', 'timestamp']
+    return changes.insert().from_select(columns, select([
+        case([(upserted.c.inserted, literal(RelationshipChange.CREATE))],
+             else_=literal(RelationshipChange.UPDATE)),
+        upserted.c.id, upserted.c.subject_package_id,
+        upserted.c.object_package_id, upserted.c.type, upserted.c.comment,
+        upserted.c.extras, literal(datetime.datetime.utcnow()),
+    ])).returning(
+        changes.c.op, changes.c.subject_package_id,
+        changes.c.object_package_id, changes.c.type, changes.c.comment,
+        changes.c.extras)
+
+
+def tree_summary(package_id, limit=10, max_depth=20, rel_type=u'child_of',
+                 visible=None, primary=False):
+    '''Return the path from the root of the tree of `rel_type` down to the
+    parent of a package, the number of its children and its first `limit`
+    children by name, with two queries.
+
+    The path follows the first parent of every package, by id, for at most
+    `max_depth` levels. With `visible`, a query of package ids as returned
+    by :py:func:`visible_packages`, other packages are left out. With
+    `primary`, the primary database is read rather than the read database.
+
+    :returns: ``(path, child_count, children, ancestors)``, the path and the
+        children as lists of ``(id, name, title)``, and the ids of every
+        package of the path, including those left out
+    '''
+    session = meta.Session if primary else read_session()
+    rel = Relationship.__table__
+    package = _package.Package.__table__
+    edges = and_(rel.c.state == core.State.ACTIVE, rel.c.type == rel_type)
+
+    def first_parent(child):
+        return select([rel.c.object_package_id]).where(and_(
+            edges, rel.c.subject_package_id == child,
+        )).order_by(rel.c.object_package_id).limit(1).as_scalar()
+
+    up = select([
+        first_parent(literal(package_id)).label('id'),
+        literal(1).label('depth'),
+    ]).cte('up', recursive=True)
+    up = up.union_all(select([
+        first_parent(up.c.id), up.c.depth + 1,
+    ]).where(and_(up.c.id.isnot(None), up.c.depth < max_depth)))
+    path = session.execute(select([
+        package.c.id, package.c.name, package.c.title,
+        _visible(package.c.state == core.State.ACTIVE, package.c.id,
+                 visible).label('shown'),
+    ]).select_from(up.join(package, package.c.id == up.c.id)).order_by(
+        up.c.depth.desc())).fetchall()
+
+    rows = session.execute(select([
+        package.c.id, package.c.name, package.c.title,
+        func.count().over().label('total'),
+    ]).select_from(rel.join(
+        package, package.c.id == rel.c.subject_package_id
+    )).where(and_(
+        edges, rel.c.object_package_id == package_id,
+        _visible(package.c.state == core.State.ACTIVE, package.c.id,
+                 visible),
+    )).order_by(package.c.name).limit(max(limit, 1))).fetchall()
+    child_count = rows[0].total if rows else 0
+    children = [tuple(row[:3]) for row in rows[:limit]]
+    return ([tuple(row[:3]) for row in path if row.shown], child_count,
+            children, [row.id for row in path])
+
+
+def tree_relatives(package_id, rel_type=u'child_of', up=False):
+    '''Return the ids of the packages below `package_id` in the tree of
+    `rel_type`, a stored type whose subject is the child of its object, or
+    above it with `up`, however deep.
+
+    The tree is walked by a single recursive query, which stops on cycles.'''
+    rel = Relationship.__table__
+    start, end = rel.c.object_package_id, rel.c.subject_package_id
+    if up:
+        start, end = end, start
+    edges = and_(rel.c.state == core.State.ACTIVE, rel.c.type == rel_type)
+    relatives = select([end.label('id')]).where(and_(
+        edges, start == package_id,
+    )).cte('relatives', recursive=True)
+    relatives = relatives.union(select([end]).where(and_(
+        edges, start == relatives.c.id)))
+    ids = set(id_ for id_, in read_session().execute(
+        select([relatives.c.id])))
+    ids.discard(package_id)
+    return ids
+
+
+def is_descendant(package_id, ancestor_id, rel_type=u'child_of'):
+    '''Return whether `package_id` is below `ancestor_id` in the tree of
+    `rel_type`, a stored type whose subject is the child of its object.
+
+    The tree is walked by a single recursive query, which stops on cycles.'''
+    rel = Relationship.__table__
+    edges = and_(rel.c.state == core.State.ACTIVE, rel.c.type == rel_type)
+    below = select([rel.c.subject_package_id.label('id')]).where(and_(
+        edges, rel.c.object_package_id == ancestor_id,
+    )).cte('below', recursive=True)
+    below = below.union(select([rel.c.subject_package_id]).where(and_(
+        edges, rel.c.object_package_id == below.c.id)))
+    return meta.Session.query(
+        exists().where(below.c.id == package_id)).scalar()
+
+
+def closing_cycles(edges, rel_type):
+    '''Return the stored ``(subject_id, object_id)`` of `edges`, active
+    relationships of `rel_type`, that are on a cycle of that type.
+
+    The relationships are walked from all the edges at once by a single
+    recursive query, which stops on cycles.'''
+    edges = list(edges)
+    if not edges:
+        return set()
+    rel = Relationship.__table__
+    links = and_(rel.c.state == core.State.ACTIVE, rel.c.type == rel_type)
+    up = select([
+        rel.c.subject_package_id.label('origin'),
+        rel.c.object_package_id.label('start'),
+        rel.c.object_package_id.label('node'),
+    ]).where(and_(links, tuple_(
+        rel.c.subject_package_id, rel.c.object_package_id).in_(edges)
+    )).cte('up', recursive=True)
+    up = up.union(select([
+        up.c.origin, up.c.start, rel.c.object_package_id,
+    ]).where(and_(links, rel.c.subject_package_id == up.c.node)))
+    return set(tuple(row) for row in meta.Session.execute(
+        select([up.c.origin, up.c.start]).where(
+            up.c.node == up.c.origin).distinct()))
+
+
+def move_children(source_id, target_id, rel_type=u'child_of'):
+    '''Move every child of `source_id` under `target_id`, with their own
+    subtrees, in the tree of `rel_type`.
+
+    The relationships are updated in place by one statement, and recorded in
+    the change log as the deletion of the old relationship followed by the
+    creation of the new one. Children already under the target only lose
+    their relationship with the source. The caller is responsible for
+    checking for cycles and for committing.
+
+    :returns: the number of children moved
+    '''
+    rel = Relationship.__table__
+    edges = and_(rel.c.state == core.State.ACTIVE, rel.c.type == rel_type)
+    under_target = select([rel.c.subject_package_id]).where(and_(
+        edges, rel.c.object_package_id == target_id))
+    moving = and_(edges, rel.c.object_package_id == source_id)
+
+    moved = delete_relationships(
+        and_(moving, rel.c.subject_package_id.in_(under_target)))
+    ids = [id_ for id_, in meta.Session.execute(
+        select([rel.c.id]).where(moving))]
+    if ids:
+        RelationshipChange.record_many(
+            RelationshipChange.DELETE, rel.c.id.in_(ids))
+        meta.Session.execute(rel.update().where(rel.c.id.in_(ids)).values(
+            object_package_id=target_id))
+        RelationshipChange.record_many(
+            RelationshipChange.CREATE, rel.c.id.in_(ids))
+        meta.Session.expire_all()
+    return moved + len(ids)
+
+
+def copy_children(source_id, target_id, rel_type=u'child_of'):
+    '''Add every child of `source_id` under `target_id` as well, with the
+    comment and extras of its relationship with the source. Children
+    already under the target are left as they are.
+
+    The new relationships are inserted with one statement. The caller is
+    responsible for checking for cycles and for committing.
+
+    :returns: the number of children copied
+    '''
+    rel = Relationship.__table__
+    edges = and_(rel.c.state == core.State.ACTIVE, rel.c.type == rel_type)
+    under_target = select([rel.c.subject_package_id]).where(and_(
+        edges, rel.c.object_package_id == target_id))
+    rows = meta.Session.execute(select([
+        rel.c.subject_package_id, rel.c.comment, rel.c.extras,
+    ]).where(and_(
+        edges, rel.c.object_package_id == source_id,
+        ~rel.c.subject_package_id.in_(under_target),
+    ))).fetchall()
+    if not rows:
+        return 0
+    new = [{
+        'id': _types.make_uuid(),
+        'subject_package_id': subject,
+        'object_package_id': target_id,
+        'type': rel_type,
+        'comment': comment,
+        'extras': extras or {},
+        'state': core.State.ACTIVE,
+    } for subject, comment, extras in rows]
+    # Before the new rows are locked, as other writers wait for the lock
+    _lock_change_log()
+    meta.Session.execute(rel.insert(), new)
+    RelationshipChange.record_many(
+        RelationshipChange.CREATE, rel.c.id.in_([row['id'] for row in new]))
+    return len(new)
+
+
+def relationships_version(package_refs, depth=None):
+    '''Return ``(version, last_modified)`` of the relationship data of the
+    given packages (ids or names).
+
+    The version combines the latest relationship change and the latest
+    ``metadata_modified`` of the packages within `depth` relationships of
+    the given ones, in either direction, or of their whole connected
+    component without `depth`, as nested listings show them all. Returns
+    ``(None, None)`` if none of the packages exist.'''
+    Package = _package.Package
+
+    ids = [
+        id_ for id_, in read_session().query(Package.id).filter(or_(
+            Package.id.in_(package_refs),
+            Package.name.in_(package_refs),
+        ))
+    ]
+    if not ids:
+        return None, None
+
+    reached = select([_within(ids, depth).c.id])
+    modified, = read_session().query(
+        func.max(Package.metadata_modified)
+    ).filter(Package.id.in_(reached)).one()
+
+    seq, changed = RelationshipChange.latest_for(reached)
+    last_modified = max(filter(None, [modified, changed]), default=None)
+    version = u'{}-{}'.format(seq or 0, modified.isoformat() if modified else '')
+    return version, last_modified
+
+
+def _within(package_ids, depth=None):
+    '''Return a recursive CTE of the ids of the packages within `depth`
+    active relationships of `package_ids`, in either direction, however far
+    without `depth`. It stops on cycles.'''
+    rel = Relationship.__table__
+    active = rel.c.state == core.State.ACTIVE
+    edges = union_all(
+        select([rel.c.subject_package_id.label('start'),
+                rel.c.object_package_id.label('end')]).where(active),
+        select([rel.c.object_package_id, rel.c.subject_package_id]).where(
+            active),
+    ).alias('edges')
+
+    levels = [] if depth is None else [literal(0).label('depth')]
+    package = _package.Package.__table__
+    reached = select([package.c.id.label('id')] + levels).where(
+        package.c.id.in_(package_ids)).cte('reached', recursive=True)
+    step = select([edges.c.end] + (
+        [] if depth is None else [reached.c.depth + 1]
+    )).select_from(reached.join(edges, edges.c.start == reached.c.id))
+    if depth is not None:
+        step = step.where(reached.c.depth < depth)
+    return reached.union(step)
+
+
+def _stream(query, batch_size):
+    result = read_session().connection().execution_options(
+        stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield tuple(row)
+
+
+def iter_edges(batch_size=10000, details=False):
+    '''Yield ``(subject_id, object_id, type)`` of every active relationship,
+    read from a server-side cursor `batch_size` rows at a time.
+
+    With `details`, the ``comment``, the ``extras`` and the names of the
+    subject and the object, joined in by the same query, follow.'''
+    rel = Relationship.__table__
+    columns = [rel.c.subject_package_id, rel.c.object_package_id, rel.c.type]
+    from_ = rel
+    if details:
+        package = _package.Package.__table__
+        subject = package.alias('subject')
+        object_ = package.alias('object')
+        columns += [rel.c.comment, rel.c.extras, subject.c.name,
+                    object_.c.name]
+        from_ = rel.join(
+            subject, subject.c.id == rel.c.subject_package_id
+        ).join(object_, object_.c.id == rel.c.object_package_id)
+    return _stream(
+        select(columns).select_from(from_).where(
+            rel.c.state == core.State.ACTIVE),
+        batch_size)
+
+
+NODE_ATTRIBUTES = ('name', 'title', 'type', 'state', 'private', 'owner_org',
+                   'metadata_modified')
+
+
+def iter_nodes(batch_size=10000):
+    '''Yield the id followed by the :py:data:`NODE_ATTRIBUTES` of every
+    package with at least one active relationship, read from a server-side
+    cursor.'''
+    rel = Relationship.__table__
+    package = _package.Package.__table__
+    related = exists().where(and_(
+        rel.c.state == core.State.ACTIVE,
+        or_(rel.c.subject_package_id == package.c.id,
+            rel.c.object_package_id == package.c.id)))
+    return _stream(
+        select([package.c.id] + [
+            package.c[name] for name in NODE_ATTRIBUTES
+        ]).where(related),
+        batch_size)
+
+
+def average_fanout():
+    '''Return the average number of active relationships of a package that
+    has any, counted from the side with the larger fan-out.'''
+    rel = Relationship.__table__
+    total, subjects, objects = read_session().query(
+        func.count(rel.c.id),
+        func.count(distinct(rel.c.subject_package_id)),
+        func.count(distinct(rel.c.object_package_id)),
+    ).filter(rel.c.state == core.State.ACTIVE).one()
+    if not total:
+        return 1.0
+    return float(total) / min(subjects, objects)
+
+
 def create_tables():
     """
     Creates the necessary database tables
     """
     log.debug("Creating relationships database tables")
     Base.metadata.create_all(engine)
+    _upgrade_tables()
+
+
+def _upgrade_tables():
+    '''Add the columns and indexes introduced after the tables were first
+    created, and record the relationships that predate the change log.'''
+    inspector = inspect(engine)
+    for table in (Relationship.__table__, RelationshipChange.__table__,
+                  RelationshipCount.__table__):
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                log.debug("Adding %s.%s", table.name, column.name)
+                engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    table.name, CreateColumn(column).compile(engine)))
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        if table is Relationship.__table__ \
+                and ACTIVE_EDGE_INDEX not in indexes:
+            _delete_duplicate_edges()
+        for index in table.indexes:
+            if index.name not in indexes:
+                log.debug("Creating index %s", index.name)
+                index.create(engine)
+
+    counts = RelationshipCount.__table__
+    with engine.begin() as connection:
+        if not connection.execute(select([exists().select_from(counts)])
+                                  ).scalar():
+            recount(connection)
+
+    rel = Relationship.__table__
+    changes = RelationshipChange.__table__
+    engine.execute(RelationshipChange._insert_from(
+        RelationshipChange.CREATE,
+        and_(rel.c.state == core.State.ACTIVE,
+             ~exists().where(changes.c.relationship_id == rel.c.id))))
+
+
+def _delete_duplicate_edges():
+    '''Delete all but one of the relationships active more than once, left
+    by concurrent writes before the unique index on active edges.'''
+    rel = Relationship.__table__
+    active = rel.c.state == core.State.ACTIVE
+    kept = select([func.min(rel.c.id)]).where(active).group_by(
+        *[rel.c[name] for name in ACTIVE_EDGE_COLUMNS])
+    duplicates = and_(active, ~rel.c.id.in_(kept))
+    with engine.begin() as connection:
+        connection.execute(RelationshipChange._insert_from(
+            RelationshipChange.DELETE, duplicates))
+        deleted = connection.execute(rel.update().where(duplicates).values(
+            state=core.State.DELETED)).rowcount
+    if deleted:
+        log.info("Deleted %s duplicate relationships", deleted)
 
 
 def drop_tables():
@@ -213,4 +1551,8 @@ def drop_tables():
     Drop all tables
     """
     log.debug("Deleting relationships database tables")
-    Base.metadata.drop_all(engine, tables=[Relationship.__table__, ])
+    Base.metadata.drop_all(engine, tables=[
+        Relationship.__table__,
+        RelationshipChange.__table__,
+        RelationshipCount.__table__,
+    ])
@@ -2,19 +2,28 @@ import ckan.plugins as p
 import ckan.plugins.toolkit as tk
 import ckanext.relationships.logic.action as action
 import ckanext.relationships.logic.auth as auth
+import ckanext.relationships.logic.validators as validators
 import ckanext.relationships.interfaces as interfaces
 
 from ckan.logic.schema import default_create_package_schema
 from .views import get_blueprints
 from ckanext.relationships.logic.schema import default_relationship_schema
 from ckanext.relationships.cli import get_commands
+from ckanext.relationships.caching import invalidate_tree_summaries
+from ckanext.relationships.model import (
+    PackageRelationship, delete_relationships, involving, load_types,
+    relationship_counts, tree_relatives)
+from ckanext.relationships.search import COUNT_FIELD, translate_filters
 
 class RelationshipsPlugin(p.SingletonPlugin):
     p.implements(p.IConfigurer)
+    p.implements(p.IConfigurable)
     p.implements(p.IBlueprint)
     p.implements(p.IActions)
     p.implements(p.IAuthFunctions)
+    p.implements(p.IValidators)
     p.implements(p.IClick)
+    p.implements(p.IPackageController, inherit=True)
     # p.implements(p.IDatasetForm)
     p.implements(interfaces.IRelationships, inherit=True)
 
@@ -25,6 +34,11 @@ class RelationshipsPlugin(p.SingletonPlugin):
         tk.add_public_directory(config_, 'public')
         tk.add_resource('fanstatic', 'relationships')
 
+    # IConfigurable
+
+    def configure(self, config_):
+        load_types(config_)
+
     # IActions
 
     def get_actions(self):
@@ -32,7 +46,28 @@ class RelationshipsPlugin(p.SingletonPlugin):
             'package_relationship_create': action.package_relationship_create,
             'package_relationship_delete': action.package_relationship_delete,
             'package_relationships_list': action.package_relationships_list,
-            'package_relationship_update': action.package_relationship_update
+            'package_relationship_update': action.package_relationship_update,
+            'package_relationship_changes_since':
+                action.package_relationship_changes_since,
+            'package_relationship_create_many':
+                action.package_relationship_create_many,
+            'package_relationship_delete_many':
+                action.package_relationship_delete_many,
+            'package_relationship_reparent':
+                action.package_relationship_reparent,
+            'package_relationship_move_subtree':
+                action.package_relationship_move_subtree,
+            'package_relationship_exists':
+                action.package_relationship_exists,
+            'package_relationship_counts':
+                action.package_relationship_counts,
+            'package_relationships_list_many':
+                action.package_relationships_list_many,
+            'dataset_purge': action.dataset_purge,
+            'package_show': action.package_show,
+            'package_create': action.package_create,
+            'package_update': action.package_update,
+            'package_patch': action.package_patch,
         }
 
     # IAuthFunctions
@@ -42,8 +77,32 @@ class RelationshipsPlugin(p.SingletonPlugin):
             'package_relationship_create': auth.package_relationship_create,
             'package_relationship_delete': auth.package_relationship_delete,
             'package_relationships_list': auth.package_relationships_list,
-            'package_relationship_update': auth.package_relationship_update
+            'package_relationship_update': auth.package_relationship_update,
+            'package_relationship_changes_since':
+                auth.package_relationship_changes_since,
+            'package_relationship_create_many':
+                auth.package_relationship_create_many,
+            'package_relationship_delete_many':
+                auth.package_relationship_delete_many,
+            'package_relationship_reparent':
+                auth.package_relationship_reparent,
+            'package_relationship_move_subtree':
+                auth.package_relationship_move_subtree,
+            'package_relationship_exists': auth.package_relationship_exists,
+            'package_relationship_counts': auth.package_relationship_counts,
+            'package_relationships_list_many':
+                auth.package_relationships_list_many,
+        }
+
+    # IValidators
+
+    def get_validators(self):
+        return {
+            'relationship_package_exists':
+                validators.relationship_package_exists,
+            'relationship_extras': validators.relationship_extras,
         }
+
     # IDatasetForm
 
     def create_package_schema(self):
@@ -65,7 +124,55 @@ class RelationshipsPlugin(p.SingletonPlugin):
     def get_blueprint(self):
         return get_blueprints()
 
+    # IPackageController
+
+    def delete(self, entity):
+        # Relationships of a deleted dataset are deleted with it, in the
+        # same transaction
+        delete_relationships(involving([entity.id]))
+
+    def after_dataset_update(self, context, pkg_dict):
+        # Tree summaries show the names and titles of related datasets, and
+        # only to users who can read them
+        _invalidate_tree_summaries(pkg_dict['id'])
+        return pkg_dict
+
+    def after_dataset_delete(self, context, pkg_dict):
+        _invalidate_tree_summaries(pkg_dict['id'])
+        return pkg_dict
+
+    def before_dataset_search(self, search_params):
+        fq = search_params.get('fq', '')
+        translated, filters = translate_filters(fq)
+        if translated != fq:
+            search_params['fq'] = translated
+            search_params['fq_list'] = \
+                list(search_params.get('fq_list') or []) + filters
+        return search_params
+
+    def before_dataset_index(self, pkg_dict):
+        # For sorting and the has_children/has_parent filters. Datasets are
+        # reindexed whenever their counters change
+        counts = relationship_counts([pkg_dict['id']])[pkg_dict['id']]
+        for type_ in PackageRelationship.get_all_types():
+            if PackageRelationship.has_rule(type_, 'indexed'):
+                pkg_dict[COUNT_FIELD + type_] = counts.get(type_, 0)
+        return pkg_dict
+
+    # CKAN < 2.10
+    before_search = before_dataset_search
+    before_index = before_dataset_index
+    after_update = after_dataset_update
+    after_delete = after_dataset_delete
+
     # IClick
 
     def get_commands(self):
         return get_commands()
+
+
+def _invalidate_tree_summaries(package_id):
+    # The dataset is shown in the summaries of the datasets below it, and
+    # among the children in those of its parents
+    invalidate_tree_summaries(
+        tree_relatives(package_id, up=True) | {package_id})
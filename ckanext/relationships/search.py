@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''Relationship filters for ``package_search``.
+
+The following filters are understood in ``fq``, with a dataset id or name as
+value, and are replaced by a filter on the matching dataset ids, or on the
+indexed relationship counts, before the query reaches Solr:
+
+``<type>:<dataset>``
+    datasets with a relationship of ``<type>`` to the dataset, e.g.
+    ``child_of:my-collection``, for the types with the ``indexed`` rule
+``descendant_of:<dataset>`` / ``ancestor_of:<dataset>``
+    datasets below or above the dataset in the ``child_of`` hierarchy,
+    however deep
+``has_children:true|false`` / ``has_parent:true|false``
+    datasets with or without children or parents, filtered on the
+    ``relationships_count_<type>`` fields when the type is indexed
+``<type>_count:<n>`` / ``<type>_count:[<low> TO <high>]``
+    datasets with that many relationships of ``<type>``, e.g.
+    ``parent_of_count:[10 TO *]`` for datasets with at least ten children,
+    read from the relationship counters
+
+Filters naming a dataset the user cannot read match nothing. Datasets whose
+relationship counters change are reindexed when the change is committed, so
+the indexed counts stay current.
+
+The ids are passed with Solr's ``terms`` query parser, which handles long
+lists efficiently. A filter matching more than
+``ckanext.relationships.search.max_ids`` datasets (default: 5000), or
+excluding that many, is rejected rather than sent as a request Solr would
+refuse. Permission labels, pagination and facets are applied by
+``package_search`` as usual.
+'''
+import logging
+import re
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckan.model import meta
+
+from .model import (
+    RECOUNTED, PackageRelationship, packages_counted, packages_with,
+    traverse, tree_relatives)
+
+log = logging.getLogger(__name__)
+
+# Whether the tree is walked up from the dataset
+TREE_FILTERS = {
+    'descendant_of': False,
+    'ancestor_of': True,
+}
+EXISTENCE = {
+    'has_children': 'parent_of',
+    'has_parent': 'child_of',
+}
+
+COUNT_SUFFIX = '_count'
+COUNT_FIELD = 'relationships_count_'
+
+CONFIG_MAX_IDS = 'ckanext.relationships.search.max_ids'
+DEFAULT_MAX_IDS = 5000
+
+MATCH_NOTHING = '-*:*'
+
+_RANGE = re.compile(r'^\[\s*(\d+|\*)\s+TO\s+(\d+|\*)\s*\]$')
+
+
+def _indexed_types():
+    return [type_ for type_ in PackageRelationship.get_all_types()
+            if PackageRelationship.has_rule(type_, 'indexed')]
+
+
+def _filter_pattern():
+    types = _indexed_types()
+    names = list(TREE_FILTERS) + list(EXISTENCE) + types \
+        + [type_ + COUNT_SUFFIX for type_ in types]
+    return re.compile(
+        r'(?<![\w:-])({}):("[^"]*"|\[[^\]]*\]|[^\s()]+)'.format(
+            '|'.join(re.escape(name) for name in names)))
+
+
+def _terms(ids, name):
+    if not ids:
+        return MATCH_NOTHING
+    max_ids = tk.asint(tk.config.get(CONFIG_MAX_IDS, DEFAULT_MAX_IDS))
+    if len(ids) > max_ids:
+        raise tk.ValidationError({'fq': [
+            'The {} filter matches or excludes more than {} datasets, '
+            'which is more than the search index accepts'.format(
+                name, max_ids)]})
+    return '{!terms f=id}' + ','.join(sorted(ids))
+
+
+def _readable_package_id(ref):
+    '''Return the id of a dataset, or None if it does not exist or the user
+    of the current request cannot read it.'''
+    pkg = model.Package.get(ref)
+    if pkg is None:
+        return None
+    if has_request_context():
+        try:
+            tk.check_access('package_show', {'user': g.get('user')},
+                            {'id': pkg.id})
+        except (tk.NotAuthorized, tk.ObjectNotFound):
+            return None
+    return pkg.id
+
+
+def _matching_ids(name, value):
+    root = _readable_package_id(value)
+    if root is None:
+        return set()
+    if name in TREE_FILTERS:
+        up = TREE_FILTERS[name]
+        if PackageRelationship.has_rule(u'child_of', 'transitive'):
+            return tree_relatives(root, u'child_of', up)
+        # Only the parents or the children
+        name = u'parent_of' if up else u'child_of'
+    # Datasets that are `name` of the root are reached from the root through
+    # the reverse type
+    adjacency = traverse([root], PackageRelationship.reverse_type(name), 1)
+    ids = set(
+        edge[0] for edges in adjacency.values() for edge in edges)
+    ids.discard(root)
+    return ids
+
+
+def _existence_filter(name, value):
+    '''Return the Solr filter on the datasets with, or without, a
+    relationship of the type of the `name` filter, or None if every dataset
+    matches.'''
+    rel_type = EXISTENCE[name]
+    wanted = tk.asbool(value)
+    if PackageRelationship.has_rule(rel_type, 'indexed'):
+        filter_ = '{}{}:[1 TO *]'.format(COUNT_FIELD, rel_type)
+        return filter_ if wanted else '-' + filter_
+    ids = packages_with(rel_type)
+    if wanted:
+        return _terms(ids, name)
+    return '-_query_:"{}"'.format(_terms(ids, name)) if ids else None
+
+
+def _count_filter(rel_type, value):
+    '''Return the Solr filter on the datasets with a number of relationships
+    of `rel_type` in the range `value`, or None if every dataset matches.'''
+    name = rel_type + COUNT_SUFFIX
+    match = _RANGE.match(value)
+    if match:
+        low, high = [None if bound == '*' else int(bound)
+                     for bound in match.groups()]
+    elif value.isdigit():
+        low = high = int(value)
+    else:
+        raise tk.ValidationError({'fq': [
+            'Invalid relationship count: {}'.format(value)]})
+    if low:
+        return _terms(packages_counted(rel_type, low, high), name)
+    # Datasets without relationships have no counter, so the range is
+    # matched by excluding the datasets above it
+    if high is None:
+        return None
+    ids = packages_counted(rel_type, high + 1)
+    return '-_query_:"{}"'.format(_terms(ids, name)) if ids else None
+
+
+def translate_filters(fq):
+    '''Take the relationship filters out of `fq`.
+
+    :returns: the remaining ``fq`` and the list of Solr filters on ids that
+        replace the relationship filters, each to be sent as its own ``fq``
+        so its local params apply to it alone
+    '''
+    filters = []
+
+    def replace(match):
+        name, value = match.group(1), match.group(2).strip('"')
+        if name.endswith(COUNT_SUFFIX) and name not in _indexed_types():
+            filter_ = _count_filter(name[:-len(COUNT_SUFFIX)], value)
+        elif name in EXISTENCE:
+            filter_ = _existence_filter(name, value)
+        else:
+            filter_ = _terms(_matching_ids(name, value), name)
+        if filter_:
+            filters.append(filter_)
+        return ''
+
+    fq = _filter_pattern().sub(replace, fq).strip()
+    return fq, filters
+
+
+def _reindex_before_commit(session):
+    # As CKAN does for the datasets changed through the ORM, in the same
+    # transaction, so the indexed counts match the committed counters
+    package_ids = session.info.pop(RECOUNTED, None)
+    if not package_ids or not tk.asbool(
+            tk.config.get('ckan.search.automatic_indexing', True)):
+        return
+    from ckan.lib.search import commit, index_for
+
+    package_index = index_for('package')
+    context = {'model': model, 'ignore_auth': True, 'validate': False,
+               'use_cache': False}
+    for package_id in sorted(package_ids):
+        try:
+            pkg_dict = tk.get_action('package_show')(
+                dict(context), {'id': package_id})
+        except tk.ObjectNotFound:
+            # Purged with its relationships
+            continue
+        package_index.update_dict(pkg_dict, defer_commit=True)
+    commit()
+    log.debug('Reindexed %d datasets with changed relationship counts',
+              len(package_ids))
+
+
+def _forget_after_rollback(session):
+    session.info.pop(RECOUNTED, None)
+
+
+event.listen(meta.Session, 'before_commit', _reindex_before_commit)
+event.listen(meta.Session, 'after_rollback', _forget_after_rollback)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''Statistics of the whole relationship graph.
+
+:py:class:`GraphStats` takes the edges one at a time, so the table is read in
+a single pass, and keeps only per-package arrays of integers besides the
+mapping of package ids to array positions.
+'''
+import heapq
+from array import array
+from collections import Counter
+
+NO_PARENT = -1
+UNKNOWN = -1
+ON_PATH = -2
+
+
+class GraphStats(object):
+    '''Connected components, per-type counts, tree depths of `tree_type` and
+    the fan-out of every package.
+
+    In relationships of `tree_type` the subject is the child and the object
+    the parent, as in ``child_of``. A child with several parents is placed
+    under the first one seen, and counted in ``multiple_parents``.'''
+
+    def __init__(self, tree_type=u'child_of'):
+        self.tree_type = tree_type
+        self.relationships = 0
+        self.types = Counter()
+        self.multiple_parents = 0
+        self._index = {}
+        self._ids = []
+        # Union-find forest
+        self._component = array('l')
+        self._size = array('l')
+        self._degree = array('l')
+        self._tree_parent = array('l')
+
+    def _node(self, package_id):
+        index = self._index.get(package_id)
+        if index is None:
+            index = self._index[package_id] = len(self._ids)
+            self._ids.append(package_id)
+            self._component.append(index)
+            self._size.append(1)
+            self._degree.append(0)
+            self._tree_parent.append(NO_PARENT)
+        return index
+
+    def _find(self, index):
+        component = self._component
+        while component[index] != index:
+            # Path halving
+            component[index] = component[component[index]]
+            index = component[index]
+        return index
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a == b:
+            return
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._component[b] = a
+        self._size[a] += self._size[b]
+
+    def add(self, subject_id, object_id, type_):
+        subject = self._node(subject_id)
+        object_ = self._node(object_id)
+        self.relationships += 1
+        self.types[type_] += 1
+        self._degree[subject] += 1
+        self._degree[object_] += 1
+        self._union(subject, object_)
+        if type_ == self.tree_type:
+            if self._tree_parent[subject] == NO_PARENT:
+                self._tree_parent[subject] = object_
+            else:
+                self.multiple_parents += 1
+
+    def components(self):
+        '''Return the sizes of the connected components, largest first.'''
+        return sorted(
+            (self._size[index] for index in range(len(self._ids))
+             if self._component[index] == index),
+            reverse=True)
+
+    def tree_depths(self):
+        '''Return the depth of every tree, by the index of its root, and the
+        number of cycles found, each rooted at the first of its nodes
+        reached.
+
+        A root without children is not a tree.'''
+        count = len(self._ids)
+        depth = array('l', [UNKNOWN]) * count
+        root = array('l', [UNKNOWN]) * count
+        cycles = 0
+        for start in range(count):
+            path = []
+            node = start
+            while depth[node] == UNKNOWN \
+                    and self._tree_parent[node] != NO_PARENT:
+                depth[node] = ON_PATH
+                path.append(node)
+                node = self._tree_parent[node]
+            if depth[node] == ON_PATH:
+                # Rooted at the node that closes the cycle
+                cycles += 1
+                position = path.index(node)
+                path, cycle = path[:position], path[position + 1:]
+                depth[node] = 0
+                root[node] = node
+                for offset, member in enumerate(reversed(cycle), 1):
+                    depth[member] = offset
+                    root[member] = node
+            elif depth[node] == UNKNOWN:
+                depth[node] = 0
+                root[node] = node
+            for offset, child in enumerate(reversed(path), 1):
+                depth[child] = depth[node] + offset
+                root[child] = root[node]
+
+        trees = {}
+        for node in range(count):
+            if depth[node] > trees.get(root[node], 0):
+                trees[root[node]] = depth[node]
+        return trees, cycles
+
+    def fanout(self):
+        '''Return the number of packages per range of relationship counts,
+        as ``[(low, high, packages)]`` with ranges doubling in size.'''
+        buckets = Counter(degree.bit_length() for degree in self._degree)
+        return [(1 << (bits - 1), (1 << bits) - 1, buckets[bits])
+                for bits in sorted(buckets)]
+
+    def hubs(self, top=10):
+        '''Return ``(package_id, relationships)`` of the `top` packages with
+        the most relationships.'''
+        indexes = heapq.nlargest(
+            top, range(len(self._ids)), key=self._degree.__getitem__)
+        return [(self._ids[index], self._degree[index]) for index in indexes]
+
+    def summary(self, top=10):
+        components = self.components()
+        trees, cycles = self.tree_depths()
+        depths = list(trees.values())
+        return {
+            'packages': len(self._ids),
+            'relationships': self.relationships,
+            'types': dict(self.types),
+            'components': len(components),
+            'largest_component': components[0] if components else 0,
+            'trees': len(depths),
+            'max_depth': max(depths, default=0),
+            'average_depth':
+                float(sum(depths)) / len(depths) if depths else 0.0,
+            'multiple_parents': self.multiple_parents,
+            'cycles': cycles,
+            'fanout': self.fanout(),
+            'hubs': self.hubs(top),
+        }
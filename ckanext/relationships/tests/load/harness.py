@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+'''Load-testing harness for the hierarchy endpoint and the relationship
+actions.
+
+:py:func:`seed_catalogue` writes a synthetic ``child_of`` hierarchy straight
+to the database, :py:func:`run` drives a weighted mix of requests against it
+from concurrent workers, through the Flask test client of the application
+under test or over HTTP against a running server, and
+:py:class:`Report` summarises throughput, latency percentiles and the use of
+the database connection pools.
+'''
+import datetime
+import json
+import math
+import random
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from ckan.model import meta
+from ckan.model.package import Package
+from ckan.model.types import make_uuid
+
+from ckanext.relationships import model as rel_model
+
+HIERARCHY_QUERY = '''
+query ($ids: [ID]!, $depth: Int) {
+  people {
+    packages(ids: $ids, depth: $depth) {
+      id name title relationships { subject type object depth }
+    }
+  }
+}'''
+
+DEFAULT_MIX = {
+    'hierarchy': 4,
+    'list': 3,
+    'list_many': 2,
+    'counts': 1,
+    'exists': 1,
+}
+
+
+class Catalogue(object):
+    '''The datasets of a seeded hierarchy, by level from the roots.'''
+
+    def __init__(self, levels):
+        self.levels = levels
+        self.ids = [id_ for level in levels for id_ in level]
+
+    def random_node(self, rnd, below_root=False):
+        levels = self.levels[1:] if below_root and len(self.levels) > 1 \
+            else self.levels
+        return rnd.choice(rnd.choice(levels))
+
+
+def seed_catalogue(roots=10, fanout=5, depth=3, prefix=u'load'):
+    '''Create `roots` trees of ``child_of`` relationships, `fanout` children
+    per dataset and `depth` levels below the roots, with bulk inserts.
+
+    The datasets are not indexed, as the relationship actions and the
+    hierarchy endpoint read them from the database only.
+
+    :returns: the :py:class:`Catalogue` of the new datasets
+    '''
+    package = Package.__table__
+    rel = rel_model.Relationship.__table__
+    now = datetime.datetime.utcnow()
+
+    def packages(count, level):
+        rows = [{
+            'id': make_uuid(),
+            'name': u'{}-{}-{}'.format(prefix, level, number),
+            'title': u'{} {} {}'.format(prefix, level, number),
+            'type': u'dataset',
+            'state': u'active',
+            'private': False,
+            'metadata_created': now,
+            'metadata_modified': now,
+        } for number in range(count)]
+        meta.Session.execute(package.insert(), rows)
+        return [row['id'] for row in rows]
+
+    levels = [packages(roots, 0)]
+    for level in range(1, depth + 1):
+        parents = levels[-1]
+        children = packages(len(parents) * fanout, level)
+        rows = [{
+            'id': make_uuid(),
+            'subject_package_id': child,
+            'object_package_id': parents[number // fanout],
+            'type': u'child_of',
+            'comment': u'',
+            'extras': {},
+            'state': u'active',
+        } for number, child in enumerate(children)]
+        meta.Session.execute(rel.insert(), rows)
+        rel_model.RelationshipChange.record_many(
+            rel_model.RelationshipChange.CREATE,
+            rel.c.id.in_([row['id'] for row in rows]))
+        levels.append(children)
+    # Nor are they reindexed for their new relationship counters
+    meta.Session.info.pop(rel_model.RECOUNTED, None)
+    meta.Session.commit()
+    return Catalogue(levels)
+
+
+def operations(catalogue, depth=2, batch=10):
+    '''Return the requests of the mix, as functions of a random generator
+    returning ``(method, path, body)``.'''
+    def action(name, **params):
+        return 'POST', '/api/3/action/' + name, params
+
+    return {
+        'hierarchy': lambda rnd: ('POST', '/get_hierarchy', {
+            'query': HIERARCHY_QUERY,
+            'variables': {'ids': [catalogue.random_node(rnd)],
+                          'depth': depth},
+        }),
+        'list': lambda rnd: action(
+            'package_relationships_list', id=catalogue.random_node(rnd)),
+        'list_many': lambda rnd: action(
+            'package_relationships_list_many',
+            ids=rnd.sample(catalogue.ids, min(batch, len(catalogue.ids))),
+            depth=depth),
+        'counts': lambda rnd: action(
+            'package_relationship_counts',
+            ids=rnd.sample(catalogue.ids, min(batch, len(catalogue.ids)))),
+        'exists': lambda rnd: action(
+            'package_relationship_exists',
+            subject=catalogue.random_node(rnd, below_root=True),
+            object=catalogue.random_node(rnd)),
+    }
+
+
+class FlaskClient(object):
+    '''Send the requests through the test client of a Flask application,
+    one client per worker thread.'''
+
+    def __init__(self, flask_app, headers=None):
+        self.flask_app = flask_app
+        self.headers = headers or {}
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.flask_app.test_client()
+        response = client.open(path, method=method, json=body,
+                               headers=self.headers)
+        return response.status_code
+
+
+class HttpClient(object):
+    '''Send the requests to a running server.'''
+
+    def __init__(self, base_url, headers=None, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.headers = dict(headers or {}, **{
+            'Content-Type': 'application/json'})
+        self.timeout = timeout
+
+    def request(self, method, path, body):
+        request = Request(self.base_url + path, method=method,
+                          data=json.dumps(body).encode('utf8'),
+                          headers=self.headers)
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+
+class PoolSampler(threading.Thread):
+    '''Sample the connections checked out of the database pools of this
+    process, the primary one and those of the read sessions, until
+    stopped.'''
+
+    def __init__(self, interval=0.01):
+        super(PoolSampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.samples = {}
+        self._stopped = threading.Event()
+
+    def pools(self):
+        engines = {'primary': meta.engine}
+        for session in list(rel_model._read_sessions.values()):
+            engines['read'] = session.session_factory.kw['bind']
+        return dict((name, engine.pool) for name, engine in engines.items())
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            for name, pool in self.pools().items():
+                if hasattr(pool, 'checkedout'):
+                    self.samples.setdefault(name, []).append(
+                        pool.checkedout())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        usage = {}
+        for name, pool in self.pools().items():
+            samples = self.samples.get(name) or [0]
+            usage[name] = {
+                'pool_size': pool.size() if hasattr(pool, 'size') else None,
+                'max_checked_out': max(samples),
+                'mean_checked_out': sum(samples) / float(len(samples)),
+            }
+        return usage
+
+
+def percentile(sorted_values, fraction):
+    '''Return the nearest-rank percentile of a sorted list.'''
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class Report(object):
+    '''Latencies and statuses of the requests of one run.'''
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.elapsed = 0.0
+        self.pools = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if status >= 400:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def _summary(self, latencies, errors):
+        latencies = sorted(latencies)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / self.elapsed
+            if self.elapsed else None,
+            'p50_ms': _ms(percentile(latencies, 0.50)),
+            'p95_ms': _ms(percentile(latencies, 0.95)),
+            'p99_ms': _ms(percentile(latencies, 0.99)),
+        }
+
+    def as_dict(self):
+        every = [s for latencies in self.latencies.values()
+                 for s in latencies]
+        return {
+            'elapsed': self.elapsed,
+            'total': self._summary(every, sum(self.errors.values())),
+            'operations': dict(
+                (name, self._summary(latencies, self.errors.get(name, 0)))
+                for name, latencies in sorted(self.latencies.items())),
+            'pools': self.pools,
+        }
+
+    def format(self):
+        data = self.as_dict()
+        lines = ['{:<12} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+            'operation', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+            'p99 ms')]
+        rows = sorted(data['operations'].items()) + [('total', data['total'])]
+        for name, row in rows:
+            lines.append(
+                '{:<12} {:>8} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'
+                .format(name, row['requests'], row['errors'],
+                        row['throughput'] or 0, row['p50_ms'] or 0,
+                        row['p95_ms'] or 0, row['p99_ms'] or 0))
+        for name, usage in sorted(data['pools'].items()):
+            lines.append(
+                '{} pool: size {}, at most {} connections checked out, '
+                '{:.1f} on average'.format(
+                    name, usage['pool_size'], usage['max_checked_out'],
+                    usage['mean_checked_out']))
+        return '\n'.join(lines)
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+def run(client, ops, mix=None, workers=8, requests=1000, seed=0,
+        sample_pools=True):
+    '''Send `requests` requests drawn from `ops` with the weights of `mix`
+    from `workers` threads.
+
+    Every worker draws from its own generator seeded from `seed`, so runs
+    are reproducible. Pool usage is only sampled for the pools of this
+    process, so it is meaningless against a server in another one.
+
+    :returns: the :py:class:`Report` of the run
+    '''
+    mix = dict((name, weight) for name, weight in (mix or DEFAULT_MIX).items()
+               if weight)
+    names = sorted(mix)
+    weights = [mix[name] for name in names]
+    report = Report()
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker(number):
+        rnd = random.Random('{}-{}'.format(seed, number))
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            name = rnd.choices(names, weights)[0]
+            method, path, body = ops[name](rnd)
+            started = time.perf_counter()
+            try:
+                status = client.request(method, path, body)
+            except Exception:
+                status = 599
+            report.add(name, time.perf_counter() - started, status)
+
+    sampler = PoolSampler() if sample_pools else None
+    if sampler:
+        sampler.start()
+    threads = [threading.Thread(target=worker, args=(number, ))
+               for number in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report.elapsed = time.perf_counter() - started
+    if sampler:
+        report.pools = sampler.stop()
+    return report
@@ -0,0 +1,84 @@
+# encoding: utf-8
+'''Load test of the hierarchy endpoint and the relationship actions.
+
+Skipped unless ``RELATIONSHIPS_LOAD`` is set. The run is parameterised by
+environment variables:
+
+``RELATIONSHIPS_LOAD_ROOTS``, ``_FANOUT``, ``_DEPTH``
+    shape of the seeded hierarchy (default: 10 roots, 5 children per
+    dataset, 3 levels)
+``RELATIONSHIPS_LOAD_WORKERS``, ``_REQUESTS``, ``_SEED``
+    concurrent workers, total number of requests and random seed (default:
+    8, 1000 and 0)
+``RELATIONSHIPS_LOAD_URL``
+    send the requests to a server running with the same database instead of
+    the test client; pool usage is then not reported
+``RELATIONSHIPS_LOAD_REPORT``
+    path of a file to write the report to, as JSON
+
+e.g.::
+
+    RELATIONSHIPS_LOAD=1 RELATIONSHIPS_LOAD_WORKERS=16 \\
+        pytest --ckan-ini=test.ini -s ckanext/relationships/tests/load
+'''
+import json
+import os
+
+import pytest
+
+from . import harness
+
+ENV = 'RELATIONSHIPS_LOAD'
+
+
+def _setting(name, default):
+    return int(os.environ.get('{}_{}'.format(ENV, name), default))
+
+
+@pytest.mark.skipif(not os.environ.get(ENV), reason='load tests not enabled')
+@pytest.mark.usefixtures("clean_db")
+def test_load(app):
+    catalogue = harness.seed_catalogue(
+        roots=_setting('ROOTS', 10), fanout=_setting('FANOUT', 5),
+        depth=_setting('DEPTH', 3))
+    url = os.environ.get(ENV + '_URL')
+    if url:
+        client = harness.HttpClient(url)
+    else:
+        client = harness.FlaskClient(app.flask_app)
+
+    report = harness.run(
+        client, harness.operations(catalogue),
+        workers=_setting('WORKERS', 8), requests=_setting('REQUESTS', 1000),
+        seed=_setting('SEED', 0), sample_pools=not url)
+
+    print('\n' + report.format())
+    path = os.environ.get(ENV + '_REPORT')
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report.as_dict(), f, indent=2)
+    assert not report.errors
+
+
+class TestReport(object):
+    def test_percentiles(self):
+        values = list(range(1, 101))
+        assert harness.percentile(values, 0.50) == 50
+        assert harness.percentile(values, 0.95) == 95
+        assert harness.percentile(values, 0.99) == 99
+        assert harness.percentile([7], 0.99) == 7
+        assert harness.percentile([], 0.5) is None
+
+    def test_summary(self):
+        report = harness.Report()
+        for seconds in (0.01, 0.02, 0.03):
+            report.add('list', seconds, 200)
+        report.add('hierarchy', 0.1, 500)
+        report.elapsed = 2.0
+
+        data = report.as_dict()
+        assert data['total']['requests'] == 4
+        assert data['total']['errors'] == 1
+        assert data['total']['throughput'] == 2.0
+        assert data['operations']['list']['p50_ms'] == pytest.approx(20.0)
+        assert 'hierarchy' in report.format()
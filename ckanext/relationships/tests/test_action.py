@@ -0,0 +1,790 @@
+# encoding: utf-8
+
+import datetime
+import threading
+
+import pytest
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.relationships.caching import REDIS_GENERATION
+from ckanext.relationships.model import relationships_of
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestChangesSince(object):
+    def test_changes_are_recorded_in_order(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        rel = {
+            "subject": child["id"],
+            "object": parent["id"],
+            "type": u"child_of",
+        }
+        helpers.call_action("package_relationship_create", **rel)
+        helpers.call_action(
+            "package_relationship_update", comment=u"Updated", **rel)
+        helpers.call_action("package_relationship_delete", **rel)
+
+        result = helpers.call_action("package_relationship_changes_since")
+        changes = result["changes"]
+        assert [c["op"] for c in changes] == [u"create", u"update", u"delete"]
+        assert changes[0]["subject"] == child["id"]
+        assert changes[0]["object"] == parent["id"]
+        assert result["last_seq"] == changes[-1]["seq"]
+
+    def test_paging_by_sequence_number(self):
+        parent = factories.Dataset()
+        for _ in range(3):
+            helpers.call_action(
+                "package_relationship_create",
+                subject=factories.Dataset()["id"],
+                object=parent["id"],
+                type=u"child_of",
+            )
+
+        first = helpers.call_action(
+            "package_relationship_changes_since", limit=2)
+        assert len(first["changes"]) == 2
+        rest = helpers.call_action(
+            "package_relationship_changes_since", since=first["last_seq"])
+        assert len(rest["changes"]) == 1
+        assert rest["changes"][0]["seq"] > first["last_seq"]
+
+    def test_concurrent_writers_commit_in_sequence_order(self):
+        parent, first, second = [factories.Dataset() for _ in range(3)]
+        helpers.call_action(
+            "package_relationship_create", context={"defer_commit": True},
+            subject=first["id"], object=parent["id"], type=u"child_of")
+
+        written = threading.Event()
+
+        def write():
+            try:
+                helpers.call_action(
+                    "package_relationship_create", subject=second["id"],
+                    object=parent["id"], type=u"child_of")
+                written.set()
+            finally:
+                model.Session.remove()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        # The second transaction waits for the first one to end
+        assert not written.wait(1)
+        model.repo.commit()
+        writer.join(10)
+        assert written.is_set()
+
+        changes = helpers.call_action(
+            "package_relationship_changes_since")["changes"]
+        assert [c["subject"] for c in changes] == [first["id"], second["id"]]
+        assert changes[0]["seq"] < changes[1]["seq"]
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestCreateMany(object):
+    def test_create_and_update_in_one_call(self):
+        parent = factories.Dataset()
+        children = [factories.Dataset() for _ in range(3)]
+        helpers.call_action(
+            "package_relationship_create",
+            subject=children[0]["id"], object=parent["id"], type=u"child_of")
+
+        result = helpers.call_action(
+            "package_relationship_create_many",
+            relationships=[
+                {"subject": child["name"], "object": parent["id"],
+                 "type": u"child_of", "comment": u"Batch"}
+                for child in children
+            ],
+        )
+        assert len(result) == 3
+        assert all(rel["object"] == parent["name"] for rel in result)
+        listed = helpers.call_action(
+            "package_relationships_list", id=parent["id"])
+        assert len(listed) == 3
+        assert set(rel["comment"] for rel in listed) == {u"Batch"}
+
+    def test_repeated_create_is_an_upsert(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        rel = {"subject": child["id"], "object": parent["id"],
+               "type": u"child_of"}
+        helpers.call_action("package_relationship_create", **rel)
+        helpers.call_action("package_relationship_create", **rel)
+        result = helpers.call_action(
+            "package_relationship_create", comment=u"Again", **rel)
+
+        assert result["comment"] == u"Again"
+        listed = helpers.call_action(
+            "package_relationships_list", id=child["id"])
+        assert len(listed) == 1
+        changes = helpers.call_action(
+            "package_relationship_changes_since")["changes"]
+        assert [c["op"] for c in changes] == [u"create", u"update"]
+
+    def test_missing_dataset_fails_the_whole_batch(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        with pytest.raises(tk.ValidationError) as e:
+            helpers.call_action(
+                "package_relationship_create_many",
+                relationships=[
+                    {"subject": child["id"], "object": parent["id"],
+                     "type": u"child_of"},
+                    {"subject": u"missing", "object": parent["id"],
+                     "type": u"child_of"},
+                ],
+            )
+        errors = e.value.error_dict["relationships"]
+        assert not errors[0]
+        assert "subject" in errors[1]
+        assert helpers.call_action(
+            "package_relationships_list", id=parent["id"]) == []
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestDeleteMany(object):
+    def _relate(self, subject, object_, type_=u"child_of"):
+        helpers.call_action(
+            "package_relationship_create",
+            subject=subject["id"], object=object_["id"], type=type_)
+
+    def test_delete_listed_relationships(self):
+        parent = factories.Dataset()
+        children = [factories.Dataset() for _ in range(3)]
+        for child in children:
+            self._relate(child, parent)
+
+        result = helpers.call_action(
+            "package_relationship_delete_many",
+            relationships=[
+                {"subject": children[0]["name"], "object": parent["id"],
+                 "type": u"child_of"},
+                {"subject": parent["id"], "object": children[1]["id"],
+                 "type": u"parent_of"},
+            ],
+        )
+        assert result == {"deleted": 2}
+        remaining = helpers.call_action(
+            "package_relationships_list", id=parent["id"])
+        assert len(remaining) == 1
+
+    def test_delete_by_filter(self):
+        parent = factories.Dataset()
+        for _ in range(3):
+            self._relate(factories.Dataset(), parent)
+
+        result = helpers.call_action(
+            "package_relationship_delete_many",
+            object=parent["id"], type=u"child_of")
+        assert result == {"deleted": 3}
+
+    def test_package_delete_cascades(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        self._relate(child, parent)
+
+        helpers.call_action("package_delete", id=parent["id"])
+
+        changes = helpers.call_action(
+            "package_relationship_changes_since")["changes"]
+        assert changes[-1]["op"] == u"delete"
+        assert changes[-1]["object"] == parent["id"]
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestExistsAndCounts(object):
+    def test_exists(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        other = factories.Dataset()
+        helpers.call_action(
+            "package_relationship_create",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+
+        assert helpers.call_action(
+            "package_relationship_exists",
+            subject=child["name"], object=parent["id"], type=u"child_of")
+        assert helpers.call_action(
+            "package_relationship_exists",
+            subject=parent["id"], object=child["id"])
+        assert helpers.call_action(
+            "package_relationship_exists",
+            relationships=[
+                {"subject": parent["id"], "object": child["id"],
+                 "type": u"parent_of"},
+                {"subject": parent["id"], "object": child["id"],
+                 "type": u"child_of"},
+                {"subject": other["id"], "object": child["id"]},
+            ]) == [True, False, False]
+
+    def test_counts(self):
+        parent = factories.Dataset()
+        children = [factories.Dataset() for _ in range(2)]
+        for child in children:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=child["id"], object=parent["id"], type=u"child_of")
+
+        counts = helpers.call_action(
+            "package_relationship_counts",
+            ids=[parent["name"], children[0]["id"], factories.Dataset()["id"]])
+        assert counts[parent["name"]] == {u"parent_of": 2}
+        assert counts[children[0]["id"]] == {u"child_of": 1}
+        assert list(counts.values())[2] == {}
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestListMany(object):
+    def test_subtrees_of_many_roots(self):
+        root = factories.Dataset()
+        child = factories.Dataset()
+        grandchild = factories.Dataset()
+        other = factories.Dataset()
+        for subject, object_ in [(child, root), (grandchild, child),
+                                 (grandchild, other)]:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=subject["id"], object=object_["id"],
+                type=u"child_of")
+
+        result = helpers.call_action(
+            "package_relationships_list_many",
+            ids=[root["name"], other["name"]], type=u"parent_of", depth=2)
+
+        assert result[root["name"]] == [
+            {"subject": root["name"], "type": u"parent_of",
+             "object": child["name"], "comment": u"", "extras": {},
+             "depth": 1},
+            {"subject": child["name"], "type": u"parent_of",
+             "object": grandchild["name"], "comment": u"", "extras": {},
+             "depth": 2},
+        ]
+        assert result[other["name"]] == [
+            {"subject": other["name"], "type": u"parent_of",
+             "object": grandchild["name"], "comment": u"", "extras": {},
+             "depth": 1},
+        ]
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestExtras(object):
+    def test_create_and_update_extras(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        rel = {
+            "subject": child["id"],
+            "object": parent["id"],
+            "type": u"child_of",
+        }
+        created = helpers.call_action(
+            "package_relationship_create",
+            extras={"weight": 0.5, "provenance": u"import"}, **rel)
+        assert created["extras"] == {"weight": 0.5, "provenance": u"import"}
+
+        updated = helpers.call_action(
+            "package_relationship_update", extras='{"weight": 1}', **rel)
+        assert updated["extras"] == {"weight": 1}
+
+    def test_invalid_extras(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        with pytest.raises(tk.ValidationError) as e:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=child["id"], object=parent["id"], type=u"child_of",
+                extras=u"[1, 2]")
+        assert "extras" in e.value.error_dict
+
+    def test_filter_by_extras(self):
+        root = factories.Dataset()
+        kept = factories.Dataset()
+        skipped = factories.Dataset()
+        grandchild = factories.Dataset()
+        for subject, object_, source in [(kept, root, u"a"),
+                                         (skipped, root, u"b"),
+                                         (grandchild, kept, u"a")]:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=subject["id"], object=object_["id"],
+                type=u"child_of", extras={"source": source, "weight": 1})
+
+        listed = helpers.call_action(
+            "package_relationships_list", id=root["id"],
+            extras='{"source": "a"}')
+        assert [rel["object"] for rel in listed] == [kept["name"]]
+
+        result = helpers.call_action(
+            "package_relationships_list_many", ids=[root["id"]],
+            type=u"parent_of", depth=2, extras={"source": u"a"})
+        assert [rel["object"] for rel in result[root["id"]]] == [
+            kept["name"], grandchild["name"]]
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestAsOf(object):
+    def test_relationships_at_a_date(self):
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        rel = {
+            "subject": child["id"],
+            "object": parent["id"],
+            "type": u"child_of",
+        }
+        before = datetime.datetime.utcnow()
+        helpers.call_action(
+            "package_relationship_create", comment=u"First", **rel)
+        created = datetime.datetime.utcnow()
+        helpers.call_action(
+            "package_relationship_update", comment=u"Second", **rel)
+        updated = datetime.datetime.utcnow()
+        helpers.call_action("package_relationship_delete", **rel)
+
+        def listed(as_of):
+            return helpers.call_action(
+                "package_relationships_list", id=parent["id"],
+                as_of=as_of.isoformat())
+
+        assert listed(before) == []
+        assert [r["comment"] for r in listed(created)] == [u"First"]
+        assert [r["comment"] for r in listed(updated)] == [u"Second"]
+        assert listed(datetime.datetime.utcnow()) == []
+        assert helpers.call_action(
+            "package_relationships_list", id=parent["id"]) == []
+
+        result = helpers.call_action(
+            "package_relationships_list_many", ids=[parent["id"]],
+            as_of=created.isoformat())
+        assert result[parent["id"]] == [
+            {"subject": parent["name"], "type": u"parent_of",
+             "object": child["name"], "comment": u"First", "extras": {},
+             "depth": 1},
+        ]
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestSubtreeOperations(object):
+    def _relate(self, child, parent):
+        helpers.call_action(
+            "package_relationship_create",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+
+    def _children(self, parent):
+        return sorted(
+            rel["object"] for rel in helpers.call_action(
+                "package_relationships_list", id=parent["id"])
+            if rel["type"] == u"parent_of")
+
+    def test_reparent(self):
+        old, new, node = [factories.Dataset() for _ in range(3)]
+        self._relate(node, old)
+
+        result = helpers.call_action(
+            "package_relationship_reparent", id=node["name"],
+            parent=new["name"])
+        assert result["object"] == new["name"]
+        assert self._children(old) == []
+        assert self._children(new) == [node["name"]]
+
+    def test_reparent_under_own_descendant_fails(self):
+        root, child, grandchild = [factories.Dataset() for _ in range(3)]
+        self._relate(child, root)
+        self._relate(grandchild, child)
+
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(
+                "package_relationship_reparent", id=root["id"],
+                parent=grandchild["id"])
+
+    def test_move_and_copy_subtree(self):
+        source, target, copy_target = [factories.Dataset() for _ in range(3)]
+        children = [factories.Dataset() for _ in range(3)]
+        for child in children:
+            self._relate(child, source)
+        self._relate(children[0], target)
+
+        result = helpers.call_action(
+            "package_relationship_move_subtree", source=source["id"],
+            target=target["id"])
+        assert result == {"moved": 3}
+        assert self._children(source) == []
+        names = sorted(child["name"] for child in children)
+        assert self._children(target) == names
+
+        result = helpers.call_action(
+            "package_relationship_move_subtree", source=target["id"],
+            target=copy_target["id"], copy=True)
+        assert result == {"copied": 3}
+        assert self._children(target) == names
+        assert self._children(copy_target) == names
+
+    def test_move_into_own_subtree_fails(self):
+        source, child = factories.Dataset(), factories.Dataset()
+        self._relate(child, source)
+
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(
+                "package_relationship_move_subtree", source=source["id"],
+                target=child["id"])
+
+    def test_move_needs_access_to_every_child(self):
+        editor = factories.User()
+        org = factories.Organization(
+            users=[{"name": editor["name"], "capacity": "editor"}])
+        other_org = factories.Organization()
+        source = factories.Dataset(owner_org=org["id"])
+        target = factories.Dataset(owner_org=org["id"])
+        self._relate(factories.Dataset(owner_org=org["id"]), source)
+        self._relate(factories.Dataset(owner_org=other_org["id"]), source)
+
+        with pytest.raises(tk.NotAuthorized):
+            helpers.call_action(
+                "package_relationship_move_subtree",
+                context={"user": editor["name"], "ignore_auth": False},
+                source=source["id"], target=target["id"])
+        assert len(self._children(source)) == 2
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestVisibility(object):
+    def test_private_datasets_are_left_out(self):
+        member = factories.User()
+        outsider = factories.User()
+        org = factories.Organization(
+            users=[{"name": member["name"], "capacity": "member"}])
+        parent = factories.Dataset()
+        public = factories.Dataset()
+        private = factories.Dataset(owner_org=org["id"], private=True)
+        for child in (public, private):
+            helpers.call_action(
+                "package_relationship_create",
+                subject=child["id"], object=parent["id"], type=u"child_of")
+
+        def listed(user):
+            context = {"user": user["name"], "ignore_auth": False}
+            return sorted(
+                rel["object"] for rel in helpers.call_action(
+                    "package_relationships_list", context=context,
+                    id=parent["id"]))
+
+        assert listed(outsider) == [public["name"]]
+        assert listed(member) == sorted([public["name"], private["name"]])
+
+        result = helpers.call_action(
+            "package_relationships_list_many",
+            context={"user": outsider["name"], "ignore_auth": False},
+            ids=[parent["id"]])
+        assert [rel["object"] for rel in result[parent["id"]]] == [
+            public["name"]]
+
+    def test_unknown_type_is_rejected(self):
+        parent = factories.Dataset()
+        other = factories.Dataset()
+        helpers.call_action(
+            "package_relationship_create",
+            subject=other["id"], object=factories.Dataset()["id"],
+            type=u"child_of")
+
+        with pytest.raises(tk.ValidationError) as e:
+            helpers.call_action(
+                "package_relationships_list", id=parent["id"], rel=u"bogus")
+        assert "rel" in e.value.error_dict
+        assert relationships_of(parent["id"], rel_type=u"bogus") == []
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestAnonymousAccess(object):
+    def _call(self, action, **data_dict):
+        context = {"user": "", "ignore_auth": False}
+        return helpers.call_action(action, context=context, **data_dict)
+
+    def _relate(self):
+        parent, child = factories.Dataset(), factories.Dataset()
+        helpers.call_action(
+            "package_relationship_create",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+        return parent, child
+
+    def test_list(self):
+        parent, child = self._relate()
+        listed = self._call("package_relationships_list", id=parent["id"])
+        assert [rel["object"] for rel in listed] == [child["name"]]
+
+    def test_list_many(self):
+        parent, child = self._relate()
+        result = self._call(
+            "package_relationships_list_many", ids=[parent["id"]])
+        assert [rel["object"] for rel in result[parent["id"]]] == [
+            child["name"]]
+
+    def test_exists(self):
+        parent, child = self._relate()
+        assert self._call(
+            "package_relationship_exists",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+
+    def test_counts(self):
+        parent, child = self._relate()
+        counts = self._call("package_relationship_counts", ids=[parent["id"]])
+        assert counts[parent["id"]] == {u"parent_of": 1}
+
+    def test_private_datasets_are_not_counted(self):
+        member = factories.User()
+        org = factories.Organization(
+            users=[{"name": member["name"], "capacity": "member"}])
+        parent = factories.Dataset()
+        for private in (False, True):
+            helpers.call_action(
+                "package_relationship_create",
+                subject=factories.Dataset(
+                    owner_org=org["id"], private=private)["id"],
+                object=parent["id"], type=u"child_of")
+
+        counts = self._call("package_relationship_counts", ids=[parent["id"]])
+        assert counts[parent["id"]] == {u"parent_of": 1}
+        counts = helpers.call_action(
+            "package_relationship_counts",
+            context={"user": member["name"], "ignore_auth": False},
+            ids=[parent["id"]])
+        assert counts[parent["id"]] == {u"parent_of": 2}
+
+    def test_private_datasets_stay_hidden(self):
+        org = factories.Organization()
+        private = factories.Dataset(owner_org=org["id"], private=True)
+        with pytest.raises(tk.NotAuthorized):
+            self._call("package_relationship_counts", ids=[private["id"]])
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestTreeSummary(object):
+    def test_summary_in_package_show(self):
+        root, child, grandchild = [factories.Dataset() for _ in range(3)]
+        for subject, object_ in [(child, root), (grandchild, child)]:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=subject["id"], object=object_["id"],
+                type=u"child_of")
+
+        shown = helpers.call_action(
+            "package_show", id=grandchild["id"], include_tree_summary=True)
+        tree = shown["relationships_tree"]
+        assert [pkg["name"] for pkg in tree["path"]] == [
+            root["name"], child["name"]]
+        assert tree["child_count"] == 0
+
+        tree = helpers.call_action(
+            "package_show", id=child["id"], include_tree_summary=True
+        )["relationships_tree"]
+        assert tree["child_count"] == 1
+        assert [pkg["id"] for pkg in tree["children"]] == [grandchild["id"]]
+
+        assert "relationships_tree" not in helpers.call_action(
+            "package_show", id=child["id"])
+
+    def test_summary_is_invalidated_by_writes(self):
+        parent, child = factories.Dataset(), factories.Dataset()
+
+        def child_count():
+            return helpers.call_action(
+                "package_show", id=parent["id"], include_tree_summary=True
+            )["relationships_tree"]["child_count"]
+
+        assert child_count() == 0
+        helpers.call_action(
+            "package_relationship_create",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+        assert child_count() == 1
+
+    def test_summary_is_invalidated_by_dataset_updates(self):
+        outsider = factories.User()
+        org = factories.Organization()
+        parent = factories.Dataset()
+        child = factories.Dataset(owner_org=org["id"])
+        helpers.call_action(
+            "package_relationship_create",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+
+        def children():
+            return [pkg["name"] for pkg in helpers.call_action(
+                "package_show",
+                context={"user": outsider["name"], "ignore_auth": False},
+                id=parent["id"], include_tree_summary=True
+            )["relationships_tree"]["children"]]
+
+        assert children() == [child["name"]]
+        helpers.call_action("package_patch", id=child["id"], name=u"renamed")
+        assert children() == [u"renamed"]
+        helpers.call_action("package_patch", id=child["id"], private=True)
+        assert children() == []
+
+    @pytest.mark.usefixtures("clean_redis")
+    def test_only_summaries_showing_the_dataset_are_invalidated(self):
+        root, child, grandchild, unrelated = [
+            factories.Dataset() for _ in range(4)]
+        for subject, object_ in [(child, root), (grandchild, child)]:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=subject["id"], object=object_["id"],
+                type=u"child_of")
+
+        def path():
+            return [pkg["name"] for pkg in helpers.call_action(
+                "package_show", id=grandchild["id"],
+                include_tree_summary=True
+            )["relationships_tree"]["path"]]
+
+        def generations():
+            return connect_to_redis().mget([
+                REDIS_GENERATION.format(pkg["id"])
+                for pkg in (root, child, grandchild)])
+
+        assert path() == [root["name"], child["name"]]
+        before = generations()
+        helpers.call_action("package_patch", id=unrelated["id"], title=u"T")
+        assert generations() == before
+
+        helpers.call_action("package_patch", id=root["id"], name=u"renamed")
+        assert path() == [u"renamed", child["name"]]
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestNestedRelationships(object):
+    def test_relationships_created_with_the_dataset(self):
+        parent = factories.Dataset()
+        children = [factories.Dataset() for _ in range(3)]
+        dataset = factories.Dataset(
+            relationships_as_subject=[
+                {"object": parent["name"], "type": u"child_of"}],
+            relationships_as_object=[
+                {"subject": child["id"], "type": u"child_of",
+                 "comment": u"Nested"} for child in children],
+        )
+
+        listed = helpers.call_action(
+            "package_relationships_list", id=dataset["id"])
+        assert sorted(rel["type"] for rel in listed) == \
+            [u"child_of"] + [u"parent_of"] * 3
+
+        helpers.call_action(
+            "package_patch", id=dataset["id"],
+            relationships_as_subject=[
+                {"object": parent["id"], "type": u"child_of",
+                 "comment": u"Patched"}])
+        listed = helpers.call_action(
+            "package_relationships_list", id=dataset["id"], rel=u"child_of")
+        assert [rel["comment"] for rel in listed] == [u"Patched"]
+        assert len(helpers.call_action(
+            "package_relationships_list", id=dataset["id"])) == 4
+
+    def test_nested_relationships_are_synced(self):
+        parent, other_parent, child = [factories.Dataset() for _ in range(3)]
+        dataset = factories.Dataset(
+            relationships_as_subject=[
+                {"object": parent["id"], "type": u"child_of"}],
+            relationships_as_object=[
+                {"subject": child["id"], "type": u"child_of"}])
+
+        context = {"user": helpers.call_action("get_site_user")["name"]}
+        result = helpers.call_action(
+            "package_patch", context=context, id=dataset["id"],
+            relationships_as_subject=[
+                {"object": other_parent["id"], "type": u"child_of"}])
+        assert [rel["object"] for rel in result["relationships_as_subject"]] \
+            == [other_parent["id"]]
+        assert "relationship_package_ids" not in context
+        listed = helpers.call_action(
+            "package_relationships_list", id=dataset["id"])
+        assert sorted((rel["type"], rel["object"]) for rel in listed) == [
+            (u"child_of", other_parent["name"]),
+            (u"parent_of", child["name"])]
+
+        helpers.call_action(
+            "package_patch", id=dataset["id"], relationships_as_object=[])
+        listed = helpers.call_action(
+            "package_relationships_list", id=dataset["id"])
+        assert [rel["type"] for rel in listed] == [u"child_of"]
+
+    def test_invalid_nested_relationship_fails_the_dataset(self):
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(
+                "package_create", name=u"with-missing-parent",
+                relationships_as_subject=[
+                    {"object": u"missing", "type": u"child_of"}])
+        with pytest.raises(tk.ObjectNotFound):
+            helpers.call_action("package_show", id=u"with-missing-parent")
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestTypeRules(object):
+    def test_cycles_of_acyclic_types_are_rejected(self):
+        first, second, third = [factories.Dataset() for _ in range(3)]
+        helpers.call_action(
+            "package_relationship_create_many",
+            relationships=[
+                {"subject": second["id"], "object": first["id"],
+                 "type": u"child_of"},
+                {"subject": third["id"], "object": second["id"],
+                 "type": u"child_of"},
+            ])
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(
+                "package_relationship_create",
+                subject=first["id"], object=third["id"], type=u"child_of")
+        assert helpers.call_action(
+            "package_relationships_list", id=first["id"]) == [{
+                "subject": first["name"], "type": u"parent_of",
+                "object": second["name"], "comment": u"", "extras": {}}]
+
+        # sibling_of is not acyclic
+        helpers.call_action(
+            "package_relationship_create_many",
+            relationships=[
+                {"subject": first["id"], "object": second["id"],
+                 "type": u"sibling_of"},
+                {"subject": second["id"], "object": first["id"],
+                 "type": u"sibling_of"},
+            ])
+
+    def test_non_transitive_types_are_not_walked(self):
+        first, second, third = [factories.Dataset() for _ in range(3)]
+        for subject, object_ in ((first, second), (second, third)):
+            helpers.call_action(
+                "package_relationship_create", subject=subject["id"],
+                object=object_["id"], type=u"sibling_of")
+
+        result = helpers.call_action(
+            "package_relationships_list_many", ids=[first["id"]],
+            type=u"sibling_of", depth=3)
+        assert [rel["depth"] for rel in result[first["id"]]] == [1]
+
+    def test_only_transitive_types_are_walked_without_a_type(self):
+        first, sibling, sibling_of_sibling, parent, grandparent = [
+            factories.Dataset() for _ in range(5)]
+        for subject, object_, type_ in [
+                (first, sibling, u"sibling_of"),
+                (sibling, sibling_of_sibling, u"sibling_of"),
+                (first, parent, u"child_of"),
+                (parent, grandparent, u"child_of")]:
+            helpers.call_action(
+                "package_relationship_create", subject=subject["id"],
+                object=object_["id"], type=type_)
+
+        result = helpers.call_action(
+            "package_relationships_list_many", ids=[first["id"]], depth=3)
+        reached = dict(
+            (rel["object"], rel["depth"]) for rel in result[first["id"]])
+        assert reached[sibling["name"]] == 1
+        assert reached[grandparent["name"]] == 2
+        assert sibling_of_sibling["name"] not in reached
+
+    def test_tree_operations_need_a_hierarchical_type(self):
+        first, second = factories.Dataset(), factories.Dataset()
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(
+                "package_relationship_reparent", id=first["id"],
+                parent=second["id"], type=u"sibling_of")
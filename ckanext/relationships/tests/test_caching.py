@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+import flask
+import pytest
+from graphql import parse
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.relationships.caching import (
+    CacheValidator, package_refs_from_document)
+from ckanext.relationships.model import relationships_version
+
+
+class TestPackageRefsFromDocument(object):
+    def test_literal_and_variable_ids(self):
+        document = parse(
+            'query q($id: ID) { people { '
+            'a: package(id: "pkga") { id } '
+            'b: package(id: $id) { id } } }'
+        )
+        refs = package_refs_from_document(document, {"id": "pkgb"})
+        assert sorted(refs) == ["pkga", "pkgb"]
+
+    def test_unknown_variable(self):
+        document = parse(
+            'query q($id: ID) { people { package(id: $id) { id } } }')
+        assert package_refs_from_document(document, {}) is None
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestRelationshipsVersion(object):
+    def test_changes_two_levels_down(self):
+        root, child, grandchild = [factories.Dataset() for _ in range(3)]
+        for subject, object_ in [(child, root), (grandchild, child)]:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=subject["id"], object=object_["id"],
+                type=u"child_of")
+
+        version, _last_modified = relationships_version([root["id"]])
+        direct, _last_modified = relationships_version([root["id"]], 1)
+        helpers.call_action(
+            "package_patch", id=grandchild["id"], title=u"Renamed")
+        assert relationships_version([root["id"]])[0] != version
+        assert relationships_version([root["id"]], 1)[0] == direct
+
+        version, _last_modified = relationships_version([root["id"]])
+        helpers.call_action(
+            "package_relationship_create",
+            subject=factories.Dataset()["id"], object=grandchild["id"],
+            type=u"child_of")
+        assert relationships_version([root["id"]])[0] != version
+
+
+@pytest.mark.usefixtures("clean_db", "with_request_context")
+class TestCacheValidator(object):
+    def test_etag_depends_on_readable_datasets(self):
+        org = factories.Organization()
+        member = factories.User()
+        helpers.call_action(
+            "organization_member_create", id=org["id"],
+            username=member["name"], role=u"member")
+        dataset = factories.Dataset()
+
+        etags = []
+        for user in (u"", factories.User()["name"], member["name"]):
+            flask.g.user = user
+            etags.append(CacheValidator([dataset["id"]]).etag)
+        assert etags[0] == etags[1]
+        assert etags[1] != etags[2]
@@ -0,0 +1,90 @@
+# encoding: utf-8
+
+import pytest
+from graphql_server import HttpQueryError
+
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.relationships.documents import (
+    CONFIG_PERSISTED_MAX_LENGTH, DEFAULT_PERSISTED_TTL, REDIS_KEY, LRUCache,
+    get_backend, query_hash, resolve_persisted_query)
+from ckanext.relationships.hierarchy import package_schema
+
+
+class TestLRUCache(object):
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+
+
+class TestCachedDocumentBackend(object):
+    def test_document_is_parsed_once(self):
+        query = "{ people { package(id: \"x\") { id } } }"
+        backend = get_backend()
+        first = backend.document_from_string(package_schema, query)
+        second = backend.document_from_string(package_schema, query)
+        assert first is second
+
+    def test_invalid_document_is_not_cached(self):
+        query = "{ people { missing } }"
+        backend = get_backend()
+        first = backend.document_from_string(package_schema, query)
+        assert first.execute().invalid
+        assert backend.document_from_string(package_schema, query) \
+            is not first
+
+
+class TestPersistedQueries(object):
+    def _extensions(self, sha256):
+        return {"persistedQuery": {"version": 1, "sha256Hash": sha256}}
+
+    def test_plain_query_is_untouched(self):
+        data = {"query": "{ people { package { id } } }"}
+        assert resolve_persisted_query(data, {}, package_schema) is data
+
+    def test_hash_mismatch(self):
+        data = {
+            "query": "{ people { package { id } } }",
+            "extensions": self._extensions("0" * 64),
+        }
+        with pytest.raises(HttpQueryError):
+            resolve_persisted_query(data, {}, package_schema)
+
+    @pytest.mark.usefixtures("clean_redis")
+    def test_unknown_then_registered_hash(self):
+        query = "{ people { package { title } } }"
+        sha256 = query_hash(query)
+        with pytest.raises(HttpQueryError, match="PersistedQueryNotFound"):
+            resolve_persisted_query(
+                {"extensions": self._extensions(sha256)}, {}, package_schema)
+
+        resolve_persisted_query(
+            {"query": query, "extensions": self._extensions(sha256)}, {},
+            package_schema)
+        data = resolve_persisted_query(
+            {"extensions": self._extensions(sha256)}, {}, package_schema)
+        assert data["query"] == query
+        assert 0 < connect_to_redis().ttl(REDIS_KEY.format(sha256)) \
+            <= DEFAULT_PERSISTED_TTL
+
+    @pytest.mark.usefixtures("clean_redis")
+    @pytest.mark.ckan_config(CONFIG_PERSISTED_MAX_LENGTH, 40)
+    @pytest.mark.parametrize("query", [
+        "{ people { missing } }",
+        "{ people {",
+        "{ people { package { id name title description url } } }",
+    ])
+    def test_invalid_or_long_query_is_not_registered(self, query):
+        sha256 = query_hash(query)
+        data = {"query": query, "extensions": self._extensions(sha256)}
+        assert resolve_persisted_query(data, {}, package_schema) is data
+        with pytest.raises(HttpQueryError, match="PersistedQueryNotFound"):
+            resolve_persisted_query(
+                {"extensions": self._extensions(sha256)}, {}, package_schema)
@@ -0,0 +1,82 @@
+# encoding: utf-8
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+import pytest
+
+import ckan.logic as logic
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.relationships.executors import (
+    PooledAsyncioExecutor, PooledThreadExecutor)
+
+EXECUTORS = [PooledThreadExecutor, PooledAsyncioExecutor]
+
+
+@pytest.fixture
+def pool():
+    pool = ThreadPoolExecutor(max_workers=2)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.mark.parametrize("executor_class", EXECUTORS)
+class TestPooledExecutors(object):
+    def _run(self, executor_class, pool, *fns):
+        executor = executor_class(pool)
+        for fn in fns:
+            executor.execute(fn)
+        executor.wait_until_finished()
+
+    def test_resolvers_run_concurrently(self, app, executor_class, pool):
+        # Both resolvers have to be running at once to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        passed = []
+
+        def resolver():
+            barrier.wait()
+            passed.append(threading.current_thread().name)
+
+        with app.flask_app.test_request_context():
+            self._run(executor_class, pool, resolver, resolver)
+        assert len(passed) == 2
+
+    def test_acting_user_reaches_the_resolvers(
+            self, app, executor_class, pool):
+        users = []
+
+        def resolver():
+            users.append(flask.g.user)
+
+        with app.flask_app.test_request_context():
+            flask.g.user = u"someone"
+            self._run(executor_class, pool, resolver, resolver)
+        assert users == [u"someone", u"someone"]
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_resolvers_check_access_as_the_acting_user(app, pool):
+    member = factories.User()
+    org = factories.Organization(
+        users=[{"name": member["name"], "capacity": "member"}])
+    parent = factories.Dataset()
+    private = factories.Dataset(owner_org=org["id"], private=True)
+    helpers.call_action(
+        "package_relationship_create",
+        subject=private["id"], object=parent["id"], type=u"child_of")
+    listed = []
+
+    def resolver():
+        result = logic.get_action("package_relationships_list_many")(
+            {"api_version": 2}, {"ids": [parent["id"]]})
+        listed.extend(rel["object"] for rel in result[parent["id"]])
+
+    with app.flask_app.test_request_context():
+        flask.g.user = member["name"]
+        executor = PooledThreadExecutor(pool)
+        executor.execute(resolver)
+        executor.wait_until_finished()
+    assert listed == [private["id"]]
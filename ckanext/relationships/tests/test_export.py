@@ -0,0 +1,45 @@
+# encoding: utf-8
+
+import datetime
+import io
+import xml.etree.ElementTree as ET
+
+from ckanext.relationships.export import (
+    read_adjacency, write_adjacency, write_graphml)
+
+EDGES = [
+    (u"a", u"b", u"child_of", None, {}, u"pkg-a", u"pkg-b"),
+    (u"c", u"b", u"child_of", u"x < y", {"weight": 1}, u"pkg-c", u"pkg-b"),
+    (u"a", u"c", u"sibling_of", u"", {}, u"pkg-a", u"pkg-c"),
+]
+
+
+class TestExport(object):
+    def test_adjacency_round_trip(self):
+        out = io.BytesIO()
+        assert write_adjacency(out, EDGES) == (3, 3)
+
+        out.seek(0)
+        ids, types, offsets, targets, edge_types = read_adjacency(out)
+        assert ids == [u"a", u"b", u"c"]
+        assert types == [u"child_of", u"sibling_of"]
+        assert list(offsets) == [0, 2, 2, 3]
+        assert list(targets) == [1, 2, 1]
+        assert [types[t] for t in edge_types] == [
+            u"child_of", u"sibling_of", u"child_of"]
+
+    def test_graphml(self):
+        out = io.BytesIO()
+        nodes = [(u"a", u"pkg-a", u"A & B", u"dataset", u"active", False,
+                  None, datetime.datetime(2020, 1, 1))]
+        write_graphml(out, nodes, EDGES)
+
+        ns = {"g": "http://graphml.graphdrawing.org/xmlns"}
+        graph = ET.fromstring(out.getvalue()).find("g:graph", ns)
+        node = graph.find("g:node", ns)
+        data = dict((d.get("key"), d.text) for d in node)
+        assert data["title"] == u"A & B"
+        assert data["private"] == u"false"
+        edges = graph.findall("g:edge", ns)
+        assert len(edges) == 3
+        assert edges[1].get("source") == u"c"
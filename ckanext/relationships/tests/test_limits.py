@@ -0,0 +1,25 @@
+# encoding: utf-8
+
+from graphql import parse
+
+from ckanext.relationships.limits import analyse
+from ckanext.relationships.hierarchy import package_schema
+
+
+class TestAnalyse(object):
+    def test_keyed_list_is_not_multiplied(self):
+        document = parse('{ people { package(id: "pkga") { id name } } }')
+        cost = analyse(package_schema, document, fanout=10, max_depth=10)
+        assert cost.depth == 3
+        assert cost.fields == 4
+        assert cost.cost == 4
+
+    def test_unkeyed_list_is_multiplied_by_fanout(self):
+        document = parse('{ people { package { id name } } }')
+        cost = analyse(package_schema, document, fanout=10, max_depth=10)
+        assert cost.cost == 1 + 1 + 10 * 2
+
+    def test_depth_is_capped(self):
+        document = parse('{ people { package { child { id } } } }')
+        cost = analyse(package_schema, document, fanout=1, max_depth=2)
+        assert cost.depth == 3
@@ -1,5 +1,18 @@
 """Tests for plugin.py."""
+import subprocess
+import sys
+
 import ckanext.relationships.plugin as plugin
 
 def test_plugin():
     pass
+
+
+def test_plugin_import_does_not_load_graphql():
+    # The GraphQL stack is only imported when /get_hierarchy is requested
+    code = (
+        "import sys, ckanext.relationships.plugin; "
+        "loaded = {'graphene', 'graphql', 'flask_graphql'} & set(sys.modules); "
+        "assert not loaded, loaded"
+    )
+    subprocess.check_call([sys.executable, "-c", code])
@@ -1,9 +1,19 @@
 # encoding: utf-8
 
+import json
+
 import pytest
 import ckan.model as model
+import ckan.plugins as p
+from ckan.exceptions import CkanConfigurationException
 from ckan.lib.create_test_data import CreateTestData
 
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckanext.relationships.model import (
+    CONFIG_READ_URL, DEFAULT_TYPES, DEFAULT_TYPES_PRINTABLE,
+    PackageRelationship, load_types, read_session)
+
 
 @pytest.mark.usefixtures("clean_db")
 class TestCreation(object):
@@ -302,3 +312,171 @@ class TestComplicated(object):
             len(homer.get_relationships(with_package=homer_derived)) == 1
         ), "expectiong homer to have recreated initial relationship"
         self._check(rels, "homer_derived", "derives_from", "homer")
+
+
+@pytest.fixture
+def reset_types():
+    yield
+    PackageRelationship.set_types(DEFAULT_TYPES, DEFAULT_TYPES_PRINTABLE)
+
+
+@pytest.mark.usefixtures("reset_types")
+class TestLoadTypes(object):
+    def test_defaults(self):
+        load_types({})
+        assert PackageRelationship.get_all_types() == [
+            u"child_of", u"parent_of", u"sibling_of", u"sibling_of"]
+
+    def test_types_from_config(self):
+        load_types({
+            "ckanext.relationships.types":
+                "depends_on:dependency_of links_to",
+        })
+        assert PackageRelationship.types == [
+            (u"depends_on", u"dependency_of"), (u"links_to", u"links_to")]
+        assert PackageRelationship.get_reverse_types() == [
+            u"dependency_of", u"links_to"]
+        assert PackageRelationship.make_type_printable(u"dependency_of") \
+            == u"dependency of {}"
+
+    def test_types_from_file(self, tmp_path):
+        path = tmp_path / "types.json"
+        path.write_text(json.dumps([{
+            "type": "derives_from",
+            "reverse": "has_derivation",
+            "printable": "derives from {}",
+            "reverse_printable": "has derivation {}",
+        }]))
+        load_types({"ckanext.relationships.types_file": str(path)})
+        assert PackageRelationship.types == [
+            (u"derives_from", u"has_derivation")]
+        assert PackageRelationship.make_type_printable(u"has_derivation") \
+            == u"has derivation {}"
+
+    def test_type_rules(self, tmp_path):
+        path = tmp_path / "types.json"
+        path.write_text(json.dumps([
+            {"type": "child_of", "reverse": "parent_of"},
+            {"type": "depends_on", "reverse": "dependency_of",
+             "acyclic": True, "indexed": False},
+            {"type": "links_to", "reverse": "links_to"},
+        ]))
+        load_types({"ckanext.relationships.types_file": str(path)})
+        has_rule = PackageRelationship.has_rule
+        assert has_rule(u"parent_of", "hierarchical")
+        assert has_rule(u"parent_of", "acyclic")
+        assert has_rule(u"dependency_of", "acyclic")
+        assert has_rule(u"depends_on", "transitive")
+        assert not has_rule(u"depends_on", "indexed")
+        assert not has_rule(u"depends_on", "hierarchical")
+        assert has_rule(u"links_to", "symmetric")
+        assert not has_rule(u"links_to", "transitive")
+
+    def test_invalid_type_rules(self, tmp_path):
+        path = tmp_path / "types.json"
+        path.write_text(json.dumps([
+            {"type": "links_to", "hierarchical": True}]))
+        with pytest.raises(CkanConfigurationException):
+            load_types({"ckanext.relationships.types_file": str(path)})
+
+    def test_plugin_without_type_rules(self, monkeypatch):
+        class OldPlugin(object):
+            name = "old"
+
+            def get_rel_types(self):
+                return [(u"cites", u"cited_by")]
+
+            def get_printable_rel_types(self):
+                return [(u"cites {}", u"is cited by {}")]
+
+        monkeypatch.setattr(
+            p, "PluginImplementations", lambda interface: [OldPlugin()])
+        load_types({})
+        assert u"cites" in PackageRelationship.get_forward_types()
+        assert PackageRelationship.has_rule(u"cited_by", "transitive")
+        monkeypatch.undo()
+        load_types({})
+
+    def test_conflicting_types(self):
+        with pytest.raises(CkanConfigurationException):
+            load_types({
+                "ckanext.relationships.types":
+                    "child_of:parent_of child_of:sibling_of",
+            })
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestReadSession(object):
+    def test_primary_without_read_url(self):
+        assert read_session() is model.Session
+
+    def test_reads_stay_on_primary_after_a_write(self, ckan_config,
+                                                 monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, CONFIG_READ_URL, ckan_config["sqlalchemy.url"])
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        model.Session.remove()
+        assert read_session() is not model.Session
+
+        helpers.call_action(
+            "package_relationship_create",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+        assert read_session() is model.Session
+
+        model.Session.remove()
+        assert read_session() is not model.Session
+        listed = helpers.call_action(
+            "package_relationships_list", id=parent["id"])
+        assert [rel["object"] for rel in listed] == [child["name"]]
+
+
+@pytest.mark.usefixtures("clean_db")
+class TestCounters(object):
+    def _counts(self, *ids):
+        return helpers.call_action("package_relationship_counts", ids=ids)
+
+    def test_counters_follow_the_writes(self):
+        parent = factories.Dataset()
+        other = factories.Dataset()
+        children = [factories.Dataset() for _ in range(3)]
+        helpers.call_action(
+            "package_relationship_create_many",
+            relationships=[
+                {"subject": child["id"], "object": parent["id"],
+                 "type": u"child_of"} for child in children])
+        helpers.call_action(
+            "package_relationship_create",
+            subject=children[0]["id"], object=children[1]["id"],
+            type=u"sibling_of")
+        assert self._counts(parent["id"])[parent["id"]] == {u"parent_of": 3}
+        assert self._counts(children[1]["id"])[children[1]["id"]] == {
+            u"child_of": 1, u"sibling_of": 1}
+
+        helpers.call_action(
+            "package_relationship_delete",
+            subject=children[0]["id"], object=parent["id"],
+            type=u"child_of")
+        helpers.call_action(
+            "package_relationship_move_subtree",
+            source=parent["id"], target=other["id"])
+        counts = self._counts(parent["id"], other["id"])
+        assert counts[parent["id"]] == {}
+        assert counts[other["id"]] == {u"parent_of": 2}
+
+    def test_recount(self):
+        from ckanext.relationships.model import RelationshipCount, recount
+
+        parent = factories.Dataset()
+        child = factories.Dataset()
+        helpers.call_action(
+            "package_relationship_create",
+            subject=child["id"], object=parent["id"], type=u"child_of")
+        model.Session.query(RelationshipCount).update({"count": 7})
+        model.repo.commit()
+
+        assert recount() == 2
+        model.repo.commit()
+        counts = self._counts(parent["id"], child["id"])
+        assert counts[parent["id"]] == {u"parent_of": 1}
+        assert counts[child["id"]] == {u"child_of": 1}
@@ -0,0 +1,97 @@
+# encoding: utf-8
+
+import flask
+import pytest
+import ckan.plugins.toolkit as tk
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestRelationshipFilters(object):
+    def _names(self, fq):
+        result = helpers.call_action("package_search", fq=fq)
+        return sorted(pkg["name"] for pkg in result["results"])
+
+    def test_filters(self):
+        root = factories.Dataset(name=u"root")
+        child = factories.Dataset(name=u"child")
+        factories.Dataset(name=u"grandchild")
+        factories.Dataset(name=u"unrelated")
+        for subject, object_ in [(u"child", u"root"),
+                                 (u"grandchild", u"child")]:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=subject, object=object_, type=u"child_of")
+
+        assert self._names(u"child_of:root") == [u"child"]
+        assert self._names(u"parent_of:grandchild") == [u"child"]
+        assert self._names(u"descendant_of:root") == [u"child", u"grandchild"]
+        assert self._names(u"has_children:true") == [u"child", u"root"]
+        assert self._names(u"has_children:false") == [
+            u"grandchild", u"unrelated"]
+        assert self._names(
+            u"child_of:{} name:child".format(root["id"])) == [u"child"]
+        assert self._names(u"child_of:{}".format(child["id"])) == [
+            u"grandchild"]
+
+    def test_count_filters(self):
+        parent = factories.Dataset(name=u"parent")
+        factories.Dataset(name=u"lonely")
+        for name in (u"first", u"second"):
+            factories.Dataset(name=name)
+            helpers.call_action(
+                "package_relationship_create",
+                subject=name, object=parent["id"], type=u"child_of")
+
+        assert self._names(u"parent_of_count:2") == [u"parent"]
+        assert self._names(u"parent_of_count:[1 TO *]") == [u"parent"]
+        assert self._names(u"child_of_count:[0 TO 0]") == [
+            u"lonely", u"parent"]
+
+    @pytest.mark.ckan_config("ckanext.relationships.search.max_ids", 1)
+    def test_too_many_ids(self):
+        parents = [factories.Dataset() for _ in range(2)]
+        root = factories.Dataset(name=u"root")
+        for parent in parents:
+            helpers.call_action(
+                "package_relationship_create",
+                subject=parent["id"], object=root["id"], type=u"child_of")
+            helpers.call_action(
+                "package_relationship_create",
+                subject=factories.Dataset()["id"], object=parent["id"],
+                type=u"child_of")
+
+        # Answered from the indexed counts, whatever the number of datasets
+        assert len(self._names(u"has_children:true")) == 3
+        assert len(self._names(u"has_parent:false")) == 1
+        with pytest.raises(tk.ValidationError) as e:
+            self._names(u"descendant_of:root")
+        assert "descendant_of" in e.value.error_dict["fq"][0]
+
+    @pytest.mark.ckan_config("ckanext.relationships.traversal_max_depth", 1)
+    def test_tree_filters_are_not_limited_in_depth(self):
+        names = [u"level-{}".format(level) for level in range(4)]
+        for name in names:
+            factories.Dataset(name=name)
+        for child, parent in zip(names[1:], names):
+            helpers.call_action(
+                "package_relationship_create",
+                subject=child, object=parent, type=u"child_of")
+
+        assert self._names(u"descendant_of:level-0") == names[1:]
+        assert self._names(u"ancestor_of:level-3") == names[:3]
+
+    def test_unreadable_dataset_matches_nothing(self, app):
+        org = factories.Organization()
+        private = factories.Dataset(owner_org=org["id"], private=True)
+        factories.Dataset(name=u"child")
+        helpers.call_action(
+            "package_relationship_create",
+            subject=u"child", object=private["id"], type=u"child_of")
+
+        fq = u"child_of:{}".format(private["id"])
+        assert self._names(fq) == [u"child"]
+        with app.flask_app.test_request_context():
+            flask.g.user = u""
+            assert self._names(fq) == []
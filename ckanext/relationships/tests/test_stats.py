@@ -0,0 +1,63 @@
+# encoding: utf-8
+
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from ckanext.relationships import model as rel_model
+from ckanext.relationships.cli import relationship
+from ckanext.relationships.stats import GraphStats
+
+
+def _graph(edges):
+    graph = GraphStats()
+    for edge in edges:
+        graph.add(*edge)
+    return graph
+
+
+class TestGraphStats(object):
+    def test_summary(self):
+        graph = _graph([
+            (u"b", u"a", u"child_of"),
+            (u"c", u"b", u"child_of"),
+            (u"d", u"a", u"child_of"),
+            (u"x", u"y", u"sibling_of"),
+        ])
+        summary = graph.summary(top=2)
+
+        assert summary["packages"] == 6
+        assert summary["relationships"] == 4
+        assert summary["types"] == {u"child_of": 3, u"sibling_of": 1}
+        assert summary["components"] == 2
+        assert summary["largest_component"] == 4
+        assert summary["trees"] == 1
+        assert summary["max_depth"] == 2
+        assert summary["fanout"] == [(1, 1, 4), (2, 3, 2)]
+        assert summary["hubs"] == [(u"b", 2), (u"a", 2)] \
+            or summary["hubs"] == [(u"a", 2), (u"b", 2)]
+
+    def test_cycles_and_multiple_parents(self):
+        graph = _graph([
+            (u"p", u"q", u"child_of"),
+            (u"q", u"p", u"child_of"),
+            (u"p", u"r", u"child_of"),
+        ])
+        trees, cycles = graph.tree_depths()
+
+        assert cycles == 1
+        assert graph.multiple_parents == 1
+        assert list(trees.values()) == [1]
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_stats_command_removes_the_read_sessions(monkeypatch):
+    removed = []
+    monkeypatch.setattr(
+        rel_model, "remove_read_sessions", lambda: removed.append(True))
+
+    result = CliRunner().invoke(relationship, ["stats", "--json"])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)["relationships"] == 0
+    assert removed == [True]